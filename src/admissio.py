@@ -0,0 +1,74 @@
+"""
+    Admissió de connexions al servidor de xat
+
+    Cada connexió acceptada ocupa memòria i, amb el motor de fils, dos fils
+    d'execució. Per aguantar una allau de connexions (per exemple, quan tots
+    els participants es tornen a connectar alhora després d'un tall de la
+    xarxa) el servidor limita quantes connexions té obertes:
+
+    - en total (--connexions=N)
+    - per adreça IP (--connexions_ip=N)
+
+    Les connexions que superen algun límit es tanquen de seguida, sense
+    llegir-ne res. Una connexió compta des que s'accepta fins que es tanca,
+    també mentre encara no ha enviat el nom. Amb diversos processos, cada
+    procés aplica els límits a les seves connexions.
+
+    Quan el sistema no té recursos per acceptar més connexions (per exemple,
+    s'han exhaurit els descriptors de fitxer), el servidor deixa d'acceptar-ne
+    durant PAUSA_RECURSOS segons en comptes de donar-se per perdut.
+"""
+
+import errno
+import threading
+
+# Errors d'accept() que indiquen que falten recursos, no que s'ha perdut el servidor
+ERRORS_RECURSOS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+
+# Temps que es deixa d'acceptar connexions quan falten recursos (en segons)
+PAUSA_RECURSOS = 0.1
+
+# Nombre màxim de connexions que s'accepten de cop, abans d'atendre la resta de feina
+LOT_ACCEPTACIONS = 256
+
+
+class Admissio:
+    """ Comptador de les connexions obertes, en total i per adreça IP """
+
+    def __init__(self, maxim=0, maxim_ip=0):
+        self.maxim = maxim              # connexions obertes en total (0: sense límit)
+        self.maxim_ip = maxim_ip        # connexions obertes des de cada IP (0: sense límit)
+        self.bloqueig = threading.Lock()
+        self.obertes = 0
+        self.per_ip = dict()            # clau: adreça IP. valor: connexions obertes
+
+    def __len__(self):
+        return self.obertes
+
+    def admet(self, adressa):
+        """ compta la nova connexió des de l'adreça (host, port) si no supera
+            cap límit. Retorna si s'admet """
+        ip = adressa[0]
+        with self.bloqueig:
+            if self.maxim and self.obertes >= self.maxim:
+                return False
+            if self.maxim_ip and self.per_ip.get(ip, 0) >= self.maxim_ip:
+                return False
+            self.obertes += 1
+            self.per_ip[ip] = self.per_ip.get(ip, 0) + 1
+            return True
+
+    def allibera(self, adressa):
+        """ descompta una connexió admesa que s'ha tancat """
+        ip = adressa[0]
+        with self.bloqueig:
+            self.obertes -= 1
+            if self.per_ip[ip] == 1:
+                del self.per_ip[ip]
+            else:
+                self.per_ip[ip] -= 1
+
+
+def admissio(opcions):
+    """ crea l'admissió de connexions a partir de les opcions del servidor """
+    return Admissio(opcions['connexions'], opcions['connexions_ip'])
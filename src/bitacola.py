@@ -0,0 +1,151 @@
+"""
+    Bitàcola del servidor i del client de xat
+
+    Configura el mòdul logging perquè escriure un registre no aturi mai qui
+    l'escriu:
+
+    - els fils que registren només filtren el registre i el deixen en una cua.
+      Un fil escriptor (logging.handlers.QueueListener) els formata i els
+      escriu al fitxer, de manera que l'entrada/sortida del disc no alenteix
+      el xat
+    - els registres es formaten tard: cal cridar logging.info("... %s", valor)
+      en comptes de logging.info("... %s" % valor), de manera que els
+      registres descartats o per sota del nivell no es formaten mai. Per la
+      mateixa raó, els valors dels registres no s'han de modificar un cop
+      registrats
+    - cada categoria, és a dir cada text de registre abans de formatar-lo,
+      té un límit de registres per segon. Els registres per sota de WARNING
+      es poden mostrejar: se n'escriu només un de cada N. Quan es descarten
+      registres d'una categoria, el següent que s'escriu indica quants se n'han
+      omès
+    - el fitxer pot ser de text o de línies JSON (FORMAT_JSON)
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+# Formats del fitxer de la bitàcola
+FORMAT_TEXT = 'text'
+FORMAT_JSON = 'json'
+FORMATS = (FORMAT_TEXT, FORMAT_JSON)
+
+# Format de cada línia de la bitàcola de text
+PLANTILLA_TEXT = "%(asctime)s %(levelname)s: %(message)s"
+
+# Registres per segon que s'escriuen de cada categoria
+LIMIT_PER_DEFECTE = 50
+
+# Cua on es deixen els registres, o None si encara no s'ha configurat la bitàcola
+cua = None
+
+# Fil escriptor de la bitàcola, o None si no està en marxa
+escoltador = None
+
+
+class Limitador(logging.Filter):
+    """ Filtre que limita els registres per segon de cada categoria i en
+        mostreja els que són per sota de WARNING """
+
+    def __init__(self, limit=LIMIT_PER_DEFECTE, mostreig=1):
+        super().__init__()
+        self.limit = limit          # registres per segon de cada categoria (0: sense límit)
+        self.mostreig = mostreig    # s'escriu un de cada mostreig registres informatius
+        self.bloqueig = threading.Lock()
+        self.categories = dict()    # clau: categoria. valor: [fitxes, darrer moment, vistos, omesos]
+
+    def filter(self, record):
+        ara = time.monotonic()
+        with self.bloqueig:
+            estat = self.categories.get(record.msg)
+            if estat is None:
+                estat = self.categories[record.msg] = [self.limit, ara, 0, 0]
+            estat[2] += 1
+            if record.levelno < logging.WARNING and (estat[2] - 1) % self.mostreig:
+                estat[3] += 1
+                return False
+            if self.limit:
+                estat[0] = min(self.limit, estat[0] + (ara - estat[1]) * self.limit)
+                estat[1] = ara
+                if estat[0] < 1:
+                    estat[3] += 1
+                    return False
+                estat[0] -= 1
+            record.omesos = estat[3]
+            estat[3] = 0
+        return True
+
+
+class CuaBitacola(logging.handlers.QueueHandler):
+    """ Deixa els registres a la cua del fil escriptor sense formatar-los """
+
+    def prepare(self, record):
+        return record
+
+
+class FormatText(logging.Formatter):
+    """ Format de text, que indica quants registres de la categoria s'han omès """
+
+    def format(self, record):
+        text = super().format(record)
+        if getattr(record, 'omesos', 0):
+            text += " (omesos %s registres similars)" % record.omesos
+        return text
+
+
+class FormatJSON(logging.Formatter):
+    """ Format de línies JSON: un objecte per registre """
+
+    def format(self, record):
+        linia = {
+            'moment': self.formatTime(record),
+            'nivell': record.levelname,
+            'categoria': record.msg,
+            'missatge': record.getMessage(),
+            'fil': record.threadName,
+            'proces': record.process,
+        }
+        if getattr(record, 'omesos', 0):
+            linia['omesos'] = record.omesos
+        if record.exc_info:
+            linia['excepcio'] = self.formatException(record.exc_info)
+        return json.dumps(linia, ensure_ascii=False)
+
+
+def configura(fitxer, nivell=logging.INFO, format=FORMAT_TEXT, limit=LIMIT_PER_DEFECTE, mostreig=1):
+    """ configura la bitàcola de l'aplicació al fitxer indicat i arrenca el fil escriptor """
+    global cua
+    sortida = logging.FileHandler(fitxer)
+    sortida.setFormatter(FormatJSON() if format == FORMAT_JSON else FormatText(PLANTILLA_TEXT))
+    cua = CuaBitacola(queue.SimpleQueue())
+    cua.addFilter(Limitador(limit, mostreig))
+    cua.sortida = sortida
+    arrel = logging.getLogger()
+    arrel.addHandler(cua)
+    arrel.setLevel(nivell)
+    arrenca()
+    atexit.register(atura)
+
+
+def arrenca():
+    """ arrenca el fil escriptor, si la bitàcola està configurada i no està en marxa """
+    global escoltador
+    if cua is not None and escoltador is None:
+        escoltador = logging.handlers.QueueListener(cua.queue, cua.sortida)
+        escoltador.start()
+
+
+def atura():
+    """ escriu els registres pendents i atura el fil escriptor.
+
+        Cal aturar-lo abans de crear processos amb fork(): els fills no
+        hereten el fil, i podrien heretar el fitxer a mig escriure. Després
+        cal tornar-lo a arrencar (arrenca()) al pare i a cada fill """
+    global escoltador
+    if escoltador is not None:
+        escoltador.stop()
+        escoltador = None
@@ -0,0 +1,87 @@
+"""
+    Bus de missatges entre els processos del servidor de xat
+
+    Amb l'opció --processos, el servidor reparteix els participants entre
+    diversos processos que comparteixen el port. Perquè un missatge arribi als
+    membres d'una sala atesos per un altre procés, cada procés està connectat
+    amb tots els altres i amb el procés pare per parelles de sockets Unix
+    (socketpair) creades abans de llençar els processos.
+
+    Pel bus viatgen esdeveniments: llistes codificades en JSON dins de les
+    mateixes trames que fan servir els clients (protocol.py).
+
+    - [DIFUSIO, sales, missatge, desa, reenviament]: cal enviar el missatge
+      un sol cop a cada participant del procés que sigui membre d'alguna de
+      les sales, i guardar-lo a l'historial de les sales si desa és cert. Si
+      el missatge és d'un participant, reenviament és la llista [nom, sala,
+      missatge original] per refer el protocol.Reenviament, i si no, None
+    - [NOMBRE, sala, nombre]: el procés que l'envia té ara aquest nombre de
+      participants a la sala (sala None vol dir el total del procés)
+    - [PRIVAT, noms, missatge]: cal enviar el missatge privat un sol cop a
+      cada participant del procés que tingui algun dels noms
+    - [NOM, nom, nombre]: el procés que l'envia té ara aquest nombre de
+      participants amb el nom
+    - [FINALITZA]: el procés pare demana finalitzar
+"""
+
+import json
+import socket
+
+import protocol
+
+# Número del procés pare dins del bus. Els processos que atenen participants
+# es numeren a partir de 1
+PROCES_PARE = 0
+
+# Mida màxima d'un esdeveniment (en bytes). Un esdeveniment porta un missatge
+# d'una trama i, en JSON, alguns caràcters ocupen fins a sis bytes
+MIDA_MAXIMA_ESDEVENIMENT = 8 * protocol.MIDA_MAXIMA_TRAMA
+
+# Tipus d'esdeveniments
+DIFUSIO = "difusio"
+NOMBRE = "nombre"
+PRIVAT = "privat"
+NOM = "nom"
+FINALITZA = "finalitza"
+
+
+def codifica(*esdeveniment):
+    """ retorna la trama amb l'esdeveniment, a punt per enviar pel bus """
+    return protocol.codifica(json.dumps(esdeveniment, ensure_ascii=False), protocol.PROTOCOL_TRAMES)
+
+
+def reenviament(missatge):
+    """ retorna la llista amb què viatja pel bus un protocol.Reenviament, o
+        None si el missatge no ho és """
+    if isinstance(missatge, protocol.Reenviament):
+        return [missatge.nom, missatge.sala, missatge.missatge]
+    return None
+
+
+def descodifica(missatge):
+    """ retorna la llista de l'esdeveniment rebut en un missatge del bus """
+    return json.loads(missatge)
+
+
+def descodificador(entrada=None):
+    """ retorna un descodificador per als esdeveniments que arriben pel bus """
+    return protocol.Descodificador(protocol.PROTOCOL_TRAMES, entrada, MIDA_MAXIMA_ESDEVENIMENT)
+
+
+def crea_xarxa(processos):
+    """ connecta cada un dels processos (i el pare) amb tots els altres.
+        Retorna un diccionari amb els sockets de cada procés, per número:
+        {procés: {altre procés: socket}} """
+    xarxa = { numero: dict() for numero in range(PROCES_PARE, processos + 1) }
+    for numero in xarxa:
+        for altre in range(numero + 1, processos + 1):
+            xarxa[numero][altre], xarxa[altre][numero] = socket.socketpair()
+    return xarxa
+
+
+def tanca_altres(xarxa, numero):
+    """ tanca tots els sockets de la xarxa excepte els del procés indicat """
+    for altre, sockets in xarxa.items():
+        if altre != numero:
+            for connexio in sockets.values():
+                connexio.close()
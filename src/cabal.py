@@ -0,0 +1,151 @@
+"""
+    Limitació del cabal dels participants
+
+    Cada missatge que envia un participant es multiplica a les cues de tots els
+    membres de la sala. Sense cap límit, un sol participant que envia tan de
+    pressa com li permet TCP satura el servidor i endarrereix els missatges de
+    tothom. Per evitar-ho, cada connexió té un cabal màxim de missatges i de
+    bytes per segon, controlat amb cubells de fitxes: el cubell s'omple al
+    ritme permès fins a una capacitat que admet ràfegues curtes
+    (RAFEGA segons de cabal), i cada missatge en gasta.
+
+    A més, cada procés del servidor té un límit global de repartiments per
+    segon, compartit per tots els participants: un missatge compta tants
+    repartiments com membres tenen les sales on va. Acota la feina total de
+    difusió encara que molts participants enviïn alhora sense superar el seu
+    límit.
+
+    Quan un participant supera el seu cabal, l'acció escollida decideix què
+    passa amb el missatge:
+
+    - espera: es deixa de llegir del participant fins que torna a tenir
+      fitxes. Quan s'omplen les memòries intermèdies, TCP atura l'emissor
+    - descarta: es descarta el missatge, i s'avisa el participant del primer
+      que es descarta de cada ràfega
+    - desconnecta: es desconnecta el participant
+
+    Quan se supera el límit global, sempre s'espera: la culpa no és de cap
+    participant en concret.
+
+    Els cubells admeten que un missatge gasti més fitxes de les que queden
+    (i fins i tot més de la capacitat): el cubell queda en negatiu i el
+    missatge següent espera que es torni a omplir. Així el cabal mitjà
+    respecta el límit sigui quina sigui la mida dels missatges.
+"""
+
+import threading
+import time
+
+# Accions quan un participant supera el seu cabal
+ACCIO_ESPERA = 'espera'
+ACCIO_DESCARTA = 'descarta'
+ACCIO_DESCONNECTA = 'desconnecta'
+ACCIONS = (ACCIO_ESPERA, ACCIO_DESCARTA, ACCIO_DESCONNECTA)
+
+# Segons de cabal que admet cada cubell de cop, en una ràfega
+RAFEGA = 2
+
+
+class Cubell:
+    """ Cubell de fitxes que s'omple a raó de taxa fitxes per segon fins a la
+        capacitat """
+
+    __slots__ = ('taxa', 'capacitat', 'fitxes', 'moment')
+
+    def __init__(self, taxa, rafega=RAFEGA):
+        self.taxa = taxa
+        self.capacitat = max(1, taxa * rafega)
+        self.fitxes = self.capacitat
+        self.moment = time.monotonic()
+
+    def espera(self, ara):
+        """ omple el cubell fins al moment ara i retorna quants segons falta
+            esperar perquè tingui fitxes (0 si ja en té) """
+        self.fitxes = min(self.capacitat, self.fitxes + (ara - self.moment) * self.taxa)
+        self.moment = ara
+        return -self.fitxes / self.taxa if self.fitxes < 0 else 0
+
+    def gasta(self, quantitat):
+        self.fitxes -= quantitat
+
+
+class Limits:
+    """ Límits de cabal d'un procés del servidor: crea el cabal de cada
+        connexió i porta el cubell global dels repartiments """
+
+    def __init__(self, missatges_segon=0, bytes_segon=0, repartiments_segon=0, accio=ACCIO_ESPERA):
+        self.missatges_segon = missatges_segon      # 0: sense límit
+        self.bytes_segon = bytes_segon              # 0: sense límit
+        self.accio = accio
+        self.repartiments = Cubell(repartiments_segon) if repartiments_segon else None
+        self.bloqueig = threading.Lock()            # protegeix el cubell global
+
+    def cabal(self):
+        """ retorna el cabal d'una nova connexió, o None si no hi ha cap límit """
+        if self.missatges_segon or self.bytes_segon or self.repartiments:
+            return Cabal(self)
+        return None
+
+    def espera_global(self, ara):
+        if self.repartiments is None:
+            return 0
+        with self.bloqueig:
+            return self.repartiments.espera(ara)
+
+    def reparteix(self, nombre):
+        """ descompta del cubell global els repartiments fets """
+        if self.repartiments is not None and nombre:
+            with self.bloqueig:
+                self.repartiments.gasta(nombre)
+
+
+def limits(opcions):
+    """ crea els límits de cabal a partir de les opcions del servidor """
+    return Limits(opcions['missatges_segon'], opcions['bytes_segon'], opcions['repartiments_segon'],
+                  opcions['exces'])
+
+
+class Cabal:
+    """ Cabal d'una connexió """
+
+    __slots__ = ('limits', 'missatges', 'bytes', 'descartats')
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.missatges = Cubell(limits.missatges_segon) if limits.missatges_segon else None
+        self.bytes = Cubell(limits.bytes_segon) if limits.bytes_segon else None
+        self.descartats = 0     # missatges descartats seguits
+
+    def admet(self, missatge):
+        """ comprova si es pot processar ara el missatge.
+
+            Retorna la tupla (acció, espera): (None, 0) si es pot processar,
+            i llavors se'n descompten les fitxes, o bé l'acció que cal fer i
+            quants segons falten perquè es pugui processar """
+        ara = time.monotonic()
+        espera = 0
+        if self.missatges is not None:
+            espera = self.missatges.espera(ara)
+        if self.bytes is not None:
+            espera = max(espera, self.bytes.espera(ara))
+        if espera:
+            if self.limits.accio == ACCIO_DESCARTA:
+                self.descartats += 1
+            return (self.limits.accio, espera)
+        espera = self.limits.espera_global(ara)
+        if espera:
+            return (ACCIO_ESPERA, espera)
+        if self.missatges is not None:
+            self.missatges.gasta(1)
+        if self.bytes is not None:
+            self.bytes.gasta(len(missatge.encode("utf8")))
+        self.descartats = 0
+        return (None, 0)
+
+    def cal_avisar(self):
+        """ indica si el missatge que s'acaba de descartar és el primer de la ràfega """
+        return self.descartats == 1
+
+    def reparteix(self, nombre):
+        """ anota els repartiments que ha provocat el darrer missatge admès """
+        self.limits.reparteix(nombre)
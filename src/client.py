@@ -2,23 +2,43 @@
 
 """
     Implementació d'un client de xat
+
+    El client atén des d'un sol fil la consola i la connexió amb el servidor:
+    un bucle espera amb el mòdul selectors que arribi una línia de la consola
+    o dades del servidor, i mai no es queda bloquejat en cap de les dues.
+    Així, quan el servidor finalitza, el client se n'adona a l'instant encara
+    que ningú no escrigui res, i mentre la sala està en silenci el client no
+    es desperta per res.
+
+    Als sistemes on el selector no pot esperar l'entrada (a Windows, select()
+    només admet sockets), un fil llegeix la consola amb input() i passa les
+    línies al bucle per un parell de sockets (ConsolaFil).
+
+    Un cop connectat, el client espera els missatges del servidor sense límit
+    de temps: respon els batecs del servidor i deixa que TCP keepalive
+    detecti si s'ha perdut la connexió mentre la sala està en silenci.
+
+    El client parla el protocol binari (protocol.PROTOCOL_BINARI): els
+    missatges llargs viatgen comprimits i els noms dels participants,
+    internats.
+
+    La connexió amb el servidor la gestiona xat.Client, la mateixa
+    biblioteca que fan servir els bots (xat.py).
 """
 
+import codecs
+import os
+import selectors
 import socket
 import sys
 import threading
 import logging
 
-# Mida màxima dels missatges a intercanviar entre el client i el servidor
-MIDA_MISSATGE = 1024
-
-# Temps d'espera en les operacions d'entrada/sortida amb les connexions (en segons)
-MAXIM_ESPERA_CONNEXIO = 2
+import bitacola
+import xat
 
-# Constants per indicar el resultat d'una operació d'entrada/sortida amb sockets
-RESULTA_OK = 0          # operació realitzada amb éxit
-RESULTA_ERROR = 1       # operació no realitzada: s'ha produït un error
-RESULTA_TIMEOUT = 2     # operació no realitzada: s'ha superat el temps
+# Mida de cada lectura de la consola (en bytes)
+MIDA_LECTURA_CONSOLA = 4096
 
 
 def obte_ip_port_i_nom(argv):
@@ -43,154 +63,188 @@ def obte_ip_port_i_nom(argv):
     return (host, port, nom)
 
 
-def connecta_amb_servidor(host, port):
-    """ Connecta amb el servidor en la host i port especificats.
-        Si la connexió no és possible, ho notifica i finalitza l'execució.
+class Consola:
+    """ Lector de línies de la consola que no es bloqueja
+
+        Llegeix directament del descriptor de l'entrada només quan el selector
+        indica que hi ha dades, guarda les línies incompletes fins que arriben
+        senceres i passa cada línia al client.
     """
-    try:
-        connexio = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        connexio.settimeout(MAXIM_ESPERA_CONNEXIO)
-        connexio.connect((host, port))
-        return connexio
-    except socket.timeout:
-        logging.error("S'ha superat el temps d'espera màxim")
-        print("En aquests moments no es pot connectar amb el servidor. Prova més tard")
-        return None
-    except OSError:
-        logging.error("No s'ha pogut connectar amb el servidor")
-        print("Hi ha problemes per connectar-se amb el servidor")
-        return None
-
-
-def gestiona_connexio(connexio, finalitzacio):
-    """ Aquesta és la funció que gestiona la recepció de missatges per part de
-        la connexió.
-
-        Es manté escoltant noves peticions fins que es marqui la finalització o
-        hi hagi algun problema de connexió.  """
-    while not finalitzacio.isSet():
-        resultat, missatge = rep(connexio)
-        if resultat == RESULTA_TIMEOUT:
-            # ha superat el temps d'espera, provem un altre cop
-            continue
-        if resultat == RESULTA_ERROR:
-            # s'ha perdut la connexió amb el servidor
-            finalitzacio.set()
-            logging.info("Perduda la connexió amb el servidor")
-            print("Perduda la connexió amb el servidor")
-            break
 
-        if missatge == "{quit}":
-            finalitzacio.set()
-            logging.info("Rebut missatge de finalització del servidor")
-            print("El servidor s'ha tancat. Es finalitza aquesta sessió")
-            break
+    def __init__(self, client, entrada=None):
+        self.client = client
+        self.entrada = entrada if entrada is not None else sys.stdin
+        self.text = codecs.getincrementaldecoder("utf8")("replace")
+        self.pendent = ""       # línia incompleta
+
+    def fileno(self):
+        return self.entrada.fileno()
+
+    def rep(self):
+        """ retorna les dades que han arribat. Buides si s'ha acabat l'entrada """
+        return os.read(self.fileno(), MIDA_LECTURA_CONSOLA)
+
+    def llegeix(self):
+        """ retorna la llista de línies completes que han arribat, o None si
+            s'ha acabat l'entrada """
+        dades = self.rep()
+        if not dades:
+            linies = [self.pendent] if self.pendent else []
+            self.pendent = ""
+            return linies or None
+        linies = (self.pendent + self.text.decode(dades)).split("\n")
+        self.pendent = linies.pop()
+        return linies
+
+    def processa(self, mascara):
+        """ passa al client les línies que han arribat """
+        linies = self.llegeix()
+        if linies is None:
+            linies = ["{quit}"]     # s'ha acabat l'entrada
+        for linia in linies:
+            if not self.client.ordena(linia):
+                break
+
+
+class ConsolaFil(Consola):
+    """ Lector de línies de la consola per als sistemes on el selector no
+        admet l'entrada
+
+        Un fil llegeix les línies amb input() i les escriu en un parell de
+        sockets, i el bucle espera l'altre extrem com qualsevol connexió. Quan
+        s'acaba l'entrada, el fil tanca el seu extrem.
+    """
+
+    def __init__(self, client):
+        super().__init__(client)
+        self.lectura, self.escriptura = socket.socketpair()
+        threading.Thread(target=self.llegeix_consola, daemon=True).start()
 
-        # rebut un missatge stàndard
-        print(missatge)
-        logging.info("Rebut missatge %s" % missatge)
+    def fileno(self):
+        return self.lectura.fileno()
 
+    def rep(self):
+        return self.lectura.recv(MIDA_LECTURA_CONSOLA)
 
-    # tanca la connexió
-    connexio.close()
-    logging.info("Tancada la connexió")
-    logging.info("Finalitza el fil de gestió de la connexió")
+    def llegeix_consola(self):
+        """ fil que passa al bucle les línies de la consola """
+        try:
+            while True:
+                self.escriptura.sendall(bytes(input() + "\n", "utf8"))
+        except (EOFError, OSError):
+            pass
+        finally:
+            self.escriptura.close()
 
 
-def envia(connexio, missatge):
-    """ Tracta d'enviar el missatge al participant."""
+def consola_seleccionable(entrada):
+    """ indica si el selector del client pot esperar l'entrada. A Windows,
+        select() només admet sockets """
     try:
-        connexio.sendall(bytes(missatge, "utf8"))
-        return RESULTA_OK
-    except socket.timeout:
-        return RESULTA_TIMEOUT
-    except OSError as e:
-        return RESULTA_ERROR
-
-
-def rep(connexio):
-   """ obté un missatge del participant i es retorna
-       El resultat és la tupla (resultat, missatge) """
-   try:
-       missatge = connexio.recv(MIDA_MISSATGE).decode("utf8")
-       if len(missatge) == 0:
-           return (RESULTA_ERROR, '')
-       logging.info("Rebut missatge %s" % missatge)
-       return (RESULTA_OK, missatge.strip())
-   except socket.timeout:
-       return (RESULTA_TIMEOUT, None)
-   except OSError:
-       return (RESULTA_ERROR, None)
-
-
-def llenca_fil_gestio_connexio(connexio, finalitzacio):
-    """ llença el fil d'execució que gestionarà els missatges que es rebin del servidor """
-    threading.Thread(target=gestiona_connexio, args=(connexio, finalitzacio)).start()
-
-
-def processa_comandes(connexio, finalitzacio):
-    """ processa les comandes que es reben de consola. """
-    print("Introdueix els missatges que vulguis enviar a tothom. '{quit}' per abandonar el xat")
-    while not finalitzacio.isSet():
-        missatge = input().strip()
+        with selectors.SelectSelector() as selector:
+            selector.register(entrada, selectors.EVENT_READ)
+            selector.select(0)
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+class ClientConsola(xat.Client):
+    """ Participant que escriu a la consola els missatges que rep i envia les
+        línies que s'hi escriuen
+
+        Els missatges que arriben en una mateixa volta del bucle s'escriuen a
+        la consola de cop (presenta_sortida()). La consola només s'atén
+        mentre hi ha connexió amb el servidor.
+    """
+
+    def __init__(self, host, port, nom):
+        super().__init__(host, port, nom, reconnecta=False)
+        self.consola = Consola(self) if consola_seleccionable(sys.stdin) else ConsolaFil(self)
+        self.atenent_consola = False
+        self.connectada = False     # si s'ha arribat a connectar amb el servidor
+        self.finalitzada = False    # si el servidor ha finalitzat la sessió
+        self.sortida = []           # missatges pendents de presentar
+
+    def connectat(self):
+        self.connectada = True
+        self.bucle.registra(self.consola, self.consola, selectors.EVENT_READ)
+        self.atenent_consola = True
+
+    def desconnecta(self):
+        if self.atenent_consola:
+            self.bucle.desregistra(self.consola)
+            self.atenent_consola = False
+        super().desconnecta()
+
+    def rebut(self, missatge):
+        self.sortida.append(missatge.text)
+
+    def finalitzat(self):
+        self.finalitzada = True
+        self.sortida.append("El servidor s'ha tancat. Es finalitza aquesta sessió")
+
+    def desconnectat(self):
+        if not self.finalitzada:
+            self.sortida.append("Perduda la connexió amb el servidor")
+
+    def presenta_sortida(self):
+        """ escriu a la consola tots els missatges pendents de cop """
+        if self.sortida:
+            sys.stdout.write("\n".join(self.sortida) + "\n")
+            sys.stdout.flush()
+            self.sortida.clear()
+
+    def ordena(self, missatge):
+        """ envia una línia escrita a la consola. Retorna si la sessió continua """
+        missatge = missatge.strip()
         if len(missatge) == 0:  # ignorem missatges amb només espais o buits
-            continue
-        resultat = envia(connexio, missatge)
-        if resultat != RESULTA_OK:
+            return True
+        if self.envia(missatge) != xat.RESULTA_OK:
             print("S'ha produït un error en contactar amb el servidor. Es tanca la sessió.")
-            finalitzacio.set()
             logging.error("Error en enviar missatge al servidor")
-            break
+            self.tanca()
+            return False
         if missatge == "{quit}":
             print("Has abandonat la sala de xat. Fins la propera.")
-            finalitzacio.set()
             logging.info("El participant ha abandonat la sala de xat")
-            break
+            self.tanca()
+            return False
+        return True
+
 
 def principal(host, port, nom):
 
-    # crea marca de finalització
-    # Aquesta marca permet indicar als diferents fils d'execució que cal finalitzar
-    finalitzacio = threading.Event()
-    logging.info("Creat esdeveniment de finalització")
+    # select() admet també una entrada redirigida des d'un fitxer, que epoll
+    # rebutja. Amb només dues connexions no cal res més eficient
+    bucle = xat.Bucle(selectors.SelectSelector())
 
-    # Intentem la connexió amb el servidor
-    connexio = connecta_amb_servidor(host, port)
-    if not connexio:
-        logging.error("No s'ha aconseguit connectar amb el servidor")
-        return
+    # connecta amb el servidor i li envia el nom del participant
+    client = ClientConsola(host, port, nom)
+    bucle.afegeix(client)
 
-    logging.info("Connectat amb el servidor")
+    # atén la consola i la connexió amb el servidor
+    print("Introdueix els missatges que vulguis enviar a tothom. '{quit}' per abandonar el xat")
+    while client.actiu:
+        bucle.volta()
+        client.presenta_sortida()
+    client.presenta_sortida()
+    bucle.tanca()
 
-    # Envia el nom del participant
-    resultat = envia(connexio, nom)
-    if resultat != RESULTA_OK:
-        logging.error("No s'ha aconseguit enviar el nom al servidor")
+    if not client.connectada:
+        logging.error("No s'ha aconseguit connectar amb el servidor")
         print("No s'ha pogut contactar correctament amb el servidor")
-        connexio.close()
         return
-
-    # Arrenca la connexió amb el servidor
-    llenca_fil_gestio_connexio(connexio, finalitzacio)
-    logging.info("Llençat el fil de gestió de connexió")
-
-    # processa comandes de consola
-    processa_comandes(connexio, finalitzacio)
-
-
     print("Finalitzada la sessió")
-    logging.info("Finalitzada la sessió del participant %s" % nom)
+    logging.info("Finalitzada la sessió del participant %s", nom)
 
 if __name__ == '__main__':
     # configura el logging
-    logging.basicConfig(filename="%s.log" % sys.argv[0],
-            level=logging.INFO,
-            format="%(asctime)s %(levelname)s: %(message)s")
+    bitacola.configura("%s.log" % sys.argv[0])
     logging.info("Arrenca l'aplicació de client")
 
     # Obté la host i el port de connexió amb el servidor
     host, port, nom = obte_ip_port_i_nom(sys.argv)
-    logging.info("Obtingudes les dades de connexió. host: %s. Port: %s, nom: %s" % (host, port, nom))
+    logging.info("Obtingudes les dades de connexió. host: %s. Port: %s, nom: %s", host, port, nom)
 
     principal(host, port, nom)
-
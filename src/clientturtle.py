@@ -10,36 +10,42 @@
     [nomparticipant] tortuga comanda
 
     Les són: endavant, esquerra, dreta i inici
+
+    Cada participant mou la seva pròpia tortuga, d'un color diferent, que es
+    crea el primer cop que envia una comanda.
+
+    La connexió amb el servidor la gestiona un xat.Client en un fil propi,
+    perquè el fil principal ha de dibuixar la tortuga. El fil de la connexió
+    analitza els missatges i deixa a la cua només les comandes conegudes.
+
+    El fil principal dibuixa a cops de rellotge: a cada cop treu de la cua
+    totes les comandes pendents de tots els participants i les aplica a
+    l'estat de les tortugues (tortuga.Dibuix), que ajunta les de cada
+    participant que es repeteixen seguides (deu passos endavant són una sola
+    línia). Després dibuixa les línies noves de l'estat amb l'animació
+    aturada, refent la pantalla un sol cop. Així una allau de comandes d'una
+    sala animada es dibuixa de seguida en comptes d'anar-se acumulant.
 """
 
-import socket
 import sys
 import threading
 import logging
 import turtle
-import re
 import queue
 import time
 
-# Mida màxima dels missatges a intercanviar entre el client i el servidor
-MIDA_MISSATGE = 1024
-
-# Temps d'espera en les operacions d'entrada/sortida amb les connexions (en segons)
-MAXIM_ESPERA_CONNEXIO = 2
-
-# Constants de la tortuga
-NOM_TORTUGA = "tortuga"
-PAS_TORTUGA = 100           # longitut d'un pas de tortuga
-GIR_TORTUGA = 90            # graus de gir de tortuga
+import tortuga
+import xat
 
+# Temps entre dos cops de rellotge del dibuix (en mil·lisegons)
+INTERVAL_DIBUIX = 40
 
-# Aspecte d'una comanda vàlida
-COMANDA_VALIDA_REGEX = '^\[(.*)\] tortuga (.*)$'
+# Màxim de comandes que es dibuixen a cada cop de rellotge. Les que sobren
+# esperen al cop següent, perquè la finestra continuï responent
+MAXIM_COMANDES_DIBUIX = 10000
 
-# Constants per indicar el resultat d'una operació d'entrada/sortida amb sockets
-RESULTA_OK = 0          # operació realitzada amb éxit
-RESULTA_ERROR = 1       # operació no realitzada: s'ha produït un error
-RESULTA_TIMEOUT = 2     # operació no realitzada: s'ha superat el temps
+# Nom del participant que dibuixa les tortugues
+NOM_TORTUGA = "tortuga"
 
 
 def obte_host_i_port(argv):
@@ -62,119 +68,119 @@ def obte_host_i_port(argv):
     return (host, port)
 
 
-def connecta_amb_servidor(host, port):
-    """ Connecta amb el servidor en la host i port especificats.
-        Si la connexió no és possible, ho notifica i finalitza l'execució.
-    """
-    try:
-        connexio = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        connexio.settimeout(MAXIM_ESPERA_CONNEXIO)
-        connexio.connect((host, port))
-        return connexio
-    except socket.timeout:
-        logging.error("S'ha superat el temps d'espera màxim")
-        print("En aquests moments no es pot connectar amb el servidor. Prova més tard")
-        return None
-    except OSError:
-        logging.error("No s'ha pogut connectar amb el servidor")
-        print("Hi ha problemes per connectar-se amb el servidor")
-        return None
-
-
-def gestiona_connexio(connexio, missatges, finalitzacio):
-    """ Aquesta és la funció que gestiona la recepció de missatges per part de
-        la connexió.
-
-        Es manté escoltant noves peticions fins que es marqui la finalització o
-        hi hagi algun problema de connexió.  """
-    while not finalitzacio.isSet():
-        resultat, missatge = rep(connexio)
-        if resultat == RESULTA_TIMEOUT:
-            # ha superat el temps d'espera, provem un altre cop
-            continue
-        if resultat == RESULTA_ERROR:
-            # s'ha perdut la connexió amb el servidor
-            finalitzacio.set()
-            logging.info("Perduda la connexió amb el servidor")
-            print("Perduda la connexió amb el servidor")
-            break
+class ClientTortuga(xat.Client):
+    """ Participant que passa a la cua les comandes de tortuga que envien els
+        altres participants """
 
-        if missatge == "{quit}":
-            finalitzacio.set()
-            logging.info("Rebut missatge de finalització del servidor")
-            print("El servidor s'ha tancat. Es finalitza aquesta sessió")
-            break
+    def __init__(self, host, port, comandes):
+        super().__init__(host, port, NOM_TORTUGA, reconnecta=False)
+        self.comandes = comandes
 
-        # rebut un missatge stàndard
-        missatges.put(missatge)
+    def rebut(self, missatge):
+        if missatge.emissor is None:
+            return
+        nom = tortuga.analitza(missatge)
+        if nom is not None:
+            self.comandes.put((missatge.emissor, nom))
 
+    def finalitzat(self):
+        print("El servidor s'ha tancat. Es finalitza aquesta sessió")
 
-    # tanca la connexió
-    connexio.close()
-    logging.info("Tancada la connexió")
+    def desconnectat(self):
+        print("Perduda la connexió amb el servidor")
+
+
+def gestiona_connexio(bucle, finalitzacio):
+    """ atén la connexió amb el servidor fins que es tanca o es marca la
+        finalització, i llavors marca la finalització """
+    bucle.executa(finalitzacio)
+    finalitzacio.set()
+    bucle.tanca()
     logging.info("Finalitza el fil de gestió de la connexió")
 
 
-def envia(connexio, missatge):
-    """ Tracta d'enviar el missatge al participant."""
-    try:
-        connexio.sendall(bytes(missatge, "utf8"))
-        return RESULTA_OK
-    except socket.timeout:
-        return RESULTA_TIMEOUT
-    except OSError as e:
-        return RESULTA_ERROR
-
-
-def rep(connexio):
-   """ obté un missatge del participant i es retorna
-       El resultat és la tupla (resultat, missatge) """
-   try:
-       missatge = connexio.recv(MIDA_MISSATGE).decode("utf8")
-       if len(missatge) == 0:
-           return (RESULTA_ERROR, '')
-       logging.info("Rebut missatge %s" % missatge)
-       return (RESULTA_OK, missatge.strip())
-   except socket.timeout:
-       return (RESULTA_TIMEOUT, None)
-   except OSError:
-       return (RESULTA_ERROR, None)
-
-
-def llenca_fil_gestio_connexio(connexio, missatges, finalitzacio):
+def llenca_fil_gestio_connexio(bucle, finalitzacio):
     """ llença el fil d'execució que gestionarà els missatges que es rebin del servidor """
-    thread = threading.Thread(target=gestiona_connexio, args=(connexio, missatges, finalitzacio))
+    thread = threading.Thread(target=gestiona_connexio, args=(bucle, finalitzacio))
     thread.start()
 
 
-def processa_missatges(missatges, tortuga, finalitzacio):
-    """ processa les missatges que vagin arribant a la cua """
-    while not finalitzacio.isSet():
-        if missatges.empty():   # ens esperem una mica
-            time.sleep(1)
-            continue
+def treu_comandes(comandes):
+    """ treu de la cua les comandes pendents, com a molt MAXIM_COMANDES_DIBUIX """
+    lot = []
+    while len(lot) < MAXIM_COMANDES_DIBUIX:
         try:
-            missatge = missatges.get(MAXIM_ESPERA_CONNEXIO)
+            lot.append(comandes.get_nowait())
         except queue.Empty:
-            continue
-        missatges.task_done()
-        m = re.match(COMANDA_VALIDA_REGEX, missatge)
-        if m:
-            comanda = m.group(2)
-            processa_comanda(comanda, tortuga)
-
-
-def processa_comanda(comanda, tortuga):
-    """ executa la comanda si l'enten. Altrament la ignora. """
-    logging.info("processant la comanda %s" % comanda)
-    if comanda == 'endavant':
-        tortuga.forward(PAS_TORTUGA)
-    elif comanda == 'dreta':
-        tortuga.right(GIR_TORTUGA)
-    elif comanda == 'esquerra':
-        tortuga.left(GIR_TORTUGA)
-    elif comanda == 'inicia':
-        tortuga.reset()
+            break
+    return lot
+
+
+class Llenc:
+    """ Llenç on es dibuixa l'estat de les tortugues de tots els participants
+
+        Cada tortuga de l'estat té el seu llapis de turtle. A cada cop de
+        rellotge només es dibuixen les línies que l'estat ha afegit o allargat
+        des del cop anterior; si la tortuga s'ha reiniciat, s'esborra i es
+        torna a dibuixar.
+    """
+
+    def __init__(self, pantalla):
+        self.pantalla = pantalla
+        self.dibuix = tortuga.Dibuix()
+        self.llapis = dict()        # clau: nom del participant. valor: turtle.Pen
+        self.dibuixats = dict()     # clau: nom. valor: (reinicis, coordenades ja dibuixades)
+
+    def processa_comandes(self, lot):
+        """ aplica un lot de comandes (emissor, nom) i dibuixa el resultat """
+        for emissor in self.dibuix.aplica_lot(lot):
+            self.mostra(self.dibuix.tortugues[emissor])
+
+    def mostra(self, estat):
+        """ dibuixa les línies noves de la tortuga i la posa on diu l'estat """
+        llapis = self.llapis.get(estat.nom)
+        if llapis is None:
+            llapis = turtle.Pen()
+            llapis.color(estat.color)
+            llapis.penup()
+            self.llapis[estat.nom] = llapis
+            logging.info("Nova tortuga per %s", estat.nom)
+        reinicis, dibuixats = self.dibuixats.get(estat.nom, (0, 0))
+        if reinicis != estat.reinicis:
+            llapis.clear()
+            dibuixats = 0
+        segments = estat.segments
+        if dibuixats and llapis.distance(segments[dibuixats - 2], segments[dibuixats - 1]) > 1e-6:
+            # l'estat ha allargat la darrera línia dibuixada, que acaba on és el llapis
+            llapis.pendown()
+            llapis.goto(segments[dibuixats - 2], segments[dibuixats - 1])
+        for i in range(dibuixats, len(segments), 4):
+            x0, y0, x1, y1 = segments[i:i + 4]
+            if llapis.distance(x0, y0) > 1e-6:
+                llapis.penup()
+                llapis.goto(x0, y0)
+            llapis.pendown()
+            llapis.goto(x1, y1)
+        llapis.penup()
+        llapis.goto(estat.x, estat.y)
+        llapis.setheading(estat.angle)
+        self.dibuixats[estat.nom] = (estat.reinicis, len(segments))
+
+
+def dibuixa(llenc, comandes, finalitzacio):
+    """ cop de rellotge del dibuix: executa les comandes pendents, refà la
+        pantalla si cal i programa el cop següent. El cop següent es programa
+        descomptant el que ha trigat aquest, per mantenir el ritme """
+    if finalitzacio.is_set():
+        llenc.pantalla.bye()
+        return
+    inici = time.monotonic()
+    lot = treu_comandes(comandes)
+    if lot:
+        llenc.processa_comandes(lot)
+        llenc.pantalla.update()
+    durada = int((time.monotonic() - inici) * 1000)
+    llenc.pantalla.ontimer(lambda: dibuixa(llenc, comandes, finalitzacio), max(1, INTERVAL_DIBUIX - durada))
 
 
 def principal(host, port):
@@ -184,34 +190,37 @@ def principal(host, port):
     finalitzacio = threading.Event()
     logging.info("Creat esdeveniment de finalització")
 
-    # Intentem la connexió amb el servidor
-    connexio = connecta_amb_servidor(host, port)
-    if not connexio:
-        logging.error("No s'ha aconseguit connectar amb el servidor")
-        return
+    # Crea la cua on es guarden les comandes que es vagin rebent pel xat
+    comandes = queue.Queue()
 
-    logging.info("Connectat amb el servidor")
-
-    # Envia el nom del participant
-    resultat = envia(connexio, NOM_TORTUGA)
-    if resultat != RESULTA_OK:
-        logging.error("No s'ha aconseguit enviar el nom al servidor")
-        print("No s'ha pogut contactar correctament amb el servidor")
-        connexio.close()
+    # Connecta amb el servidor i li envia el nom del participant
+    bucle = xat.Bucle()
+    bucle.afegeix(ClientTortuga(host, port, comandes))
+    if not bucle.clients:
+        logging.error("No s'ha aconseguit connectar amb el servidor")
+        print("Hi ha problemes per connectar-se amb el servidor")
+        bucle.tanca()
         return
 
-    # Arrenca la tortuga
-    tortuga = turtle.Pen()
-
-    # Crea la cua es guarden els missatges que es vagin rebent pel xat
-    missatges = queue.Queue()
+    # Prepara el llenç de les tortugues, amb l'animació aturada: la pantalla
+    # es refà un cop per cada lot de comandes
+    pantalla = turtle.Screen()
+    pantalla.tracer(0)
+    llenc = Llenc(pantalla)
 
     # Arrenca la connexió amb el servidor
-    llenca_fil_gestio_connexio(connexio, missatges, finalitzacio)
+    llenca_fil_gestio_connexio(bucle, finalitzacio)
     logging.info("Llençat el fil de gestió de connexió")
 
-    # processa les comandes que arribin del xat
-    processa_missatges(missatges, tortuga, finalitzacio)
+    # dibuixa les comandes que arribin del xat fins que es tanqui la
+    # connexió o la finestra
+    dibuixa(llenc, comandes, finalitzacio)
+    try:
+        pantalla.mainloop()
+    except turtle.Terminator:
+        pass
+    finalitzacio.set()
+    bucle.desperta()
 
     logging.info("Finalitza l'execució del client tortuga")
 
@@ -0,0 +1,385 @@
+"""
+    Diari persistent dels missatges de la sala de xat
+
+    Amb l'opció --diari=directori, el servidor guarda tots els missatges que
+    els participants envien a les sales en un registre binari on només s'hi
+    afegeix al final. El registre es reparteix en segments (fitxers .seg) de
+    com a molt MIDA_SEGMENT bytes, i cada segment té al costat un índex (fitxer
+    .idx) amb la posició de cada missatge dins del segment.
+
+    Cada missatge del segment és una capçalera (REGISTRE) seguida del nom de
+    la sala i del missatge en UTF-8. La capçalera porta el CRC de la resta del
+    missatge, de manera que en arrencar es detecta un missatge escrit a mitges
+    i es descarta.
+
+    Els missatges no s'escriuen des del fil que els difon: afegeix() només els
+    deixa a la llista de pendents i un fil escriptor els escriu en blocs.
+    Quan arriba un missatge, l'escriptor espera AGRUPACIO segons i escriu i
+    sincronitza amb el disc (fsync) plegats tots els que han arribat mentrestant
+    (group commit). Així el diari no afegeix latència a la difusió: l'escriptor
+    es desperta poc sovint i la codificació i el CRC es fan al seu fil.
+
+    En arrencar, el diari projecta els segments en memòria (mmap) per refer
+    l'índex de cada sala sense llegir-los línia a línia, i les sales recuperen
+    l'historial dels seus darrers missatges.
+
+    Les consultes només bloquegen el diari per localitzar els missatges
+    (segment i posició, o el text si encara està pendent). Els missatges es
+    llegeixen dels segments després, de manera que consultar l'historial no
+    atura la difusió, que també ha de bloquejar el diari per afegir-hi.
+"""
+
+import array
+import bisect
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+# Capçalera de cada missatge del diari: CRC de la resta del missatge, mida del
+# missatge, número de seqüència dins de la sala, moment (segons des de
+# l'època) i mida del nom de la sala
+REGISTRE = struct.Struct("!IIQdH")
+
+# Mida a partir de la qual es comença un nou segment (en bytes)
+MIDA_SEGMENT = 16 * 1024 * 1024
+
+# Entrades de l'índex: posició de cada missatge dins del segment
+TIPUS_INDEX = 'Q'
+
+# Extensions dels fitxers del diari
+EXTENSIO_SEGMENT = ".seg"
+EXTENSIO_INDEX = ".idx"
+
+# Nombre màxim de missatges que es llegeixen del diari en una consulta
+MIDA_PAGINA = 100
+
+# Temps que l'escriptor espera per agrupar missatges abans d'escriure'ls (en
+# segons). És el màxim de missatges recents que es poden perdre si cau la màquina
+AGRUPACIO = 0.05
+
+
+class Segment:
+    """ Fitxer del diari amb missatges consecutius i les seves posicions """
+
+    __slots__ = ('primer', 'cami', 'posicions', 'mida', 'projeccio', 'bloqueig')
+
+    def __init__(self, primer, cami):
+        self.primer = primer            # número global del primer missatge del segment
+        self.cami = cami
+        self.posicions = array.array(TIPUS_INDEX)   # posició de cada missatge
+        self.mida = 0                   # bytes escrits al segment
+        self.projeccio = None           # mmap del segment, o None si encara no cal
+        self.bloqueig = threading.Lock()    # protegeix la projecció mentre es llegeix
+
+    def projecta(self, mida):
+        """ retorna la projecció en memòria del segment amb com a mínim mida bytes """
+        if self.projeccio is None or len(self.projeccio) < mida:
+            if self.projeccio is not None:
+                self.projeccio.close()
+            with open(self.cami, 'rb') as fitxer:
+                self.projeccio = mmap.mmap(fitxer.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.projeccio
+
+    def capcalera(self, index):
+        """ retorna la tupla (projecció, inici, mida del missatge, mida de la
+            sala) del missatge index del segment """
+        posicio = self.posicions[index]
+        inici = posicio + REGISTRE.size
+        projeccio = self.projecta(inici)
+        _, mida, _, _, mida_sala = REGISTRE.unpack_from(projeccio, posicio)
+        return self.projecta(inici + mida_sala + mida), inici, mida, mida_sala
+
+    def sala(self, index):
+        """ retorna la sala del missatge index del segment """
+        projeccio, inici, _, mida_sala = self.capcalera(index)
+        return str(projeccio[inici:inici + mida_sala], "utf8")
+
+    def llegeix(self, index):
+        """ retorna el text del missatge index del segment. Es pot cridar des
+            de diversos fils alhora """
+        with self.bloqueig:
+            projeccio, inici, mida, mida_sala = self.capcalera(index)
+            return str(projeccio[inici + mida_sala:inici + mida_sala + mida], "utf8")
+
+    def tanca(self):
+        with self.bloqueig:
+            if self.projeccio is not None:
+                self.projeccio.close()
+                self.projeccio = None
+
+
+def codifica(sala, sequencia, missatge, moment):
+    """ retorna els bytes d'un missatge del diari """
+    sala = bytes(sala, "utf8")
+    missatge = bytes(missatge, "utf8")
+    cos = REGISTRE.pack(0, len(missatge), sequencia, moment, len(sala))[4:] + sala + missatge
+    return struct.pack("!I", zlib.crc32(cos)) + cos
+
+
+def valida(dades, posicio):
+    """ retorna la tupla (sala, final) del missatge que comença a la posició,
+        o None si no hi ha un missatge sencer i correcte """
+    if posicio + REGISTRE.size > len(dades):
+        return None
+    crc, mida, _, _, mida_sala = REGISTRE.unpack_from(dades, posicio)
+    inici = posicio + REGISTRE.size
+    final = inici + mida_sala + mida
+    if final > len(dades) or zlib.crc32(dades[posicio + 4:final]) != crc:
+        return None
+    try:
+        return str(dades[inici:inici + mida_sala], "utf8"), final
+    except UnicodeDecodeError:
+        return None
+
+
+def recorre(directori):
+    """ genera en ordre les tuples (sala, missatge) de tots els missatges del
+        diari del directori, sense modificar-lo ni fer servir els índexs. Per
+        llegir el diari d'un servidor que no està en marxa """
+    noms = sorted(nom for nom in os.listdir(directori) if nom.endswith(EXTENSIO_SEGMENT))
+    for nom in noms:
+        with open(os.path.join(directori, nom), 'rb') as fitxer:
+            if os.fstat(fitxer.fileno()).st_size == 0:
+                continue
+            with mmap.mmap(fitxer.fileno(), 0, access=mmap.ACCESS_READ) as dades:
+                posicio = 0
+                while True:
+                    resultat = valida(dades, posicio)
+                    if resultat is None:
+                        break
+                    sala, final = resultat
+                    mida_sala = REGISTRE.unpack_from(dades, posicio)[4]
+                    yield sala, str(dades[posicio + REGISTRE.size + mida_sala:final], "utf8")
+                    posicio = final
+
+
+def nom_segment(directori, primer, extensio):
+    return os.path.join(directori, "%020d%s" % (primer, extensio))
+
+
+class Diari:
+    """ Registre persistent dels missatges de les sales
+
+        Els missatges tenen un número global (ordre d'arribada al diari) i un
+        número de seqüència dins de la seva sala, que comença per 1. L'índex
+        de cada sala guarda el número global dels seus missatges.
+    """
+
+    def __init__(self, directori, mida_segment=MIDA_SEGMENT):
+        self.directori = directori
+        self.mida_segment = mida_segment
+        self.condicio = threading.Condition()
+        self.segments = []              # segments per ordre, l'últim és el que s'escriu
+        self.inicis = []                # número global del primer missatge de cada segment
+        self.sales = dict()             # clau: sala. valor: array amb els números globals
+        self.escrits = 0                # missatges que ja són al disc
+        self.pendents = []              # (sala, seqüència, missatge, moment) que encara no s'han escrit
+        self.finalitzant = False
+        self.fitxer = None              # segment obert per escriure
+        self.fitxer_index = None
+        os.makedirs(directori, exist_ok=True)
+        self.recupera()
+        self.escriptor = threading.Thread(target=self.executa, name="diari", daemon=True)
+        self.escriptor.start()
+
+    def __len__(self):
+        with self.condicio:
+            return self.escrits + len(self.pendents)
+
+    def recupera(self):
+        """ refà l'índex de les sales a partir dels segments del directori """
+        inici = time.monotonic()
+        noms = sorted(nom for nom in os.listdir(self.directori) if nom.endswith(EXTENSIO_SEGMENT))
+        for nom in noms:
+            segment = Segment(self.escrits, os.path.join(self.directori, nom))
+            self.recupera_segment(segment)
+            for index in range(len(segment.posicions)):
+                sala = segment.sala(index)
+                self.sales.setdefault(sala, array.array(TIPUS_INDEX)).append(self.escrits + index)
+            self.segments.append(segment)
+            self.inicis.append(segment.primer)
+            self.escrits += len(segment.posicions)
+        if noms:
+            logging.info("Recuperats %s missatges de %s sales del diari en %.3f segons",
+                         self.escrits, len(self.sales), time.monotonic() - inici)
+
+    def recupera_segment(self, segment):
+        """ obté les posicions dels missatges del segment. Fa servir l'índex si
+            és coherent amb el segment, i si no el refà recorrent el segment.
+            Els bytes del final que no formen un missatge correcte es descarten """
+        cami_index = segment.cami[:-len(EXTENSIO_SEGMENT)] + EXTENSIO_INDEX
+        mida = os.path.getsize(segment.cami)
+        if mida == 0:
+            return
+        dades = segment.projecta(mida)
+        try:
+            with open(cami_index, 'rb') as fitxer:
+                segment.posicions.frombytes(fitxer.read())
+            if segment.posicions:
+                darrer = valida(dades, segment.posicions[-1])
+                if darrer is not None and darrer[1] == mida:
+                    segment.mida = mida
+                    return
+        except (OSError, ValueError):
+            pass
+        segment.posicions = array.array(TIPUS_INDEX)
+        posicio = 0
+        while True:
+            resultat = valida(dades, posicio)
+            if resultat is None:
+                break
+            segment.posicions.append(posicio)
+            posicio = resultat[1]
+        segment.mida = posicio
+        segment.tanca()
+        if posicio < mida:
+            logging.warning("Descartats %s bytes incorrectes al final del segment %s", mida - posicio, segment.cami)
+            os.truncate(segment.cami, posicio)
+        with open(cami_index, 'wb') as fitxer:
+            segment.posicions.tofile(fitxer)
+
+    def afegeix(self, sala, missatge):
+        """ deixa el missatge pendent d'escriure al diari i retorna el seu
+            número de seqüència dins de la sala. No espera a escriure'l """
+        with self.condicio:
+            if self.finalitzant:
+                return None
+            numeros = self.sales.setdefault(sala, array.array(TIPUS_INDEX))
+            numeros.append(self.escrits + len(self.pendents))
+            sequencia = len(numeros)
+            self.pendents.append((sala, sequencia, missatge, time.time()))
+            if len(self.pendents) == 1:
+                self.condicio.notify()
+            return sequencia
+
+    def nombre(self, sala):
+        """ retorna quants missatges de la sala hi ha al diari """
+        with self.condicio:
+            numeros = self.sales.get(sala)
+            return len(numeros) if numeros is not None else 0
+
+    def darrers(self, sala, nombre):
+        """ retorna la tupla (primer, missatges) amb com a molt els darrers
+            nombre missatges de la sala i el número de seqüència del primer """
+        with self.condicio:
+            numeros = self.sales.get(sala, ())
+            nombre = max(0, min(nombre, len(numeros)))
+            inici = len(numeros) - nombre
+            localitzats = self.localitza(numeros, inici, len(numeros))
+        return inici + 1, self.extreu(localitzats)
+
+    def des_de(self, sala, sequencia, nombre=MIDA_PAGINA):
+        """ retorna la tupla (primer, missatges) amb com a molt nombre missatges
+            de la sala posteriors al de número de seqüència indicat """
+        with self.condicio:
+            numeros = self.sales.get(sala, ())
+            inici = max(0, min(sequencia, len(numeros)))
+            localitzats = self.localitza(numeros, inici, min(len(numeros), inici + max(0, nombre)))
+        return inici + 1, self.extreu(localitzats)
+
+    def localitza(self, numeros, inici, final):
+        """ retorna on és cada missatge de les posicions inici a final de
+            l'índex d'una sala: el text si encara està pendent d'escriure, o
+            la tupla (segment, índex dins del segment). Cal cridar-la amb el
+            bloqueig adquirit """
+        localitzats = []
+        for numero in numeros[inici:final]:
+            if numero >= self.escrits:
+                localitzats.append(self.pendents[numero - self.escrits][2])
+            else:
+                segment = self.segments[bisect.bisect_right(self.inicis, numero) - 1]
+                localitzats.append((segment, numero - segment.primer))
+        return localitzats
+
+    def extreu(self, localitzats):
+        """ retorna els textos dels missatges localitzats amb localitza().
+            Es crida sense el bloqueig: els segments només creixen """
+        return [localitzat if isinstance(localitzat, str) else localitzat[0].llegeix(localitzat[1])
+                for localitzat in localitzats]
+
+    def executa(self):
+        """ fil escriptor: escriu i sincronitza els missatges pendents en blocs """
+        while True:
+            with self.condicio:
+                while not self.pendents and not self.finalitzant:
+                    self.condicio.wait()
+                if not self.pendents:
+                    break
+                if not self.finalitzant:
+                    self.condicio.wait(AGRUPACIO)   # només el desperta la finalització
+                lot = list(self.pendents)
+            try:
+                posicions = self.escriu(lot)
+            except OSError:
+                # els missatges pendents es continuen consultant des de la memòria
+                logging.exception("No s'ha pogut escriure al diari. Es deixa d'escriure")
+                with self.condicio:
+                    self.finalitzant = True
+                break
+            with self.condicio:
+                for segment, posicio in posicions:
+                    segment.posicions.append(posicio)
+                del self.pendents[:len(lot)]
+                self.escrits += len(lot)
+        if self.fitxer is not None:
+            self.fitxer.close()
+            self.fitxer_index.close()
+        for segment in self.segments:
+            segment.tanca()
+
+    def escriu(self, lot):
+        """ escriu un bloc de missatges al final del diari i el sincronitza
+            amb el disc. Retorna la llista (segment, posició) de cada missatge """
+        posicions = []
+        dades = []
+        indexs = []
+        for numero, pendent in enumerate(lot, self.escrits):
+            registre = codifica(*pendent)
+            if self.fitxer is None or self.segments[-1].mida >= self.mida_segment:
+                self.buida(dades, indexs)
+                self.obre_segment(numero)
+            segment = self.segments[-1]
+            posicions.append((segment, segment.mida))
+            indexs.append(segment.mida)
+            dades.append(registre)
+            segment.mida += len(registre)
+        self.buida(dades, indexs)
+        return posicions
+
+    def buida(self, dades, indexs):
+        """ escriu al segment obert les dades i les posicions acumulades """
+        if not dades:
+            return
+        self.fitxer.write(b''.join(dades))
+        self.fitxer.flush()
+        os.fsync(self.fitxer.fileno())
+        self.fitxer_index.write(array.array(TIPUS_INDEX, indexs).tobytes())
+        self.fitxer_index.flush()
+        del dades[:]
+        del indexs[:]
+
+    def obre_segment(self, primer):
+        """ obre per escriure el darrer segment, o en comença un de nou si no
+            n'hi ha o el darrer és ple """
+        if self.fitxer is not None:
+            self.fitxer.close()
+            self.fitxer_index.close()
+        if not self.segments or self.segments[-1].mida >= self.mida_segment:
+            segment = Segment(primer, nom_segment(self.directori, primer, EXTENSIO_SEGMENT))
+            with self.condicio:
+                self.segments.append(segment)
+                self.inicis.append(primer)
+        segment = self.segments[-1]
+        self.fitxer = open(segment.cami, 'ab')
+        self.fitxer_index = open(segment.cami[:-len(EXTENSIO_SEGMENT)] + EXTENSIO_INDEX, 'ab')
+
+    def tanca(self):
+        """ escriu els missatges pendents i atura el fil escriptor """
+        with self.condicio:
+            self.finalitzant = True
+            self.condicio.notify()
+        self.escriptor.join()
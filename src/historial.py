@@ -0,0 +1,64 @@
+"""
+    Historial dels missatges recents d'una sala de xat
+
+    Cada sala guarda els seus darrers missatges en una memòria circular de
+    capacitat fixa: quan és plena, cada missatge nou fa fora el més antic. Així
+    la memòria no creix encara que el servidor funcioni molt de temps.
+
+    Els missatges es guarden ja codificats (un diccionari amb la trama de cada
+    protocol, com el que retorna protocol.codifica_tots()), de manera que
+    repetir-los no torna a codificar res. Cada missatge té un número de
+    seqüència dins de la sala, que comença per 1. Si el servidor guarda el
+    diari (diari.py), l'historial d'una sala nova es recupera del diari i els
+    números de seqüència continuen els que hi ha.
+"""
+
+import collections
+import itertools
+import threading
+
+
+class Historial:
+    """ Memòria circular amb els darrers missatges d'una sala """
+
+    __slots__ = ('missatges', 'seguent', 'bloqueig')
+
+    def __init__(self, capacitat):
+        self.missatges = collections.deque(maxlen=capacitat)
+        self.seguent = 1                # número de seqüència del proper missatge
+        self.bloqueig = threading.Lock()
+
+    def __len__(self):
+        return len(self.missatges)
+
+    def afegeix(self, trames):
+        """ guarda les trames d'un missatge. Retorna el seu número de seqüència """
+        with self.bloqueig:
+            self.missatges.append(trames)
+            self.seguent += 1
+            return self.seguent - 1
+
+    def recupera(self, primer, missatges):
+        """ torna a omplir l'historial buit amb missatges guardats en un altre
+            lloc (el diari), on el primer té el número de seqüència indicat """
+        with self.bloqueig:
+            self.missatges.extend(missatges)
+            self.seguent = primer + len(missatges)
+
+    def darrers(self, nombre):
+        """ retorna la tupla (primer, missatges) amb com a molt els darrers
+            nombre missatges i el número de seqüència del primer """
+        with self.bloqueig:
+            return self.extreu(nombre)
+
+    def des_de(self, sequencia):
+        """ retorna la tupla (primer, missatges) amb els missatges guardats
+            posteriors al de número de seqüència indicat """
+        with self.bloqueig:
+            return self.extreu(self.seguent - 1 - sequencia)
+
+    def extreu(self, nombre):
+        """ retorna els darrers nombre missatges. Cal cridar-la amb el bloqueig adquirit """
+        nombre = max(0, min(nombre, len(self.missatges)))
+        inici = len(self.missatges) - nombre
+        return self.seguent - nombre, list(itertools.islice(self.missatges, inici, None))
@@ -0,0 +1,199 @@
+"""
+    Mètriques del servidor de xat
+
+    El servidor compta el que passa mentre funciona (connexions acceptades,
+    bytes rebuts i enviats, temps de difusió...) i, amb l'opció
+    --metriques=port, les publica per HTTP a 127.0.0.1:port/metrics en el
+    format de text de Prometheus.
+
+    Les mètriques estan pensades per estar sempre actives:
+
+    - els comptadors i els histogrames només fan una suma (i una cerca binària
+      als histogrames), sense bloqueigs. Amb el GIL, una suma d'un atribut no
+      s'interromp a la pràctica; en el pitjor cas es perdria algun increment,
+      o una consulta veuria la suma i el recompte d'un histograma a mig
+      actualitzar, cosa acceptable per a unes mètriques
+    - els indicadors no fan res mentre el servidor funciona: el seu valor es
+      calcula amb una funció quan algú consulta les mètriques
+
+    test/banc03_metriques.py mesura el cost que afegeixen.
+"""
+
+import bisect
+import http.server
+import logging
+import threading
+
+# Prefix del nom de totes les mètriques
+PREFIX = "xat_"
+
+# Límits superiors dels intervals dels histogrames de temps (en segons)
+INTERVALS_TEMPS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+# Camí HTTP on es publiquen les mètriques
+CAMI = "/metrics"
+
+# Tipus de contingut del format de text de Prometheus
+TIPUS_CONTINGUT = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Comptador:
+    """ Valor que només creix """
+
+    __slots__ = ('nom', 'descripcio', 'valor')
+
+    tipus = "counter"
+
+    def __init__(self, nom, descripcio):
+        self.nom = PREFIX + nom
+        self.descripcio = descripcio
+        self.valor = 0
+
+    def incrementa(self, quantitat=1):
+        self.valor += quantitat
+
+    def mostres(self):
+        """ retorna la llista de (nom, valor) que es publiquen """
+        return [(self.nom, self.valor)]
+
+
+class Indicador:
+    """ Valor que puja i baixa, calculat per una funció en el moment de consultar-lo """
+
+    __slots__ = ('nom', 'descripcio', 'funcio')
+
+    tipus = "gauge"
+
+    def __init__(self, nom, descripcio, funcio):
+        self.nom = PREFIX + nom
+        self.descripcio = descripcio
+        self.funcio = funcio
+
+    def mostres(self):
+        return [(self.nom, self.funcio())]
+
+
+class Histograma:
+    """ Distribució de valors en intervals acumulats, amb la seva suma """
+
+    __slots__ = ('nom', 'descripcio', 'intervals', 'recomptes', 'suma')
+
+    tipus = "histogram"
+
+    def __init__(self, nom, descripcio, intervals=INTERVALS_TEMPS):
+        self.nom = PREFIX + nom
+        self.descripcio = descripcio
+        self.intervals = intervals
+        self.recomptes = [0] * (len(intervals) + 1)     # l'últim és pels valors més grans
+        self.suma = 0
+
+    def observa(self, valor):
+        self.recomptes[bisect.bisect_left(self.intervals, valor)] += 1
+        self.suma += valor
+
+    def mostres(self):
+        recomptes = list(self.recomptes)
+        suma = self.suma
+        resultat = []
+        acumulat = 0
+        for limit, recompte in zip(self.intervals + ("+Inf", ), recomptes):
+            acumulat += recompte
+            resultat.append(('%s_bucket{le="%s"}' % (self.nom, limit), acumulat))
+        resultat.append((self.nom + "_sum", suma))
+        resultat.append((self.nom + "_count", acumulat))
+        return resultat
+
+
+class Metriques:
+    """ Conjunt de les mètriques d'un procés del servidor """
+
+    def __init__(self):
+        self.metriques = dict()     # clau: nom. valor: mètrica
+
+    def afegeix(self, metrica):
+        """ afegeix la mètrica al conjunt (substitueix la que tingui el mateix nom) i la retorna """
+        self.metriques[metrica.nom] = metrica
+        return metrica
+
+    def comptador(self, nom, descripcio):
+        return self.afegeix(Comptador(nom, descripcio))
+
+    def histograma(self, nom, descripcio, intervals=INTERVALS_TEMPS):
+        return self.afegeix(Histograma(nom, descripcio, intervals))
+
+    def indicador(self, nom, descripcio, funcio):
+        return self.afegeix(Indicador(nom, descripcio, funcio))
+
+    def text(self):
+        """ retorna totes les mètriques en el format de text de Prometheus """
+        linies = []
+        for metrica in list(self.metriques.values()):
+            linies.append("# HELP %s %s" % (metrica.nom, metrica.descripcio))
+            linies.append("# TYPE %s %s" % (metrica.nom, metrica.tipus))
+            for nom, valor in metrica.mostres():
+                linies.append("%s %s" % (nom, valor))
+        return "\n".join(linies) + "\n"
+
+
+# Mètriques del procés
+METRIQUES = Metriques()
+
+ACCEPTADES = METRIQUES.comptador("connexions_acceptades_total", "Connexions acceptades")
+REBUTJADES = METRIQUES.comptador("connexions_rebutjades_total", "Connexions rebutjades per massa connexions")
+BYTES_REBUTS = METRIQUES.comptador("bytes_rebuts_total", "Bytes rebuts de les connexions")
+BYTES_ENVIATS = METRIQUES.comptador("bytes_enviats_total", "Bytes enviats per les connexions")
+MISSATGES_DIFOSOS = METRIQUES.comptador("missatges_difosos_total", "Missatges difosos a alguna sala")
+MISSATGES_PRIVATS = METRIQUES.comptador("missatges_privats_total", "Missatges privats enviats")
+TEMPS_EXHAURITS = METRIQUES.comptador("temps_exhaurits_enviament_total",
+                                      "Enviaments que han superat el temps màxim d'espera")
+SENSE_BATEC = METRIQUES.comptador("connexions_sense_batec_total",
+                                  "Connexions perdudes per no donar senyals de vida als batecs")
+INACTIUS = METRIQUES.comptador("participants_inactius_total", "Participants marcats com a inactius")
+EXCESSOS_CABAL = METRIQUES.comptador("excessos_cabal_total",
+                                     "Missatges endarrerits, descartats o desconnectats per excés de cabal")
+DIFUSIO = METRIQUES.histograma("difusio_segons",
+                               "Temps per repartir un missatge a les cues de tots els destinataris")
+
+
+def observa_participants(participants, nombre):
+    """ afegeix els indicadors que es calculen a partir del registre de
+        participants. nombre és la funció que retorna quants participants cal
+        publicar (els del procés o, al procés pare, els de tots els processos) """
+    METRIQUES.indicador("participants", "Participants connectats", nombre)
+    METRIQUES.indicador("cues_missatges", "Missatges pendents d'enviar a les cues de tots els participants",
+                        lambda: sum(len(participant.cua) for participant in participants.instantania()))
+    METRIQUES.indicador("cua_maxima_missatges", "Missatges pendents de la cua més plena",
+                        lambda: max((len(participant.cua) for participant in participants.instantania()),
+                                    default=0))
+
+
+class GestorPeticions(http.server.BaseHTTPRequestHandler):
+    """ Respon les consultes HTTP de les mètriques """
+
+    def do_GET(self):
+        if self.path != CAMI:
+            self.send_error(404)
+            return
+        contingut = bytes(METRIQUES.text(), "utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", TIPUS_CONTINGUT)
+        self.send_header("Content-Length", str(len(contingut)))
+        self.end_headers()
+        self.wfile.write(contingut)
+
+    def log_message(self, format, *args):
+        logging.debug("Mètriques: " + format, *args)
+
+
+def publica(port, host="127.0.0.1"):
+    """ publica les mètriques per HTTP des d'un fil d'execució propi.
+        Retorna el servidor HTTP, o None si no s'ha pogut arrencar """
+    try:
+        servidor = http.server.ThreadingHTTPServer((host, port), GestorPeticions)
+    except OSError as e:
+        logging.error("No s'han pogut publicar les mètriques a %s:%s: %s", host, port, e)
+        return None
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name="metriques", daemon=True).start()
+    logging.info("Mètriques publicades a http://%s:%s%s", host, port, CAMI)
+    return servidor
@@ -0,0 +1,393 @@
+"""
+    Protocol de comunicació entre els clients i el servidor de xat
+
+    TCP no respecta els límits dels missatges: diversos missatges poden arribar
+    en una sola lectura, i un missatge llarg pot arribar en diverses lectures.
+    Per això els missatges viatgen dins de trames: quatre bytes amb la mida del
+    missatge (enter sense signe, ordre de xarxa) seguits del missatge codificat
+    en UTF-8.
+
+    Un client que parla amb trames ho anuncia enviant SALUTACIO just en
+    connectar-se, abans del nom. El servidor li respon també amb SALUTACIO.
+    Els clients antics envien directament el nom en text i continuen
+    funcionant com sempre: cada lectura de la connexió és un missatge.
+
+    Un client que envia SALUTACIO_BINARI parla el protocol binari: cada trama
+    porta, després de la mida, un sobre (SOBRE) amb el tipus del missatge,
+    uns indicadors i els identificadors de l'emissor i de la sala.
+
+    - els missatges reenviats dels participants (Reenviament) no repeteixen
+      el text "[nom] ": porten l'identificador del nom de l'emissor i el de
+      la sala (0 a la sala principal). Cada procés del servidor assigna un
+      identificador a cada nom (NOMS), i el primer cop que una connexió en
+      necessita un li envia abans una trama TIPUS_NOM que el defineix
+    - el text dels missatges de com a mínim LLINDAR_COMPRESSIO bytes es
+      comprimeix amb zlib quan ocupa menys (indicador COMPRIMIT), en els dos
+      sentits
+    - la resta de missatges (els textos del servidor i tot el que envien els
+      clients) són de TIPUS_TEXT. El servidor tanca la connexió del client
+      que li envia un altre tipus de missatge
+
+    Les connexions inactives no es desperten periòdicament: esperen dades
+    indefinidament. Per trobar els extrems que han desaparegut sense tancar la
+    connexió hi ha dos mecanismes:
+
+    - batecs: qui rep MISSATGE_BATEC respon RESPOSTA_BATEC. El servidor pot
+      enviar-ne als participants que fa estona que no envien res
+    - TCP keepalive (activa_keepalive()): el sistema sondeja la connexió quan
+      fa estona que no hi passa res, sense que l'altre extrem ho vegi
+"""
+
+import codecs
+import socket
+import struct
+import threading
+import zlib
+
+# Protocols que pot fer servir una connexió
+PROTOCOL_TEXT = 0       # text pla: cada lectura és un missatge (clients antics)
+PROTOCOL_TRAMES = 1     # missatges dins de trames amb la mida al davant
+PROTOCOL_BINARI = 2     # trames amb un sobre binari, noms internats i compressió
+
+# Bytes amb què un client anuncia que parla amb trames.
+# Comença amb un byte nul, que mai no apareix al nom d'un client antic.
+SALUTACIO = b"\x00XFJ\x01"
+
+# Bytes amb què un client anuncia que parla el protocol binari
+SALUTACIO_BINARI = b"\x00XFJ\x02"
+
+# Capçalera de cada trama: mida del missatge
+CAPCALERA = struct.Struct("!I")
+
+# Sobre de les trames del protocol binari, després de la mida: tipus,
+# indicadors, identificador de l'emissor i identificador de la sala
+SOBRE = struct.Struct("!BBHH")
+CAPCALERA_BINARIA = struct.Struct("!IBBHH")
+
+# Tipus dels missatges del protocol binari
+TIPUS_TEXT = 0          # text del servidor o d'un client
+TIPUS_REENVIAMENT = 1   # missatge d'un participant: emissor i sala són identificadors de noms
+TIPUS_NOM = 2           # definició d'un nom: emissor és l'identificador i el text, el nom
+
+# Indicadors del sobre
+COMPRIMIT = 0x01        # el text està comprimit amb zlib
+
+# Mida mínima del text que es comprimeix (en bytes) i nivell de compressió
+LLINDAR_COMPRESSIO = 256
+NIVELL_COMPRESSIO = 1
+
+# Nombre màxim de noms internats per procés. Els missatges dels participants
+# amb noms que ja no hi caben viatgen com a text
+MAXIM_NOMS = 65535
+
+# Mida màxima del missatge d'una trama (en bytes)
+MIDA_MAXIMA_TRAMA = 64 * 1024
+
+# Mida de la memòria intermèdia de lectura (en bytes)
+MIDA_LECTURA = 16 * 1024
+
+# Missatge que comprova que l'altre extrem continua viu, i la seva resposta
+MISSATGE_BATEC = "{ping}"
+RESPOSTA_BATEC = "{pong}"
+
+# Batecs seguits sense que arribi res abans de donar la connexió per perduda
+BATECS_SENSE_RESPOSTA = 2
+
+# Sondejos de TCP keepalive sense resposta abans de donar la connexió per perduda
+SONDEJOS_KEEPALIVE = 3
+
+
+class ErrorProtocol(ValueError):
+    """ Les dades rebudes no segueixen el protocol """
+
+
+class Reenviament(str):
+    """ Missatge d'un participant tal i com el rep la resta: "[nom] missatge",
+        o "[nom@sala] missatge" fora de la sala principal (sala None).
+        Guarda per separat el nom, la sala i el missatge original, que el
+        protocol binari envia sense compondre """
+
+    def __new__(cls, nom, sala, missatge):
+        if sala is None:
+            text = "[%s] %s" % (nom, missatge)
+        else:
+            text = "[%s@%s] %s" % (nom, sala, missatge)
+        reenviament = super().__new__(cls, text)
+        reenviament.nom = nom
+        reenviament.sala = sala
+        reenviament.missatge = missatge
+        return reenviament
+
+
+class Internador:
+    """ Identificadors numèrics dels noms de participants i de sales d'un
+        procés. Un nom conserva sempre el mateix identificador """
+
+    __slots__ = ('ids', 'bloqueig')
+
+    def __init__(self):
+        self.ids = dict()               # clau: nom. valor: identificador, a partir de 1
+        self.bloqueig = threading.Lock()
+
+    def id(self, nom):
+        """ retorna l'identificador del nom, o None si ja no hi caben més noms """
+        ident = self.ids.get(nom)
+        if ident is None:
+            with self.bloqueig:
+                ident = self.ids.get(nom)
+                if ident is None:
+                    if len(self.ids) >= MAXIM_NOMS:
+                        return None
+                    ident = self.ids[nom] = len(self.ids) + 1
+        return ident
+
+
+# Noms internats del procés
+NOMS = Internador()
+
+
+class Trames(dict):
+    """ Bytes a enviar d'un missatge per cada protocol (clau). La trama del
+        protocol binari només es codifica el primer cop que algú la demana.
+
+        noms són els parells (identificador, nom) als quals fa referència la
+        trama binària, que cal haver definit a la connexió abans d'enviar-la """
+
+    __slots__ = ('missatge', 'noms')
+
+    def __missing__(self, protocol):
+        if protocol != PROTOCOL_BINARI:
+            raise KeyError(protocol)
+        trama = self[protocol] = codifica_binari(self.missatge, self.noms)
+        return trama
+
+
+def codifica(missatge, protocol):
+    """ retorna els bytes a enviar per fer arribar el missatge amb el protocol """
+    if protocol == PROTOCOL_BINARI:
+        return sobre(TIPUS_TEXT, missatge)
+    dades = bytes(missatge, "utf8")
+    if protocol == PROTOCOL_TRAMES:
+        return CAPCALERA.pack(len(dades)) + dades
+    return dades
+
+
+def codifica_tots(missatge):
+    """ retorna les Trames amb els bytes a enviar per cada protocol.
+        Permet codificar un sol cop un missatge per a molts destinataris """
+    dades = bytes(missatge, "utf8")
+    trames = Trames({
+        PROTOCOL_TEXT: dades,
+        PROTOCOL_TRAMES: CAPCALERA.pack(len(dades)) + dades,
+    })
+    trames.missatge = missatge
+    trames.noms = interna(missatge)
+    return trames
+
+
+def interna(missatge):
+    """ retorna els parells (identificador, nom) de l'emissor i de la sala
+        d'un Reenviament. Si no és un Reenviament, o els noms ja no caben a
+        NOMS, retorna una tupla buida i el missatge s'enviarà com a text """
+    if not isinstance(missatge, Reenviament):
+        return ()
+    emissor = NOMS.id(missatge.nom)
+    if emissor is None:
+        return ()
+    if missatge.sala is None:
+        return ((emissor, missatge.nom), )
+    sala = NOMS.id(missatge.sala)
+    if sala is None:
+        return ()
+    return ((emissor, missatge.nom), (sala, missatge.sala))
+
+
+def sobre(tipus, text, emissor=0, sala=0):
+    """ retorna la trama binària amb el text dins d'un sobre. Comprimeix el
+        text si és prou llarg i ocupa menys comprimit """
+    dades = bytes(text, "utf8")
+    indicadors = 0
+    if len(dades) >= LLINDAR_COMPRESSIO:
+        comprimides = zlib.compress(dades, NIVELL_COMPRESSIO)
+        if len(comprimides) < len(dades):
+            dades = comprimides
+            indicadors = COMPRIMIT
+    return CAPCALERA_BINARIA.pack(SOBRE.size + len(dades), tipus, indicadors, emissor, sala) + dades
+
+
+def codifica_binari(missatge, noms):
+    """ retorna la trama binària d'un missatge amb els noms internats """
+    if not noms:
+        return sobre(TIPUS_TEXT, missatge)
+    sala = noms[1][0] if len(noms) > 1 else 0
+    return sobre(TIPUS_REENVIAMENT, missatge.missatge, noms[0][0], sala)
+
+
+def defineix(coneguts, noms):
+    """ retorna les trames que defineixen els noms (parells (identificador,
+        nom)) que no són al conjunt coneguts, i els hi afegeix """
+    definicions = b''
+    for ident, nom in noms:
+        if ident not in coneguts:
+            coneguts.add(ident)
+            definicions += sobre(TIPUS_NOM, nom, ident)
+    return definicions
+
+
+def definicions(trama):
+    """ retorna les definicions de noms (TIPUS_NOM) que hi ha al principi de
+        la trama binària, les que hi ha afegit defineix() """
+    final = 0
+    while len(trama) - final >= CAPCALERA_BINARIA.size:
+        mida, tipus = CAPCALERA_BINARIA.unpack_from(trama, final)[:2]
+        if tipus != TIPUS_NOM or final + CAPCALERA.size + mida > len(trama):
+            break
+        final += CAPCALERA.size + mida
+    return trama[:final]
+
+
+def activa_keepalive(connexio, inactivitat):
+    """ activa TCP keepalive a la connexió: després de inactivitat segons
+        sense dades, el sistema la sondeja i la dona per perduda si l'altre
+        extrem no respon a SONDEJOS_KEEPALIVE sondejos seguits """
+    try:
+        connexio.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            interval = max(1, int(inactivitat) // SONDEJOS_KEEPALIVE)
+            connexio.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(inactivitat)))
+            connexio.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+            connexio.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, SONDEJOS_KEEPALIVE)
+    except OSError:
+        pass    # la connexió ja està tancada o el sistema no ho permet
+
+
+def salutacio(protocol):
+    """ bytes amb què el servidor confirma el protocol d'un client nou """
+    if protocol == PROTOCOL_BINARI:
+        return SALUTACIO_BINARI
+    return SALUTACIO if protocol == PROTOCOL_TRAMES else b""
+
+
+def descomprimeix(dades, mida_maxima):
+    """ descomprimeix el text d'un sobre, que no pot superar mida_maxima bytes """
+    descompressor = zlib.decompressobj()
+    try:
+        text = descompressor.decompress(dades, mida_maxima + 1)
+    except zlib.error as e:
+        raise ErrorProtocol("text comprimit incorrecte: %s" % e)
+    if len(text) > mida_maxima or not descompressor.eof:
+        raise ErrorProtocol("text comprimit massa gran o incomplet")
+    return text
+
+
+class Descodificador:
+    """ Descodificador incremental dels missatges que arriben per una connexió
+
+        Reaprofita sempre la mateixa memòria intermèdia per llegir de la
+        connexió i acumula les dades fins que formen missatges complets.
+        El protocol es detecta amb les primeres dades que arriben.
+
+        Quan totes les connexions es llegeixen des d'un mateix fil, poden
+        compartir la memòria intermèdia de lectura (entrada).
+
+        Amb el protocol binari, el descodificador dels clients (reenviaments)
+        guarda els noms que defineix el servidor i retorna els missatges
+        reenviats com a Reenviament. El del servidor només accepta missatges
+        de TIPUS_TEXT: un client no pot fer-li guardar noms ni fer-se passar
+        per un altre participant.
+    """
+
+    __slots__ = ('protocol', 'dades', 'entrada', 'vista', 'text', 'mida_maxima', 'noms', 'reenviaments')
+
+    def __init__(self, protocol=None, entrada=None, mida_maxima=MIDA_MAXIMA_TRAMA, reenviaments=False):
+        self.protocol = protocol            # None fins que es detecta
+        self.dades = bytearray()            # dades rebudes pendents de descodificar
+        self.entrada = entrada if entrada is not None else bytearray(MIDA_LECTURA)
+        self.vista = memoryview(self.entrada)
+        self.text = codecs.getincrementaldecoder("utf8")("replace")
+        self.mida_maxima = mida_maxima      # mida màxima del missatge d'una trama
+        self.noms = None                    # protocol binari. clau: identificador. valor: nom
+        self.reenviaments = reenviaments    # si s'accepten definicions de noms i reenviaments
+
+    def llegeix(self, connexio):
+        """ llegeix de la connexió les dades disponibles.
+            Retorna quants bytes s'han llegit: 0 vol dir que la connexió s'ha tancat.
+            Les excepcions de la connexió es propaguen. """
+        llegits = connexio.recv_into(self.entrada)
+        self.dades += self.vista[:llegits]
+        return llegits
+
+    def alimenta(self, dades):
+        """ afegeix dades rebudes per altres mitjans """
+        self.dades += dades
+
+    def missatges(self):
+        """ retorna la llista de missatges complets rebuts fins ara.
+            Llença ErrorProtocol si les dades no són vàlides """
+        if self.protocol is None and not self.detecta():
+            return []
+        if self.protocol == PROTOCOL_TEXT:
+            missatge = self.text.decode(bytes(self.dades))
+            self.dades.clear()
+            return [missatge.strip()] if missatge else []
+        binari = self.protocol == PROTOCOL_BINARI
+        maxim = self.mida_maxima + SOBRE.size if binari else self.mida_maxima
+        missatges = []
+        inici = 0
+        while len(self.dades) - inici >= CAPCALERA.size:
+            mida, = CAPCALERA.unpack_from(self.dades, inici)
+            if mida > maxim:
+                raise ErrorProtocol("trama massa gran: %s bytes" % mida)
+            final = inici + CAPCALERA.size + mida
+            if final > len(self.dades):
+                break   # la trama encara no ha arribat sencera
+            if binari:
+                missatge = self.obre(inici + CAPCALERA.size, final)
+                if missatge is not None:
+                    missatges.append(missatge)
+            else:
+                missatge = self.dades[inici + CAPCALERA.size:final].decode("utf8", "replace")
+                missatges.append(missatge.strip())
+            inici = final
+        del self.dades[:inici]
+        return missatges
+
+    def obre(self, inici, final):
+        """ descodifica el sobre binari que ocupa les dades de inici a final.
+            Retorna el missatge, o None si era la definició d'un nom """
+        if final - inici < SOBRE.size:
+            raise ErrorProtocol("sobre incomplet")
+        tipus, indicadors, emissor, sala = SOBRE.unpack_from(self.dades, inici)
+        if tipus != TIPUS_TEXT and not self.reenviaments:
+            raise ErrorProtocol("tipus de missatge no permès: %s" % tipus)
+        dades = self.dades[inici + SOBRE.size:final]
+        if indicadors & COMPRIMIT:
+            dades = descomprimeix(dades, self.mida_maxima)
+        text = dades.decode("utf8", "replace")
+        if tipus == TIPUS_TEXT:
+            return text.strip()
+        if self.noms is None:
+            self.noms = dict()
+        if tipus == TIPUS_NOM:
+            self.noms[emissor] = text
+            return None
+        if tipus == TIPUS_REENVIAMENT:
+            if emissor not in self.noms or (sala and sala not in self.noms):
+                raise ErrorProtocol("nom no definit: %s" % (emissor if emissor not in self.noms else sala))
+            return Reenviament(self.noms[emissor], self.noms[sala] if sala else None, text)
+        raise ErrorProtocol("tipus de missatge desconegut: %s" % tipus)
+
+    def detecta(self):
+        """ detecta el protocol a partir de les primeres dades rebudes.
+            Retorna si ja se sap quin protocol fa servir la connexió """
+        if len(self.dades) < len(SALUTACIO) and SALUTACIO.startswith(self.dades):
+            return False    # encara no es pot saber
+        if self.dades.startswith(SALUTACIO):
+            self.protocol = PROTOCOL_TRAMES
+            del self.dades[:len(SALUTACIO)]
+        elif self.dades.startswith(SALUTACIO_BINARI):
+            self.protocol = PROTOCOL_BINARI
+            del self.dades[:len(SALUTACIO_BINARI)]
+        else:
+            self.protocol = PROTOCOL_TEXT
+        return True
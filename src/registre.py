@@ -0,0 +1,414 @@
+"""
+    Registre dels participants de la sala de xat
+
+    Diversos fils d'execució afegeixen, treuen i recorren els participants
+    alhora. El registre ho fa segur i ràpid:
+
+    - afegir i treure un participant costa el mateix tant si n'hi ha deu com
+      deu mil, i es fa amb el registre bloquejat
+    - es pot trobar un participant pel seu socket o pel seu nom sense haver de
+      recórrer tota la sala. Els missatges privats es reparteixen a partir
+      de l'índex de noms
+    - cada participant té un nom diferent: si el nom que demana ja el té algú,
+      se li assigna seguit del primer sufix numèric lliure ("pep", "pep1",
+      "pep2"...). L'índex de sufixos recorda, per cada nom base, per quin
+      sufix cal continuar i quins sufixos han quedat lliures (en un munt,
+      que dona primer el més petit), de manera que assignar un nom no depèn
+      de quants participants s'hi han volgut dir
+    - per enviar un missatge a tothom es recorre una instantània (una tupla
+      que no canvia mai) dels participants, sense bloquejar el registre i sense
+      que els canvis d'altres fils la puguin desbaratar
+
+    El registre també sap a quines sales és cada participant. Cada sala té el
+    seu propi conjunt de membres i la seva instantània, de manera que enviar un
+    missatge a una sala costa el que fa la sala i no el que fa tot el servidor.
+
+    Cada sala guarda també l'historial dels seus darrers missatges
+    (historial.py), que desapareix amb la sala quan aquesta queda buida. Si
+    el servidor guarda el diari (diari.py), l'historial se'n recupera cada
+    cop que es crea la sala. Es llegeix del diari abans de bloquejar el
+    registre, i només si mentrestant hi ha arribat algun missatge de la sala
+    es torna a llegir amb el registre bloquejat. La sala principal es crea
+    amb el registre i no desapareix mai, de manera que qui hi entra en
+    arrencar el servidor ja en rep la repetició de l'historial.
+
+    Quan el servidor funciona amb diversos processos, cada procés té el seu
+    registre amb els seus participants, i hi apunta quants membres té cada
+    sala als altres processos (remots) i quants participants hi tenen cada
+    nom.
+"""
+
+import heapq
+import threading
+
+import historial
+import protocol
+
+# Sala on entren tots els participants en connectar-se
+SALA_PRINCIPAL = "principal"
+
+
+class Participant:
+    """ Dades d'un participant de la sala de xat """
+
+    __slots__ = ('connexio', 'adressa', 'nom', 'es_actiu', 'cua', 'sales', 'sala')
+
+    def __init__(self, connexio, adressa, cua=None):
+        self.connexio = connexio        # socket del participant
+        self.adressa = adressa          # (host, port) del participant
+        self.nom = None                 # None fins que es rep el nom
+        self.es_actiu = True
+        self.cua = cua                  # cua de sortida dels missatges pendents
+        self.sales = dict()             # sales on és el participant, per ordre d'entrada (valor: None)
+        self.sala = None                # sala on van a parar els missatges del participant
+
+
+class Sala:
+    """ Membres d'una sala de xat """
+
+    __slots__ = ('nom', 'membres', 'fotografia', 'historial')
+
+    def __init__(self, nom, capacitat_historial=0):
+        self.nom = nom
+        self.membres = dict()           # clau: participant. valor: None
+        self.fotografia = ()            # instantània dels membres, o None si cal refer-la
+        self.historial = historial.Historial(capacitat_historial) if capacitat_historial else None
+
+
+class Registre:
+    """ Conjunt dels participants de la sala indexat per socket i per nom """
+
+    def __init__(self, capacitat_historial=0, repeticio=0, diari=None):
+        self.bloqueig = threading.Lock()
+        self.diari = diari              # diari persistent dels missatges, o None
+        self.capacitat_historial = capacitat_historial  # missatges que es guarden de cada sala
+        self.repeticio = repeticio      # missatges de l'historial que es repeteixen en entrar a una sala
+        self.per_connexio = dict()      # clau: socket. valor: participant
+        self.per_nom = dict()           # clau: nom. valor: diccionari amb els participants amb aquest nom
+        self.reservats = set()          # noms assignats a participants que encara no s'han afegit
+        self.bases = dict()             # clau: nom assignat. valor: nom base que havia demanat
+        self.sufixos = dict()           # clau: nom base. valor: [proper sufix, noms assignats vigents,
+                                        # munt dels sufixos alliberats]
+        self.fotografia = ()            # instantània dels participants, o None si cal refer-la
+        self.sales = dict()             # clau: nom de la sala. valor: Sala
+        self.remots = dict()            # clau: nom de la sala (None pel total). valor: {procés: nombre}
+        self.noms_remots = dict()       # clau: nom de participant. valor: {procés: nombre}
+        self.observador = None          # funció que rep (sala, nombre) quan canvia el nombre de
+                                        # participants d'una sala (None pel total). Es crida amb
+                                        # el registre bloquejat
+        self.observador_noms = None     # funció que rep (nom, nombre) quan canvia quants participants
+                                        # tenen un nom. Es crida amb el registre bloquejat
+        # la sala principal existeix des del principi amb l'historial del
+        # diari, perquè el primer participant que hi entra ja el pugui repetir
+        self.crea_sala(SALA_PRINCIPAL)
+
+    def __len__(self):
+        return len(self.per_connexio)
+
+    def __contains__(self, participant):
+        return self.per_connexio.get(participant.connexio) is participant
+
+    def reserva_nom(self, nom):
+        """ retorna el nom que tindrà un participant nou que demana el nom:
+            el mateix si està lliure, o seguit del primer sufix numèric lliure.
+            El nom queda reservat fins que s'afegeix el participant.
+
+            Amb diversos processos es tenen en compte els noms dels altres
+            processos, però dos processos que assignen alhora el mateix nom no
+            se n'adonen """
+        with self.bloqueig:
+            base = nom
+            sufix = self.sufixos.setdefault(base, [1, 0, []])
+            if self.ocupat(nom):
+                nom = self.sufix_lliure(base, sufix)
+            sufix[1] += 1
+            self.bases[nom] = base
+            self.reservats.add(nom)
+            return nom
+
+    def sufix_lliure(self, base, sufix):
+        """ retorna el nom base seguit del primer sufix lliure: el més petit
+            dels alliberats o, si no n'hi ha cap, el proper sufix.
+            Cal cridar-la amb el registre bloquejat """
+        ocupats = []        # alliberats que després ha pres algú altre
+        nom = None
+        while sufix[2] and nom is None:
+            numero = heapq.heappop(sufix[2])
+            if self.ocupat("%s%s" % (base, numero)):
+                ocupats.append(numero)
+            else:
+                nom = "%s%s" % (base, numero)
+        for numero in ocupats:
+            heapq.heappush(sufix[2], numero)
+        while nom is None or self.ocupat(nom):
+            nom = "%s%s" % (base, sufix[0])
+            sufix[0] += 1
+        return nom
+
+    def ocupat(self, nom):
+        """ indica si algú té o ha reservat el nom. Cal cridar-la amb el registre bloquejat """
+        return nom in self.per_nom or nom in self.reservats or nom in self.noms_remots
+
+    def allibera_nom(self, nom):
+        """ allibera un nom reservat o assignat. Cal cridar-la amb el registre bloquejat """
+        self.reservats.discard(nom)
+        base = self.bases.pop(nom, None)
+        if base is None:
+            return
+        sufix = self.sufixos[base]
+        sufix[1] -= 1
+        if not sufix[1]:
+            del self.sufixos[base]
+        elif nom != base:
+            heapq.heappush(sufix[2], int(nom[len(base):]))
+
+    def afegeix(self, participant):
+        """ afegeix un participant que ja té nom (reservat amb reserva_nom()) i
+            el fa entrar a la sala principal """
+        with self.bloqueig:
+            self.reservats.discard(participant.nom)
+            self.per_connexio[participant.connexio] = participant
+            homonims = self.per_nom.setdefault(participant.nom, dict())
+            homonims[participant] = None
+            self.avisa_nom(participant.nom, len(homonims))
+            self.fotografia = None
+            self.avisa(None, len(self.per_connexio))
+            self.entra(participant, SALA_PRINCIPAL)
+
+    def treu(self, participant):
+        """ treu el participant de la sala, si hi és """
+        with self.bloqueig:
+            if self.per_connexio.get(participant.connexio) is not participant:
+                return
+            del self.per_connexio[participant.connexio]
+            homonims = self.per_nom[participant.nom]
+            del homonims[participant]
+            self.avisa_nom(participant.nom, len(homonims))
+            if not homonims:
+                del self.per_nom[participant.nom]
+                self.allibera_nom(participant.nom)
+            self.fotografia = None
+            self.avisa(None, len(self.per_connexio))
+            for nom in list(participant.sales):
+                self.surt(participant, nom)
+            participant.sala = None
+
+    def busca_connexio(self, connexio):
+        """ retorna el participant del socket, o None si no és a la sala """
+        return self.per_connexio.get(connexio)
+
+    def busca_nom(self, nom):
+        """ retorna el primer participant que va entrar amb aquest nom, o None """
+        with self.bloqueig:
+            homonims = self.per_nom.get(nom)
+            if not homonims:
+                return None
+            return next(iter(homonims))
+
+    def destinataris(self, noms):
+        """ retorna una tupla amb els participants d'aquest procés que tenen
+            algun dels noms """
+        with self.bloqueig:
+            if len(noms) == 1:
+                return tuple(self.per_nom.get(noms[0], ()))
+            destinataris = dict()
+            for nom in noms:
+                destinataris.update(self.per_nom.get(nom, {}))
+            return tuple(destinataris)
+
+    def hi_es(self, nom):
+        """ indica si algun participant, d'aquest procés o d'un altre, té el nom """
+        with self.bloqueig:
+            return nom in self.per_nom or nom in self.noms_remots
+
+    def instantania(self):
+        """ retorna una tupla amb els participants actuals
+
+            La tupla es refà només quan hi ha hagut canvis des de l'última
+            vegada; mentrestant tothom comparteix la mateixa.
+        """
+        fotografia = self.fotografia
+        if fotografia is None:
+            with self.bloqueig:
+                if self.fotografia is None:
+                    self.fotografia = tuple(self.per_connexio.values())
+                fotografia = self.fotografia
+        return fotografia
+
+    def entra_sala(self, participant, nom):
+        """ fa entrar el participant a la sala (la crea si no existia) i hi
+            adreça els seus missatges. Retorna la instantània dels membres """
+        carregat = self.carrega_historial(nom)
+        with self.bloqueig:
+            if self.per_connexio.get(participant.connexio) is not participant:
+                return ()
+            self.entra(participant, nom, carregat)
+        return self.membres(nom)
+
+    def surt_sala(self, participant, nom):
+        """ treu el participant de la sala. Si era la sala on parlava, passa a
+            parlar a la primera de les sales on encara és.
+            Retorna si el participant era a la sala """
+        with self.bloqueig:
+            if nom not in participant.sales:
+                return False
+            self.surt(participant, nom)
+            if participant.sala == nom:
+                participant.sala = next(iter(participant.sales), None)
+            return True
+
+    def carrega_historial(self, nom):
+        """ si la sala no existeix i s'ha de recuperar del diari, en llegeix
+            l'historial. Retorna la tupla (primer, trames) o None.
+            Cal cridar-la sense bloquejar el registre """
+        if self.diari is None or not self.capacitat_historial or nom in self.sales:
+            return None
+        primer, missatges = self.diari.darrers(nom, self.capacitat_historial)
+        return primer, [protocol.codifica_tots(missatge) for missatge in missatges]
+
+    def crea_sala(self, nom, carregat=None):
+        """ crea la sala i li recupera l'historial del diari: el carregat amb
+            carrega_historial() si encara és al dia. Retorna la sala.
+            Cal cridar-la amb el registre bloquejat """
+        sala = self.sales[nom] = Sala(nom, self.capacitat_historial)
+        if sala.historial is not None and self.diari is not None:
+            if carregat is None or carregat[0] + len(carregat[1]) - 1 != self.diari.nombre(nom):
+                primer, missatges = self.diari.darrers(nom, self.capacitat_historial)
+                carregat = primer, [protocol.codifica_tots(missatge) for missatge in missatges]
+            sala.historial.recupera(*carregat)
+        return sala
+
+    def entra(self, participant, nom, carregat=None):
+        """ fa entrar el participant a la sala, i la crea si no existia (veure
+            crea_sala()). Cal cridar-la amb el registre bloquejat """
+        sala = self.sales.get(nom)
+        if sala is None:
+            sala = self.crea_sala(nom, carregat)
+        sala.membres[participant] = None
+        sala.fotografia = None
+        participant.sales[nom] = None
+        participant.sala = nom
+        self.avisa(nom, len(sala.membres))
+
+    def surt(self, participant, nom):
+        """ treu el participant de la sala. Cal cridar-la amb el registre bloquejat.
+            Les sales que queden buides desapareixen, excepte la principal """
+        sala = self.sales[nom]
+        del sala.membres[participant]
+        sala.fotografia = None
+        del participant.sales[nom]
+        self.avisa(nom, len(sala.membres))
+        if not sala.membres and nom != SALA_PRINCIPAL:
+            del self.sales[nom]
+
+    def avisa(self, nom, nombre):
+        """ avisa l'observador que ha canviat el nombre de participants d'una sala """
+        if self.observador is not None:
+            self.observador(nom, nombre)
+
+    def avisa_nom(self, nom, nombre):
+        """ avisa l'observador de noms que ha canviat quants participants tenen el nom """
+        if self.observador_noms is not None:
+            self.observador_noms(nom, nombre)
+
+    def membres(self, nom):
+        """ retorna una tupla amb els membres actuals de la sala """
+        sala = self.sales.get(nom)
+        if sala is None:
+            return ()
+        fotografia = sala.fotografia
+        if fotografia is None:
+            with self.bloqueig:
+                if sala.fotografia is None:
+                    sala.fotografia = tuple(sala.membres)
+                fotografia = sala.fotografia
+        return fotografia
+
+    def historial(self, nom):
+        """ retorna l'historial de la sala, o None si la sala no en guarda """
+        sala = self.sales.get(nom)
+        return sala.historial if sala is not None else None
+
+    def desa(self, nom, missatge, trames):
+        """ guarda a l'historial de la sala les trames d'un missatge, i el
+            missatge al diari. Amb diari, es fa amb el registre bloquejat perquè
+            els números de seqüència de l'historial i del diari coincideixin """
+        if self.diari is None:
+            historial = self.historial(nom)
+            if historial is not None:
+                historial.afegeix(trames)
+            return
+        with self.bloqueig:
+            self.diari.afegeix(nom, missatge)
+            historial = self.historial(nom)
+            if historial is not None:
+                historial.afegeix(trames)
+
+    def membres_sales(self, noms):
+        """ retorna una tupla amb els membres de qualsevol de les sales, sense
+            repeticions """
+        if len(noms) == 1:
+            return self.membres(noms[0])
+        membres = dict()
+        for nom in noms:
+            membres.update(dict.fromkeys(self.membres(nom)))
+        return tuple(membres)
+
+    def compta_remot(self, proces, nom, nombre):
+        """ apunta quants participants té la sala (None pel total) a un altre procés """
+        with self.bloqueig:
+            compta(self.remots, proces, nom, nombre)
+
+    def compta_nom_remot(self, proces, nom, nombre):
+        """ apunta quants participants tenen el nom a un altre procés """
+        with self.bloqueig:
+            compta(self.noms_remots, proces, nom, nombre)
+
+    def oblida_proces(self, proces):
+        """ oblida els participants d'un procés que ha finalitzat """
+        with self.bloqueig:
+            for index in (self.remots, self.noms_remots):
+                for nom in list(index):
+                    compta(index, proces, nom, 0)
+
+    def nombre(self, nom=None):
+        """ retorna quants participants hi ha a la sala (None: al servidor),
+            comptant els dels altres processos """
+        nombre = len(self.per_connexio) if nom is None else len(self.membres(nom))
+        with self.bloqueig:
+            return nombre + sum(self.remots.get(nom, {}).values())
+
+    def processos_amb(self, noms):
+        """ retorna el conjunt dels altres processos amb participants a alguna de les sales """
+        processos = set()
+        with self.bloqueig:
+            for nom in noms:
+                processos.update(self.remots.get(nom, ()))
+        return processos
+
+    def processos_amb_noms(self, noms):
+        """ retorna el conjunt dels altres processos amb participants que tenen algun dels noms """
+        processos = set()
+        with self.bloqueig:
+            for nom in noms:
+                processos.update(self.noms_remots.get(nom, ()))
+        return processos
+
+    def ocupacio(self):
+        """ retorna una llista amb el nom, els membres d'aquest procés i el
+            nombre total de participants de cada sala """
+        with self.bloqueig:
+            noms = list(self.sales) + [nom for nom in self.remots if nom is not None and nom not in self.sales]
+        return [(nom, self.membres(nom), self.nombre(nom)) for nom in noms]
+
+
+def compta(index, proces, nom, nombre):
+    """ apunta a l'índex {nom: {procés: nombre}} el nombre d'un altre procés.
+        Cal cridar-la amb el registre bloquejat """
+    remots = index.setdefault(nom, dict())
+    if nombre:
+        remots[proces] = nombre
+    else:
+        remots.pop(proces, None)
+        if not remots:
+            del index[nom]
@@ -0,0 +1,303 @@
+"""
+    Missatges de la sala de xat
+
+    Aquest mòdul recull els textos que el servidor envia als participants, i
+    les comandes per moure's entre sales, de manera que els diferents motors
+    del servidor (fils i esdeveniments) diguin i facin exactament el mateix.
+
+    Els participants poden ser a diverses sales alhora. Els seus missatges van
+    a parar a la sala on parlen, que és la darrera on han entrat o la que han
+    triat amb {canvia}. Comandes:
+
+    - {entra sala}: entra a la sala (la crea si no existeix) i hi parla
+    - {canvia sala}: passa a parlar a una sala on ja és
+    - {surt sala}: surt de la sala. Sense sala, surt de la sala on parla
+    - {sales}: mostra les sales on és i quants membres tenen
+    - {historial}: repeteix els missatges guardats de la sala on parla.
+      {historial N} repeteix només els N darrers, i {historial #N} els
+      posteriors al missatge amb número de seqüència N. Amb el diari, els
+      missatges que ja no són a l'historial es llegeixen del diari, per
+      pàgines de com a molt diari.MIDA_PAGINA missatges
+    - {privat nom missatge}: envia el missatge només al participant nom, sigui
+      a la sala que sigui. {privat nom1,nom2 missatge} l'envia a cadascun dels
+      noms de la llista (com a molt MAXIM_DESTINATARIS). Els destinataris es
+      troben a l'índex de noms del registre, de manera que un missatge privat
+      costa el mateix tant si hi ha deu participants com deu mil. El nom de
+      qui l'envia no compta com a destinatari
+
+    Els batecs ({ping}) es responen amb {pong}, i els {pong} que responen
+    els participants no es difonen.
+
+    Les respostes a les comandes són textos o bé missatges de l'historial ja
+    codificats. codifica_respostes() les ajunta en un sol bloc de dades, de
+    manera que el participant les rep totes amb una sola escriptura.
+
+    Els missatges dels participants que es reenvien a la resta són
+    protocol.Reenviament, que el protocol binari envia amb els noms internats.
+"""
+
+import diari
+import protocol
+import registre
+
+# Missatge que indica la finalització de la sessió
+MISSATGE_FINALITZACIO = "{quit}"
+
+# Comandes per moure's entre sales
+COMANDA_ENTRA = "entra"
+COMANDA_CANVIA = "canvia"
+COMANDA_SURT = "surt"
+COMANDA_SALES = "sales"
+COMANDA_HISTORIAL = "historial"
+COMANDA_PRIVAT = "privat"
+COMANDES = (COMANDA_ENTRA, COMANDA_CANVIA, COMANDA_SURT, COMANDA_SALES, COMANDA_HISTORIAL, COMANDA_PRIVAT)
+
+# Prefix de l'argument de {historial} que indica un número de seqüència
+PREFIX_SEQUENCIA = "#"
+
+# Separador dels noms dels destinataris d'un missatge privat
+SEPARADOR_DESTINATARIS = ","
+
+# Nombre màxim de destinataris d'un missatge privat
+MAXIM_DESTINATARIS = 50
+
+
+def missatge_benvinguda(nom, nombre):
+    """ missatge que rep el participant quan entra a la sala.
+        nombre és la quantitat de participants comptant el nou """
+    return "Hola %s. Acabes d'entrar a la sala de xat de Fanjac. " \
+           "De moment hi ha %s participants" % (nom, nombre)
+
+
+def missatge_rebateig(demanat, nom):
+    """ avís al participant nou que el nom que demanava ja el tenia algú """
+    return "El nom %s ja el fa servir algú altre. Et diràs %s" % (demanat, nom)
+
+
+def missatge_nou_participant(nom, nombre):
+    """ notificació a la resta de participants de l'arribada d'un de nou """
+    return "S'ha afegit %s. Ara ja sou %s participants" % (nom, nombre)
+
+
+def missatge_abandonament(nom):
+    """ notificació a la resta de participants que un participant marxa """
+    return "%s abandona la sala de xat" % nom
+
+
+def missatge_connexio_perduda(nom):
+    """ notificació a la resta de participants que s'ha perdut un participant """
+    return "S'ha perdut la connexió amb %s" % nom
+
+
+def missatge_cabal_descartat():
+    """ avís al participant que se li descarten missatges per excés de cabal """
+    return "Envies massa missatges: es descarten fins que baixis el ritme"
+
+
+def missatge_cabal_desconnectat():
+    """ avís al participant que se'l desconnecta per excés de cabal """
+    return "Envies massa missatges: se't desconnecta de la sala de xat"
+
+
+def missatge_reenviament(nom, missatge, sala=registre.SALA_PRINCIPAL):
+    """ missatge d'un participant tal i com el rep la resta.
+        Fora de la sala principal s'hi afegeix el nom de la sala """
+    return protocol.Reenviament(nom, None if sala == registre.SALA_PRINCIPAL else sala, missatge)
+
+
+def missatge_privat(nom, missatge):
+    """ missatge privat d'un participant tal i com el reben els destinataris """
+    return "[%s, en privat] %s" % (nom, missatge)
+
+
+def missatge_absents(noms):
+    """ avís a qui envia un missatge privat que alguns destinataris no hi són """
+    return "No hi ha cap participant anomenat %s" % ", ".join(noms)
+
+
+def missatge_privat_propi():
+    """ avís a qui envia un missatge privat només a si mateix """
+    return "No et pots enviar un missatge privat a tu mateix"
+
+
+def missatge_entrada_sala(nom, sala, nombre):
+    """ notificació als membres d'una sala que hi ha entrat un participant """
+    return "%s entra a la sala %s. Ara hi sou %s participants" % (nom, sala, nombre)
+
+
+def missatge_sortida_sala(nom, sala):
+    """ notificació als membres d'una sala que un participant n'ha sortit """
+    return "%s surt de la sala %s" % (nom, sala)
+
+
+def missatge_sala_actual(sala, nombre):
+    """ confirmació al participant de la sala on parla ara """
+    return "Ara parles a la sala %s. Hi ha %s participants" % (sala, nombre)
+
+
+def missatge_historial(sala, primer, darrer):
+    """ capçalera dels missatges de l'historial d'una sala """
+    return "Historial de la sala %s (#%s a #%s):" % (sala, primer, darrer)
+
+
+def missatges_historial(participants, nom, nombre=None, sequencia=None):
+    """ retorna les respostes amb els missatges guardats de la sala: els
+        darrers nombre (per defecte tots els de l'historial) o els posteriors a
+        la seqüència. Els que no són a l'historial es llegeixen del diari """
+    historial = participants.historial(nom)
+    if historial is None and participants.diari is None:
+        return ["La sala %s no guarda historial" % nom]
+    primer, missatges = 1, []
+    if historial is not None:
+        if sequencia is not None:
+            primer, missatges = historial.des_de(sequencia)
+        else:
+            primer, missatges = historial.darrers(len(historial) if nombre is None else nombre)
+    if participants.diari is not None:
+        pagina = diari.MIDA_PAGINA if nombre is None else min(nombre, diari.MIDA_PAGINA)
+        textos = None
+        if sequencia is not None:
+            if historial is None or primer > sequencia + 1:
+                primer, textos = participants.diari.des_de(nom, sequencia)
+        elif len(missatges) < pagina and len(missatges) < participants.diari.nombre(nom):
+            primer, textos = participants.diari.darrers(nom, pagina)
+        if textos is not None:
+            missatges = [protocol.codifica_tots(text) for text in textos]
+    if not missatges:
+        return ["No hi ha historial a la sala %s" % nom]
+    return [missatge_historial(nom, primer, primer + len(missatges) - 1)] + missatges
+
+
+def repeticio(participants, nom):
+    """ respostes amb els missatges de l'historial que rep un participant en
+        entrar a la sala, segons la repetició configurada al registre """
+    if participants.repeticio <= 0:
+        return []
+    historial = participants.historial(nom)
+    if historial is None or len(historial) == 0:
+        return []
+    return missatges_historial(participants, nom, participants.repeticio)
+
+
+def codifica_respostes(respostes, protocol_participant):
+    """ retorna en un sol bloc de dades les respostes per a un participant.
+        Les respostes poden ser textos o missatges ja codificats
+        (protocol.Trames). Amb el protocol binari, el bloc defineix els noms
+        als quals fan referència els missatges codificats """
+    if protocol_participant != protocol.PROTOCOL_BINARI:
+        return b''.join(protocol.codifica(resposta, protocol_participant) if isinstance(resposta, str)
+                        else resposta[protocol_participant] for resposta in respostes)
+    coneguts = set()
+    return b''.join(protocol.codifica(resposta, protocol_participant) if isinstance(resposta, str)
+                    else protocol.defineix(coneguts, resposta.noms) + resposta[protocol_participant]
+                    for resposta in respostes)
+
+
+def interpreta_comanda(missatge):
+    """ retorna la tupla (comanda, argument) si el missatge és una comanda de
+        sales, o None si és un missatge normal """
+    if not (missatge.startswith("{") and missatge.endswith("}")):
+        return None
+    comanda, _, argument = missatge[1:-1].strip().partition(" ")
+    if comanda not in COMANDES:
+        return None
+    return comanda, argument.strip()
+
+
+def executa_comanda(participants, participant, comanda, argument):
+    """ executa una comanda de sales del participant.
+
+        Retorna la tupla (respostes, difusions): la llista de missatges per al
+        participant i la llista de missatges per a sales, tuples (sales,
+        emissor, missatge, desa). Cada missatge de difusió arriba un sol cop a
+        cada membre de qualsevol de les sales, excepte a l'emissor. Si desa és
+        cert, el missatge es guarda a l'historial de les sales.
+    """
+    if comanda == COMANDA_SALES:
+        sales = ["%s (%s)%s" % (nom, participants.nombre(nom), " *" if nom == participant.sala else "")
+                 for nom in participant.sales]
+        return ["Ets a les sales: %s" % ", ".join(sales)], []
+
+    if comanda == COMANDA_HISTORIAL:
+        try:
+            if argument.startswith(PREFIX_SEQUENCIA):
+                return missatges_historial(participants, participant.sala,
+                                           sequencia=int(argument[len(PREFIX_SEQUENCIA):])), []
+            return missatges_historial(participants, participant.sala, int(argument) if argument else None), []
+        except ValueError:
+            return ["Cal indicar quants missatges: {%s N}, o des de quin: {%s #N}"
+                    % (COMANDA_HISTORIAL, COMANDA_HISTORIAL)], []
+
+    nom = argument or (participant.sala if comanda == COMANDA_SURT else "")
+    if not nom or " " in nom:
+        return ["Cal indicar una sala: {%s sala}" % comanda], []
+
+    if comanda == COMANDA_ENTRA:
+        ja_hi_era = nom in participant.sales
+        participants.entra_sala(participant, nom)
+        nombre = participants.nombre(nom)
+        if ja_hi_era:
+            return [missatge_sala_actual(nom, nombre)], []
+        difusions = [((nom, ), participant, missatge_entrada_sala(participant.nom, nom, nombre), False)]
+        return [missatge_sala_actual(nom, nombre)] + repeticio(participants, nom), difusions
+
+    if nom not in participant.sales:
+        return ["No ets a la sala %s" % nom], []
+
+    if comanda == COMANDA_CANVIA:
+        participant.sala = nom
+        return [missatge_sala_actual(nom, participants.nombre(nom))], []
+
+    # COMANDA_SURT
+    if len(participant.sales) == 1:
+        return ["No pots sortir de l'única sala on ets"], []
+    participants.surt_sala(participant, nom)
+    sala = participant.sala
+    resposta = "Has sortit de la sala %s. %s" % (nom, missatge_sala_actual(sala, participants.nombre(sala)))
+    return [resposta], [((nom, ), None, missatge_sortida_sala(participant.nom, nom), False)]
+
+
+def privat(participants, participant, argument):
+    """ prepara el missatge privat de la comanda {privat noms missatge}.
+
+        Retorna la tupla (respostes, privats): la llista de missatges per al
+        participant i la llista de missatges privats, tuples (noms, emissor,
+        missatge). Cada missatge privat arriba un sol cop a cada participant
+        amb algun dels noms, excepte a l'emissor, el nom del qual no es té en
+        compte """
+    destinataris, _, text = argument.partition(" ")
+    noms = tuple(dict.fromkeys(nom for nom in destinataris.split(SEPARADOR_DESTINATARIS) if nom))
+    text = text.strip()
+    if not noms or not text:
+        return ["Cal indicar a qui i què: {%s nom[%snom...] missatge}"
+                % (COMANDA_PRIVAT, SEPARADOR_DESTINATARIS)], []
+    noms = tuple(nom for nom in noms if nom != participant.nom)
+    if not noms:
+        return [missatge_privat_propi()], []
+    if len(noms) > MAXIM_DESTINATARIS:
+        return ["Com a molt es pot enviar un missatge privat a %s participants" % MAXIM_DESTINATARIS], []
+    absents = [nom for nom in noms if not participants.hi_es(nom)]
+    respostes = [missatge_absents(absents)] if absents else []
+    presents = tuple(nom for nom in noms if nom not in absents)
+    if not presents:
+        return respostes, []
+    return respostes, [(presents, participant, missatge_privat(participant.nom, text))]
+
+
+def processa_missatge(participants, participant, missatge):
+    """ processa un missatge normal o una comanda d'un participant.
+        Retorna la tupla (respostes, difusions, privats) amb les respostes i
+        les difusions de executa_comanda() i els missatges privats de privat() """
+    if missatge == protocol.MISSATGE_BATEC:
+        return [protocol.RESPOSTA_BATEC], [], []
+    if missatge == protocol.RESPOSTA_BATEC:
+        return [], [], []
+    comanda = interpreta_comanda(missatge)
+    if comanda is not None:
+        if comanda[0] == COMANDA_PRIVAT:
+            respostes, privats = privat(participants, participant, comanda[1])
+            return respostes, [], privats
+        respostes, difusions = executa_comanda(participants, participant, *comanda)
+        return respostes, difusions, []
+    sala = participant.sala
+    return [], [((sala, ), participant, missatge_reenviament(participant.nom, missatge, sala), True)], []
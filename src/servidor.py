@@ -4,162 +4,322 @@
     Implementació d'un servidor de xat
 """
 
+import os
 import sys
+import select
 import socket
 import threading
 import logging
-import queue
 import time
 
-# Mida màxima dels missatges a intercanviar entre el client i el servidor
-MIDA_MISSATGE = 1024
-
-# Nombre màxim de connexions simultànies acceptades
-MAXIM_CONNEXIONS = 10
+import admissio
+import bitacola
+import cabal
+import diari
+import metriques
+import protocol
+import registre
+import sala
+import sortida
+import servidor_esdeveniments
+import servidor_processos
 
 # Temps d'espera en les operacions d'entrada/sortida amb les connexions (en segons)
 MAXIM_ESPERA_CONNEXIO = 2
 
+# Temps màxim per acabar d'enviar els missatges pendents en finalitzar (en segons)
+MAXIM_ESPERA_FINALITZACIO = 2
+
 # Constants per indicar el resultat d'una operació d'entrada/sortida amb sockets
 RESULTA_OK = 0          # operació realitzada amb éxit
 RESULTA_ERROR = 1       # operació no realitzada: s'ha produït un error
 RESULTA_TIMEOUT = 2     # operació no realitzada: s'ha superat el temps
 
-
-def principal(host, port):
+# Motors disponibles per gestionar les connexions dels participants
+MOTOR_FILS = 'fils'                     # un fil d'execució per participant
+MOTOR_ESDEVENIMENTS = 'esdeveniments'   # un únic fil que atén totes les connexions
+MOTORS = (MOTOR_FILS, MOTOR_ESDEVENIMENTS)
+
+# Nivells de registre de la bitàcola
+NIVELLS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+
+# Opcions de la línia de comandes
+# clau: nom de l'opció. valor: (valor per defecte, descripció)
+OPCIONS = {
+    'motor': (MOTOR_FILS, "motor de gestió de connexions (%s)" % ", ".join(MOTORS)),
+    'connexions': (10000, "nombre màxim de connexions obertes de cada procés (0: sense límit)"),
+    'connexions_ip': (0, "nombre màxim de connexions obertes des de cada adreça IP a cada procés (0: sense límit)"),
+    'cua_connexions': (socket.SOMAXCONN, "connexions pendents d'acceptar que admet el sistema"),
+    'batec': (0.0, "segons sense rebre res d'un participant després dels quals se li envia un batec "
+                   "(0: cap)"),
+    'keepalive': (60, "segons sense dades després dels quals el sistema sondeja la connexió amb TCP "
+                      "keepalive (0: no se sondeja)"),
+    'espera_nom': (2.0, "temps màxim perquè un participant nou enviï el nom (en segons)"),
+    'cua': (256, "nombre màxim de missatges pendents d'enviar a cada participant"),
+    'politica': (sortida.POLITICA_DESCARTA,
+                 "què fer quan un participant té la cua plena (%s)" % ", ".join(sortida.POLITIQUES)),
+    'processos': (1, "nombre de processos que atenen els participants (amb més d'un cal el motor %s)"
+                     % MOTOR_ESDEVENIMENTS),
+    'historial': (100, "missatges que es guarden de cada sala (0: cap)"),
+    'repeticio': (0, "missatges de l'historial que rep un participant en entrar a una sala"),
+    'diari': ("", "directori on es guarda el diari persistent dels missatges (buit: sense diari)"),
+    'missatges_segon': (0, "missatges per segon que pot enviar cada participant (0: sense límit)"),
+    'bytes_segon': (0, "bytes per segon que pot enviar cada participant (0: sense límit)"),
+    'exces': (cabal.ACCIO_ESPERA, "què fer amb els missatges d'un participant que supera el seu cabal (%s)"
+                                  % ", ".join(cabal.ACCIONS)),
+    'repartiments_segon': (0, "missatges per segon que es reparteixen entre tots els destinataris de cada "
+                              "procés (0: sense límit)"),
+    'metriques': (0, "port local on es publiquen les mètriques per HTTP (0: no es publiquen)"),
+    'nivell': ('INFO', "nivell mínim dels registres de la bitàcola (%s)" % ", ".join(NIVELLS)),
+    'bitacola': (bitacola.FORMAT_TEXT, "format del fitxer de la bitàcola (%s)" % ", ".join(bitacola.FORMATS)),
+    'limit_bitacola': (bitacola.LIMIT_PER_DEFECTE, "registres per segon de cada tipus que s'escriuen a la bitàcola "
+                                                   "(0: sense límit)"),
+    'mostreig': (1, "de cada tipus de registre informatiu, només s'escriu un de cada tants"),
+}
+
+
+def principal(host, port, opcions):
 
     logging.info("Inici del servidor de xat")
 
-    # socket de servidor
-    servidor = arrenca_servidor(host, port)
-    if not servidor:
+    # sockets de servidor: un per procés, tots amb el mateix port
+    servidors = [arrenca_servidor(host, port, opcions['cua_connexions'], opcions['processos'] > 1)
+                 for _ in range(opcions['processos'])]
+    if not all(servidors):
         print("No s'ha aconseguit arrencar el servidor amb %s:%s" % (host, port))
+        return
+    servidor = servidors[0]
 
     # marca de finalització
     finalitzacio = threading.Event()
 
-    # missatges pendents
-    missatges = queue.Queue()
+    # diari persistent dels missatges, que es recupera si ja existia
+    diari_missatges = None
+    if opcions['diari']:
+        try:
+            diari_missatges = diari.Diari(opcions['diari'])
+        except OSError as e:
+            print("No s'ha aconseguit obrir el diari %s: %s" % (opcions['diari'], e))
+            return
 
     # participants del xat
-    # clau: socket del participant. valor: (nom, es_actiu)
-    participants = dict()
-
-    # arrenca l'enviament de missatges
-    llenca_fil_enviament_de_missatges(participants, missatges, finalitzacio)
-
-    # arrenca el servei
-    llenca_fil_gestio_de_peticions(servidor, participants, missatges, finalitzacio)
+    participants = registre.Registre(opcions['historial'], opcions['repeticio'], diari_missatges)
+
+    if opcions['processos'] > 1:
+        # arrenca un procés amb el motor d'esdeveniments per cada socket de servidor
+        motor = servidor_processos.llenca_processos(servidors, participants, opcions)
+    elif opcions['motor'] == MOTOR_ESDEVENIMENTS:
+        # arrenca el servei en un únic fil d'execució
+        motor = servidor_esdeveniments.llenca_fil_motor(servidor, participants, finalitzacio, opcions)
+    else:
+        # arrenca el servei
+        llenca_fil_gestio_de_peticions(servidor, participants, finalitzacio, opcions)
+        motor = None
+
+    # publica les mètriques. Amb diversos processos, cada fill publica les seves
+    if opcions['metriques']:
+        metriques.observa_participants(participants, participants.nombre)
+        metriques.publica(opcions['metriques'])
 
     # processa comandes de consola
     processa_comandes(participants, finalitzacio)
+    if motor:
+        motor.desperta()    # perquè el motor o els processos s'assabentin de la finalització
+    else:
+        finalitza_participants(servidor, participants)
+    if diari_missatges:
+        diari_missatges.tanca()     # escriu els missatges pendents
     logging.info("Finalització de l'execució de l'aplicació de servidor")
 
 
-def arrenca_servidor(host, port):
+def arrenca_servidor(host, port, cua_connexions=socket.SOMAXCONN, comparteix_port=False):
     """ Crea la connexió del servidor  la configura
+        cua_connexions és el nombre de connexions pendents d'acceptar que
+        admet el sistema.
+        Si comparteix_port, diversos sockets poden escoltar al mateix port i el
+        sistema els reparteix les noves connexions.
         Si tot ha anat bé, retona la connexió. None altrament
     """
     try:
         connexio = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         connexio.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if comparteix_port:
+            connexio.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         connexio.bind((host, port))
         connexio.settimeout(MAXIM_ESPERA_CONNEXIO)
-        connexio.listen(MAXIM_CONNEXIONS)
+        connexio.listen(cua_connexions)
         return connexio
     except OSError as e:
-        logging.error("Error intentant crear el servidor amb %s:%s. Excepció (%s): %s" % (
-                            host, port,
-                            e.errno, e.strerror))
+        logging.error("Error intentant crear el servidor amb %s:%s. Excepció (%s): %s", host, port,
+                            e.errno, e.strerror)
         return None
 
 
-def llenca_fil_enviament_de_missatges(participants, missatges, finalitzacio):
-    """ llença el fil d'execució que realitzarà l'enviament dels missatges als participants del xat """
-    threading.Thread(target=envia_missatges, args=(participants, missatges, finalitzacio, )).start()
-    logging.info("Llençat el fil d'enviament de missatges")
+def llenca_fil_gestio_de_peticions(servidor, participants, finalitzacio, opcions):
+    """ llença el fil d'execució que gestionarà les peticions de connexió dels participants del xat """
+    threading.Thread(target=gestiona_peticions, args=(servidor, participants, finalitzacio, opcions)).start()
 
 
-def llenca_fil_gestio_de_peticions(servidor, participants, missatges, finalitzacio):
-    """ llença el fil d'execució que gestionarà les peticions de connexió dels participants del xat """
-    threading.Thread(target=gestiona_peticions, args=(servidor, participants, missatges, finalitzacio)).start()
+class ParticipantFils(registre.Participant):
+    """ Participant atès per un fil d'execució propi, amb el fil que li envia
+        els missatges """
+
+    __slots__ = ('enviament', )
+
+    def __init__(self, connexio, adressa, cua):
+        super().__init__(connexio, adressa, cua)
+        self.enviament = None
 
 
-def envia_missatges(participants, missatges, finalitzacio):
-    """ Aquesta és la funció que envia els missatges als participants
+def llenca_fil_enviament_de_missatges(participant):
+    """ llença el fil d'execució que enviarà els missatges de la cua al participant.
+        Retorna el fil """
+    fil = threading.Thread(target=envia_missatges, args=(participant, ))
+    participant.enviament = fil
+    fil.start()
+    return fil
 
-        Els missages venen a la cua de missatges en forma de tuples (destinatari, missatge)
 
-        Si el destinatari no es troba a la llista de participants, o està marcat com inactiu, s'ignora
-        Si no es pot enviar el missatge, es marca el participant com inactiu.
+def envia_missatges(participant):
+    """ Aquesta és la funció que envia els missatges pendents a un participant
+
+        Cada participant té el seu propi fil d'enviament, de manera que un
+        participant lent només s'endarrereix a ell mateix.
+
+        El fil es queda bloquejat a la cua fins que hi arriba algun missatge.
+        Llavors n'agafa de cop tots els pendents i els envia amb una sola
+        escriptura.
+        Finalitza quan la cua està tancada i buida, o quan no es pot enviar.
     """
-    while not finalitzacio.isSet() or not missatges.empty():
-        if missatges.empty():   # ens esperem una mica
-            time.sleep(1)
-            continue
-        try:
-            destinatari, missatge = missatges.get(MAXIM_ESPERA_CONNEXIO)
-        except queue.Empty:
-            continue
-        missatges.task_done()
-        try:
-            adressa = destinatari.getpeername()   # comprovem que el destinatari continua connectat
-        except OSError:
-            # el participant està desconnectat
-            participants.pop(destinatari, None)
-            continue
-        nom, es_actiu = participants.get(destinatari, (None, False))
-        if not es_actiu:                    # ignora els participants no actius
-            continue
-        resultat = envia(destinatari, missatge)
-        if resultat != RESULTA_OK:
-            participants[destinatari] = (nom, False)    # queda marcat com a innactiu
-            logging.info("Participant marcat com a innactiu %s:%s" % adressa)
-            continue
-    logging.info("Finalitza la gestió d'enviaments de missatges")
+    while True:
+        lot = participant.cua.treu_tots()
+        if not lot:     # la cua s'ha tancat
+            break
+        if not envia_a_participant(participant, lot):
+            participant.cua.tanca()
+            return
+
+
+def envia_a_participant(destinatari, trames):
+    """ envia les trames al destinatari. Retorna si el destinatari continua actiu.
+
+        Si el destinatari està marcat com inactiu, s'ignora
+        Si no es pot enviar el missatge, es desconnecta el participant.
+    """
+    if not destinatari.es_actiu:        # ignora els participants no actius
+        return False
+    resultat = envia_trames(destinatari.connexio, trames)
+    if resultat != RESULTA_OK:
+        desconnecta(destinatari)
+        return False
+    return True
+
+
+def desconnecta(participant):
+    """ marca el participant com a inactiu i li talla la connexió perquè el seu
+        fil de gestió se n'assabenti de seguida """
+    if not participant.es_actiu:
+        return
+    participant.es_actiu = False        # queda marcat com a innactiu
+    metriques.INACTIUS.incrementa()
+    logging.info("Participant marcat com a innactiu %s:%s", *participant.adressa)
+    try:
+        participant.connexio.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
 
 
-def gestiona_peticions(servidor, participants, missatges, finalitzacio):
+def gestiona_peticions(servidor, participants, finalitzacio, opcions):
     """ Aquesta és la funció que gestiona les noves peticions del servidor
 
         Es manté escoltant noves peticions fins que es marqui la finalització o
-        hi hagi algun problema de connexió """
+        hi hagi algun problema de connexió. Cada cop que arriben peticions
+        les accepta totes les pendents, i tanca de seguida les que superen els
+        límits d'admissió (admissio.py) """
 
     logging.info("Iniciada la gestió de peticions")
+    limits = cabal.limits(opcions)
+    admissions = admissio.admissio(opcions)
 
-    while not finalitzacio.isSet():
+    while not finalitzacio.is_set():
         try:
-            nova_connexio, adressa = servidor.accept()
-            logging.info("Nova connexió des de l'adreça %s" % str(adressa))
-            nova_connexio.settimeout(MAXIM_ESPERA_CONNEXIO)
-            llenca_fil_gestio_participant(nova_connexio, participants, missatges, finalitzacio)
-            logging.info("Llençat fil d'execució per gestionar el nou participant %s" % str(adressa))
+            for nova_connexio, adressa in accepta_pendents(servidor):
+                metriques.ACCEPTADES.incrementa()
+                if not admissions.admet(adressa):
+                    metriques.REBUTJADES.incrementa()
+                    logging.warning("Rebutjada la connexió des de l'adreça %s: massa connexions", adressa)
+                    nova_connexio.close()
+                    continue
+                logging.info("Nova connexió des de l'adreça %s", adressa)
+                nova_connexio.settimeout(MAXIM_ESPERA_CONNEXIO)
+                if opcions['keepalive']:
+                    protocol.activa_keepalive(nova_connexio, opcions['keepalive'])
+                llenca_fil_gestio_participant(nova_connexio, adressa, participants, finalitzacio, opcions,
+                                              limits, admissions)
+                logging.info("Llençat fil d'execució per gestionar el nou participant %s", adressa)
         except socket.timeout:
             # ha passat el temps màxim d'espera. Tornem a comprovar si encara cal continuar
             pass
-        except OSError:
+        except OSError as e:
+            if finalitzacio.is_set():    # finalitza_participants() ha tancat el servidor
+                break
+            if e.errno in admissio.ERRORS_RECURSOS:
+                logging.warning("No es poden acceptar connexions: %s", e.strerror)
+                finalitzacio.wait(admissio.PAUSA_RECURSOS)
+                continue
             logging.warning("Perduda connexió del servidor")
             missatge = "Ha caigut el servidor de xat. No es podran acceptar nous participants"
-            broadcast(participants, missatges, [], missatge)
+            broadcast(participants.instantania(), None, missatge)
             print(missatge)
             break
 
     # tanca el servidor
-    if finalitzacio.isSet():
+    if finalitzacio.is_set():
         servidor.close()
     logging.info("Finalitzada la gestió de peticions")
 
 
-def llenca_fil_gestio_participant(connexio, participants, missatges, finalitzacio):
-    """ llença el fil d'execució que gestionarà els missatges que enviï un parcicipant """
-    threading.Thread(target=gestiona_participant, args=(connexio, participants, missatges, finalitzacio)).start()
+def accepta_pendents(servidor):
+    """ espera com a molt MAXIM_ESPERA_CONNEXIO segons que arribi una
+        petició de connexió i l'accepta juntament amb totes les que ja estiguin
+        pendents, fins a admissio.LOT_ACCEPTACIONS. Retorna la llista de
+        (connexió, adreça) """
+    lot = [servidor.accept()]
+    servidor.settimeout(0)
+    try:
+        while len(lot) < admissio.LOT_ACCEPTACIONS:
+            lot.append(servidor.accept())
+    except OSError:
+        pass    # no n'hi ha més de pendents. Si s'ha perdut el servidor, es veurà a la propera crida
+    finally:
+        servidor.settimeout(MAXIM_ESPERA_CONNEXIO)
+    return lot
 
 
-def gestiona_participant(connexio, participants, missatges, finalitzacio):
+def llenca_fil_gestio_participant(connexio, adressa, participants, finalitzacio, opcions, limits, admissions):
+    """ llença el fil d'execució que gestionarà els missatges que enviï un
+        parcicipant. Quan acaba, allibera la connexió de l'admissió """
+    def gestiona():
+        try:
+            gestiona_participant(connexio, participants, finalitzacio, opcions, limits)
+        finally:
+            admissions.allibera(adressa)
+    threading.Thread(target=gestiona).start()
+
+
+def gestiona_participant(connexio, participants, finalitzacio, opcions, limits):
     """
         Aquesta és la funció que gestiona les comunicacions que envia un
         participant a traves de la connexió fins que la marca de finalització
         s'estableix
+
+        Si el participant supera el seu cabal (cabal.py), els seus missatges
+        s'endarrereixen, es descarten o se'l desconnecta
+
+        Mentre el participant no envia res, el fil espera sense despertar-se.
+        Amb l'opció batec, quan fa batec segons que no arriba res se li envia
+        un batec, i si no respon a protocol.BATECS_SENSE_RESPOSTA batecs
+        seguits es dona per perdut
     """
     try:
         adressa = connexio.getpeername()
@@ -167,135 +327,299 @@ def gestiona_participant(connexio, participants, missatges, finalitzacio):
         # la connexió està tancada
         return
 
-    logging.info("Iniciada gestió per nou participant %s:%s" % adressa)
-
-    # obté el nom del participant
-    resultat, nom = rep(connexio)
+    logging.info("Iniciada gestió per nou participant %s:%s", *adressa)
+
+    # obté el nom del participant, i amb ell el protocol que fa servir. Ha
+    # d'arribar sencer abans del temps màxim, encara que arribi a trossos
+    descodificador = protocol.Descodificador()
+    limit_nom = time.monotonic() + opcions['espera_nom']
+    resultat, rebuts = RESULTA_OK, []
+    while resultat == RESULTA_OK and not rebuts:    # el nom encara no ha arribat sencer
+        espera = limit_nom - time.monotonic()
+        if espera <= 0:
+            resultat = RESULTA_TIMEOUT
+            break
+        connexio.settimeout(espera)
+        resultat, rebuts = rep(connexio, descodificador)
+    connexio.settimeout(MAXIM_ESPERA_CONNEXIO)
     if resultat != RESULTA_OK:    # no s'ha aconseguit el nom i es finalitza l'execució
-        logging.warning("No s'aconsegueix obtenir el nom del participant %s:%s. Finalitzat." % adressa)
-        connexio.close()
-        return
-
-    # envia missatge de benvinguda
-    missatge = "Hola %s. Acabes d'entrar a la sala de xat de Fanjac. " \
-               "De moment hi ha %s participants" % (nom, len(participants) + 1)
-    resultat = envia(connexio, missatge)
-    if resultat != RESULTA_OK:
-        logging.info("No s'aconsegueix enviar la benvinguda al participant %s. Finalitzat." % str((connexio.getpeername(), nom)))
+        logging.warning("No s'aconsegueix obtenir el nom del participant %s:%s. Finalitzat.", *adressa)
         connexio.close()
         return
-
-    # afegeix el nom del nou participant a la sala de participants
-    participants[connexio] = (nom, True)
-    logging.info("Nou participant %s a %s:%s" % (nom, adressa[0], adressa[1]))
-
-    # envia a la resta de participants la notificació del nou participant
-    missatge = "S'ha afegit %s. Ara ja sou %s participants" % (nom, len(participants))
-    broadcast(participants, missatges, [connexio], missatge)
+    demanat = rebuts.pop(0)     # la resta són missatges que han arribat amb el nom
+    nom = participants.reserva_nom(demanat)
+
+    # deixa el missatge de benvinguda al principi de la cua del nou participant
+    cua = sortida.CuaSortida(opcions['cua'], opcions['politica'], descodificador.protocol)
+    nombre = participants.nombre(registre.SALA_PRINCIPAL) + 1
+    respostes = [sala.missatge_benvinguda(nom, nombre)]
+    if nom != demanat:
+        respostes.append(sala.missatge_rebateig(demanat, nom))
+    respostes += sala.repeticio(participants, registre.SALA_PRINCIPAL)
+    cua.afegeix(protocol.salutacio(cua.protocol) + sala.codifica_respostes(respostes, cua.protocol))
+
+    # afegeix el nou participant a la sala de participants
+    participant = ParticipantFils(connexio, adressa, cua)
+    participant.nom = nom
+    participants.afegeix(participant)
+    cabal_participant = limits.cabal()
+
+    # envia a la resta de participants de la sala principal la notificació del
+    # nou participant. Es fa abans d'enviar la benvinguda, de manera que quan
+    # el participant la rep, la sala ja sap que hi és
+    missatge = sala.missatge_nou_participant(nom, participants.nombre(registre.SALA_PRINCIPAL))
+    difon(participants, (registre.SALA_PRINCIPAL, ), participant, missatge)
+
+    # arrenca l'enviament de missatges al nou participant, començant per la benvinguda
+    enviament = llenca_fil_enviament_de_missatges(participant)
+    logging.info("Nou participant %s a %s:%s", nom, adressa[0], adressa[1])
 
     # comença a gestionar els missatges que generi el participant
+    batecs = 0      # batecs seguits que no han obtingut resposta
     while True:
-        _, es_actiu = participants[connexio]
-        if not es_actiu:    # el participant ha estat marcat com a innactiu
+        if not participant.es_actiu:    # el participant ha estat marcat com a innactiu
             break
 
-        if finalitzacio.isSet():    # es tanca la sala de xat
-            logging.info("Notificant la finalització al participant %s:%s" % adressa)
-            missatge = "{quit}"
-            missatges.put((connexio, missatge))
+        if finalitzacio.is_set():    # es tanca la sala de xat
+            # si el participant ha entrat després que finalitza_participants()
+            # ho notifiqués a tothom, cal notificar-l'hi ara
+            logging.info("Notificant la finalització al participant %s:%s", *adressa)
+            cua.afegeix(protocol.codifica(sala.MISSATGE_FINALITZACIO, cua.protocol), 0)
             break
 
-        # recepció d'un nou missatge
-        resultat, missatge = rep(connexio)
-        if resultat == RESULTA_TIMEOUT: # temps exhaurit. Tornem-hi
-            continue
-
-        if resultat == RESULTA_ERROR:
-            logging.warning("Perduda la connexió amb el participant %s:%s" % adressa)
-            participants[connexio]=(nom, False) # marca com a inactiu
+        # recepció de nous missatges. finalitza_participants() i desconnecta()
+        # tanquen la lectura de la connexió per despertar el fil
+        if not rebuts:
+            if espera_dades(connexio, opcions['batec'] or None):
+                resultat, rebuts = rep(connexio, descodificador)
+                batecs = 0
+            elif batecs < protocol.BATECS_SENSE_RESPOSTA:
+                cua.afegeix(protocol.codifica(protocol.MISSATGE_BATEC, cua.protocol), 0)
+                batecs += 1
+                continue
+            else:
+                logging.warning("El participant %s:%s no respon als batecs", *adressa)
+                metriques.SENSE_BATEC.incrementa()
+                resultat = RESULTA_ERROR
+            if resultat == RESULTA_TIMEOUT: # temps exhaurit. Tornem-hi
+                continue
+
+            if resultat == RESULTA_ERROR and finalitzacio.is_set():
+                break   # finalitza_participants() ha tancat la lectura de la connexió
+
+            if resultat == RESULTA_ERROR:
+                logging.warning("Perduda la connexió amb el participant %s:%s", *adressa)
+                participant.es_actiu = False    # marca com a inactiu
+                # envia notificació de finalització de participant
+                missatge = sala.missatge_connexio_perduda(nom)
+                difon(participants, tuple(participant.sales), participant, missatge)
+                break
+
+            if not rebuts:  # encara no ha arribat cap missatge sencer
+                continue
+
+        missatge = rebuts.pop(0)
+
+        if missatge == sala.MISSATGE_FINALITZACIO:
+            logging.info("Rebuda petició de sortida del participant %s:%s", *adressa)
+            participant.es_actiu = False    # marca com a inactiu
             # envia notificació de finalització de participant
-            missatge = "S'ha perdut la connexió amb %s" % nom
-            broadcast(participants, missatges, [connexio], missatge)
+            missatge = sala.missatge_abandonament(nom)
+            difon(participants, tuple(participant.sales), participant, missatge)
             break
 
-        if missatge == '{quit}':
-            logging.info("Rebuda petició de sortida del participant %s:%s" % adressa)
-            participants[connexio]=(nom, False) # marca com a inactiu
-            # envia notificació de finalització de participant
-            missatge = "%s abandona la sala de xat" % nom
-            broadcast(participants, missatges, [connexio], missatge)
-            break
+        # limita el cabal del participant
+        if cabal_participant is not None:
+            accio, espera = cabal_participant.admet(missatge)
+            if accio is not None:
+                metriques.EXCESSOS_CABAL.incrementa()
+            if accio == cabal.ACCIO_ESPERA:
+                rebuts.insert(0, missatge)
+                finalitzacio.wait(espera)
+                continue
+            if accio == cabal.ACCIO_DESCARTA:
+                if cabal_participant.cal_avisar():
+                    cua.afegeix(protocol.codifica(sala.missatge_cabal_descartat(), cua.protocol), 0)
+                continue
+            if accio == cabal.ACCIO_DESCONNECTA:
+                logging.warning("Desconnectat per excés de cabal el participant %s:%s", *adressa)
+                cua.afegeix(protocol.codifica(sala.missatge_cabal_desconnectat(), cua.protocol), 0)
+                participant.es_actiu = False    # marca com a inactiu
+                missatge = sala.missatge_connexio_perduda(nom)
+                difon(participants, tuple(participant.sales), participant, missatge)
+                break
+
+        # reenvia el missatge a la resta de participants de la sala, o executa la comanda de sales
+        respostes, difusions, privats = sala.processa_missatge(participants, participant, missatge)
+        if respostes:
+            cua.afegeix(sala.codifica_respostes(respostes, cua.protocol), MAXIM_ESPERA_CONNEXIO)
+        repartiments = 0
+        for sales, emissor, text, desa in difusions:
+            repartiments += difon(participants, sales, emissor, text, desa)
+        for noms, emissor, text in privats:
+            repartiments += envia_privat(participants, noms, emissor, text)
+        if cabal_participant is not None:
+            cabal_participant.reparteix(repartiments)
+
+    # deixem un temps perquè es puguin enviar els darrers missatges
+    participants.treu(participant)
+    cua.tanca()
+    enviament.join(MAXIM_ESPERA_CONNEXIO)
+    try:
+        connexio.close()
+    except OSError:
+        pass
+    logging.info("Finalitzada l'execució del participant %s:%s", *adressa)
+
 
-        # reenvia el missatge a la resta de participants
-        reenviament = "[%s] %s" % (nom, missatge)
-        broadcast(participants, missatges, [connexio], reenviament)
+def finalitza_participants(servidor, participants):
+    """ finalitza alhora l'atenció de tots els participants, un cop marcada la
+        finalització.
 
-    time.sleep(1)   # deixem un temps perquè es pugui enviar els darrers missatges
+        Deixa d'acceptar connexions, afegeix {quit} a la cua de tothom d'una
+        sola passada i tanca les cues. Tanca la lectura de totes les connexions
+        perquè els fils que les atenen s'assabentin de seguida, i espera que els
+        fils d'enviament acabin d'enviar els missatges pendents fins a un límit
+        comú. Als que encara no han acabat se'ls talla la connexió.
+    """
+    limit = time.monotonic() + MAXIM_ESPERA_FINALITZACIO
     try:
-        connexio.close()
+        servidor.shutdown(socket.SHUT_RDWR)     # desperta el fil que accepta connexions
     except OSError:
         pass
-    participants.pop(connexio, None)
-    logging.info("Finalitzada l'execució del participant %s:%s" % adressa)
+    logging.info("Notificant la finalització als participants")
+    destinataris = participants.instantania()
+    trames = protocol.codifica_tots(sala.MISSATGE_FINALITZACIO)
+    for participant in destinataris:
+        if participant.cua.afegeix(trames[participant.cua.protocol], 0) == sortida.RESULTA_DESCONNECTA:
+            desconnecta(participant)
+        participant.cua.tanca()
+        try:
+            participant.connexio.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+    for participant in destinataris:
+        if participant.enviament is not None:
+            participant.enviament.join(max(0, limit - time.monotonic()))
+            if participant.enviament.is_alive():
+                desconnecta(participant)
+    logging.info("Finalitzats els participants")
 
 
-def envia(connexio, missatge):
-    """ Tracta d'enviar el missatge al participant."""
+def envia_trames(connexio, trames):
+    """ Tracta d'enviar al participant una llista de missatges ja codificats."""
     try:
-        connexio.sendall(bytes(missatge, "utf8"))
+        sortida.envia_totes(connexio, trames)
+        metriques.BYTES_ENVIATS.incrementa(sum(map(len, trames)))
         return RESULTA_OK
     except socket.timeout:
+        metriques.TEMPS_EXHAURITS.incrementa()
         return RESULTA_TIMEOUT
     except OSError as e:
         return RESULTA_ERROR
 
 
-def rep(connexio):
-   """ obté un missatge del participant i es retorna
-       El resultat és la tupla (resultat, missatge) """
+def espera_dades(connexio, espera=None):
+    """ espera com a molt espera segons (indefinidament si és None) que
+        arribin dades de la connexió o que es tanqui. Retorna si és així """
+    try:
+        if hasattr(select, 'poll'):
+            sondeig = select.poll()
+            sondeig.register(connexio, select.POLLIN)
+            return bool(sondeig.poll(None if espera is None else espera * 1000))
+        return bool(select.select([connexio], [], [], espera)[0])
+    except (OSError, ValueError):
+        return True     # la connexió ja està tancada: la lectura ho detectarà
+
+
+def rep(connexio, descodificador):
+   """ obté els missatges complets que hagin arribat del participant
+       El resultat és la tupla (resultat, llista de missatges) """
    try:
-       missatge = connexio.recv(MIDA_MISSATGE).decode("utf8")
-       if len(missatge) == 0:
-           return (RESULTA_ERROR, '')
-       return (RESULTA_OK, missatge.strip())
+       llegits = descodificador.llegeix(connexio)
+       if llegits == 0:
+           return (RESULTA_ERROR, [])
+       metriques.BYTES_REBUTS.incrementa(llegits)
+       return (RESULTA_OK, descodificador.missatges())
    except socket.timeout:
-       return (RESULTA_TIMEOUT, None)
-   except OSError:
-       return (RESULTA_ERROR, None)
-
-
-def broadcast(participants, missatges, excepcions, missatge):
-    """ afegeix als missatges pendents un enviament per cada participant
-        excepte els indicats com a excepcions """
-    for participant in participants:
-        if participant in excepcions:
+       return (RESULTA_TIMEOUT, [])
+   except (OSError, protocol.ErrorProtocol):
+       return (RESULTA_ERROR, [])
+
+
+def difon(participants, sales, emissor, missatge, desa=False):
+    """ envia el missatge un sol cop a cada membre de les sales excepte a
+        l'emissor. Si desa és cert, el guarda també a l'historial de les sales.
+        Retorna a quants membres s'ha repartit """
+    inici = time.perf_counter()
+    trames = protocol.codifica_tots(missatge)
+    if desa:
+        for nom in sales:
+            participants.desa(nom, missatge, trames)
+    destinataris = participants.membres_sales(sales)
+    reparteix(destinataris, emissor, trames)
+    metriques.DIFUSIO.observa(time.perf_counter() - inici)
+    metriques.MISSATGES_DIFOSOS.incrementa()
+    return len(destinataris)
+
+
+def envia_privat(participants, noms, emissor, missatge):
+    """ envia el missatge un sol cop a cada participant amb algun dels noms
+        excepte a l'emissor. Retorna a quants participants s'ha repartit """
+    destinataris = participants.destinataris(noms)
+    reparteix(destinataris, emissor, protocol.codifica_tots(missatge))
+    metriques.MISSATGES_PRIVATS.incrementa()
+    return len(destinataris)
+
+
+def broadcast(destinataris, emissor, missatge):
+    """ afegeix el missatge a la cua de sortida de cada destinatari excepte a
+        l'emissor. Els missatges del servidor no tenen emissor (None)
+
+        El missatge es codifica un sol cop per protocol i tots els participants
+        que fan servir el mateix protocol comparteixen la mateixa trama. """
+    reparteix(destinataris, emissor, protocol.codifica_tots(missatge))
+
+
+def reparteix(destinataris, emissor, trames):
+    """ afegeix a la cua de cada destinatari excepte a l'emissor la trama del
+        seu protocol """
+    for participant in destinataris:
+        if participant is emissor:
             continue
-        missatges.put((participant, missatge))
+        resultat = participant.cua.afegeix(trames[participant.cua.protocol], MAXIM_ESPERA_CONNEXIO, trames.noms)
+        if resultat == sortida.RESULTA_DESCONNECTA:
+            desconnecta(participant)
 
 
 def processa_comandes(participants, finalitzacio):
     """ processa les comandes que es reben de consola. """
     logging.info("Inici de processament de comandes")
-    while not finalitzacio.isSet():
+    while not finalitzacio.is_set():
         comanda = input("Què vols fer? (ajuda): ").strip()
         if len(comanda) == 0:
             continue
         if  'ajuda'.startswith(comanda):
             print("Les comandes disponibles són:")
             print("\tajuda: mostra aquesta ajuda")
-            print("\tquants: mostra quants participants estan actius")
-            print("\tqui: mostra la llista de participants")
+            print("\tquants: mostra quants participants hi ha en total i a cada sala")
+            print("\tqui: mostra la llista de participants de cada sala")
             print("\tfinalitza: finalitza el xat")
         elif 'quants'.startswith(comanda):
-            print("El nombre de participants en aquest moment és %s" % len(participants))
+            print("El nombre de participants en aquest moment és %s" % participants.nombre())
+            for nom, _, nombre in participants.ocupacio():
+                print("\tsala %s: %s" % (nom, nombre))
         elif 'qui'.startswith(comanda):
-            if len(participants) == 0:
+            if participants.nombre() == 0:
                 print("No hi ha cap participant en aquests moments")
             else:
                 print("Els participants actuals són")
-                for participant in participants:
-                    nom, estat = participants.get(participant, ('', False))
-                    print("\t%s (actiu: %s)" % (nom, estat))
+                for nom, membres, nombre in participants.ocupacio():
+                    print("\tsala %s:" % nom)
+                    for participant in membres:
+                        print("\t\t%s (actiu: %s)" % (participant.nom, participant.es_actiu))
+                    if nombre > len(membres):
+                        print("\t\ti %s participants més atesos per altres processos" % (nombre - len(membres)))
         elif 'finalitza'.startswith(comanda):
             logging.info("Marcant l'esdeveniment de finalització per petició de la usuària")
             finalitzacio.set()
@@ -306,14 +630,22 @@ def processa_comandes(participants, finalitzacio):
 
 
 
+def mostra_us(programa):
+    """ mostra com s'ha de cridar el programa i les opcions disponibles """
+    print("Ús: %s «host» «port» [--opció=valor ...]" % programa)
+    print("Les opcions disponibles són:")
+    for nom, (valor, descripcio) in OPCIONS.items():
+        print("\t--%s: %s. Per defecte %s" % (nom, descripcio, valor))
+
+
 def obte_ip_i_port(argv):
     """
         obté la host i el port de la llista d'arguments
 
         Si les dades no són correctes, finalitza l'execució
     """
-    if len(argv) != 3:
-        print("Ús: %s «host» «port»" % argv[0])
+    if len(argv) < 3:
+        mostra_us(argv[0])
         sys.exit()
 
     if not argv[2].isdigit() or not (1024 < int(argv[2]) <= 65535):
@@ -326,11 +658,104 @@ def obte_ip_i_port(argv):
     return (host, port)
 
 
-if __name__ == '__main__':
-    logging.basicConfig(filename="%s.log" % sys.argv[0],level=logging.DEBUG, format="%(asctime)s %(levelname)s: %(message)s")
+def obte_opcions(argv):
+    """
+        obté les opcions de la forma --nom=valor que segueixen la host i el port.
+        Les opcions que no s'indiquen prenen el valor per defecte.
+
+        Si les opcions no són correctes, finalitza l'execució
+    """
+    opcions = { nom: valor for nom, (valor, _) in OPCIONS.items() }
+    for argument in argv[3:]:
+        nom, _, valor = argument[2:].partition('=')
+        if not argument.startswith('--') or nom not in OPCIONS:
+            print("ERROR: opció desconeguda %s" % argument)
+            mostra_us(argv[0])
+            sys.exit()
+        per_defecte = OPCIONS[nom][0]
+        try:
+            opcions[nom] = type(per_defecte)(valor)
+        except ValueError:
+            print("ERROR: valor incorrecte per l'opció %s" % argument)
+            sys.exit()
+
+    if opcions['motor'] not in MOTORS:
+        print("ERROR: el motor ha de ser un de %s" % ", ".join(MOTORS))
+        sys.exit()
+
+    if opcions['politica'] not in sortida.POLITIQUES:
+        print("ERROR: la política ha de ser una de %s" % ", ".join(sortida.POLITIQUES))
+        sys.exit()
+
+    if min(opcions['connexions'], opcions['connexions_ip']) < 0:
+        print("ERROR: els límits de connexions no poden ser negatius")
+        sys.exit()
 
+    if opcions['batec'] < 0 or opcions['keepalive'] < 0:
+        print("ERROR: l'interval dels batecs i el del keepalive no poden ser negatius")
+        sys.exit()
+
+    if opcions['cua_connexions'] < 1 or opcions['espera_nom'] <= 0:
+        print("ERROR: la cua de connexions i el temps d'espera del nom han de ser positius")
+        sys.exit()
+
+    if opcions['cua'] < 1:
+        print("ERROR: la cua ha de tenir lloc per algun missatge")
+        sys.exit()
+
+    if opcions['historial'] < 0 or opcions['repeticio'] < 0:
+        print("ERROR: l'historial i la repetició no poden ser negatius")
+        sys.exit()
+
+    if opcions['exces'] not in cabal.ACCIONS:
+        print("ERROR: l'acció per l'excés de cabal ha de ser una de %s" % ", ".join(cabal.ACCIONS))
+        sys.exit()
+
+    if min(opcions['missatges_segon'], opcions['bytes_segon'], opcions['repartiments_segon']) < 0:
+        print("ERROR: els límits de cabal no poden ser negatius")
+        sys.exit()
+
+    if opcions['nivell'] not in NIVELLS:
+        print("ERROR: el nivell ha de ser un de %s" % ", ".join(NIVELLS))
+        sys.exit()
+
+    if opcions['bitacola'] not in bitacola.FORMATS:
+        print("ERROR: el format de la bitàcola ha de ser un de %s" % ", ".join(bitacola.FORMATS))
+        sys.exit()
+
+    if opcions['limit_bitacola'] < 0 or opcions['mostreig'] < 1:
+        print("ERROR: el límit de la bitàcola no pot ser negatiu i el mostreig ha de ser com a mínim 1")
+        sys.exit()
+
+    if not 0 <= opcions['metriques'] <= 65535:
+        print("ERROR: el port de les mètriques ha de ser entre 0 i 65535")
+        sys.exit()
+
+    if opcions['processos'] < 1:
+        print("ERROR: cal com a mínim un procés")
+        sys.exit()
+
+    if opcions['processos'] > 1:
+        if opcions['motor'] != MOTOR_ESDEVENIMENTS:
+            print("ERROR: amb més d'un procés cal el motor %s" % MOTOR_ESDEVENIMENTS)
+            sys.exit()
+        if opcions['diari']:
+            print("ERROR: el diari només es pot fer servir amb un procés")
+            sys.exit()
+        if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(os, 'fork'):
+            print("ERROR: aquest sistema no permet atendre els participants amb diversos processos")
+            sys.exit()
+
+    return opcions
+
+
+if __name__ == '__main__':
     host, port = obte_ip_i_port(sys.argv)
+    opcions = obte_opcions(sys.argv)
+
+    bitacola.configura("%s.log" % sys.argv[0], opcions['nivell'], opcions['bitacola'],
+                       opcions['limit_bitacola'], opcions['mostreig'])
 
-    principal(host, port)
+    principal(host, port, opcions)
 
 
@@ -0,0 +1,675 @@
+"""
+    Motor d'esdeveniments del servidor de xat
+
+    En comptes de llençar un fil d'execució per cada participant, aquest motor
+    atén totes les connexions des d'un únic fil que espera esdeveniments
+    d'entrada/sortida amb el mòdul selectors (epoll a Linux).
+
+    Una connexió inactiva no consumeix cap fil ni cap despertada periòdica, de
+    manera que el servidor pot mantenir milers de participants connectats amb
+    molt poca memòria i gairebé sense ús de CPU. Amb l'opció batec, el motor
+    només es desperta cada batec segons per enviar un batec als participants
+    que no han enviat res des de la darrera vegada.
+"""
+
+import collections
+import heapq
+import itertools
+import logging
+import selectors
+import socket
+import threading
+import time
+
+import admissio
+import bus
+import cabal
+import metriques
+import protocol
+import registre
+import sala
+import sortida
+
+# Mida de la memòria intermèdia per buidar el despertador (en bytes)
+MIDA_DESPERTADOR = 1024
+
+# Temps màxim que un participant amb la cua plena pot tenir aturats els qui li
+# envien missatges amb la política espera (en segons)
+MAXIM_ESPERA_SORTIDA = 2
+
+# Temps màxim per acabar d'enviar els missatges pendents en finalitzar (en segons)
+MAXIM_ESPERA_FINALITZACIO = 2
+
+# Capacitat de la cua de sortida cap a un altre procés del servidor. És només
+# orientativa: els esdeveniments del bus no es descarten mai
+MIDA_CUA_BUS = 65536
+
+
+class Connexio(registre.Participant):
+    """ Participant atès pel motor d'esdeveniments, amb l'estat de la seva connexió """
+
+    __slots__ = ('limit_nom', 'descodificador', 'enviant', 'bloquejos', 'esperant',
+                 'limit_espera', 'interes', 'cabal', 'retinguts', 'batecs')
+
+    def __init__(self, connexio, adressa, descodificador, cua):
+        super().__init__(connexio, adressa, cua)
+        self.limit_nom = None               # fins quan pot trigar a enviar el nom
+        self.descodificador = descodificador
+        self.enviant = collections.deque()  # trames tretes de la cua que encara no s'han enviat
+        self.bloquejos = 0                  # quants participants amb la cua plena l'aturen
+        self.esperant = []                  # connexions aturades per la cua plena d'aquesta
+        self.limit_espera = None            # fins quan pot tenir aturades les connexions
+        self.interes = 0                    # esdeveniments pels que està registrada
+        self.cabal = None                   # cabal.Cabal del participant, o None si no en té límit
+        self.retinguts = None               # missatges rebuts retinguts per excés de cabal, o None
+        self.batecs = 0                     # comprovacions de batec seguides sense rebre res
+
+
+class Proces(Connexio):
+    """ Connexió amb un altre procés del servidor a través del bus.
+        El nom és el número del procés """
+
+    __slots__ = ()
+
+
+class Motor:
+    """ Servidor de xat d'un sol fil basat en esdeveniments
+
+        Els participants de la sala es guarden al mateix registre que fa servir
+        el motor de fils, perquè la consola del servidor el pugui consultar.
+    """
+
+    def __init__(self, servidor, participants, finalitzacio, opcions, xarxa=None):
+        self.servidor = servidor
+        self.participants = participants
+        self.finalitzacio = finalitzacio
+        self.opcions = opcions
+        self.finalitzant = False
+        self.pendents_nom = collections.deque()     # connexions esperant el nom, per ordre d'arribada
+        self.perdudes = collections.deque() # connexions perdudes pendents de gestionar
+        self.plenes = collections.deque()   # (límit, connexio) de les cues plenes que aturen algú
+        self.limits = cabal.limits(opcions)
+        self.admissions = admissio.admissio(opcions)
+        self.represa_acceptacio = None      # quan es tornen a acceptar connexions, si s'ha deixat de fer
+        self.retingudes = []                # monticle de (límit, ordre, connexió) retingudes per excés de cabal
+        self.ordre = itertools.count()      # desempata les connexions retingudes fins al mateix moment
+        self.batec = opcions['batec']
+        self.proper_batec = time.monotonic() + self.batec if self.batec else None
+        self.entrada = bytearray(protocol.MIDA_LECTURA)     # lectura compartida per totes les connexions
+        self.selector = selectors.DefaultSelector()
+        self.despertador, self.campana = socket.socketpair()
+        self.despertador.setblocking(False)
+        self.campana.setblocking(False)
+        servidor.setblocking(False)
+        self.selector.register(servidor, selectors.EVENT_READ, None)
+        self.selector.register(self.despertador, selectors.EVENT_READ, self.despertador)
+        self.processos = dict()             # clau: número. valor: Proces dels altres processos del bus
+        self.pendents_bus = set()           # processos amb esdeveniments publicats pendents d'enviar
+        for numero, connexio in (xarxa or {}).items():
+            self.connecta_proces(numero, connexio)
+        if self.processos:
+            participants.observador = self.publica_nombre
+            participants.observador_noms = self.publica_nom
+
+    def connecta_proces(self, numero, connexio):
+        """ incorpora al motor la connexió del bus amb un altre procés """
+        connexio.setblocking(False)
+        descodificador = bus.descodificador(self.entrada)
+        cua = sortida.CuaSortida(MIDA_CUA_BUS, sortida.POLITICA_ESPERA, protocol.PROTOCOL_TRAMES)
+        proces = Proces(connexio, ("procés", numero), descodificador, cua)
+        proces.nom = numero
+        self.processos[numero] = proces
+        self.actualitza_interes(proces)
+
+    def desperta(self):
+        """ desperta el fil del motor perquè comprovi la marca de finalització.
+            Es pot cridar des de qualsevol fil. """
+        try:
+            self.campana.send(b'x')
+        except OSError:
+            pass    # ja hi ha una despertada pendent o el motor ha finalitzat
+
+    def executa(self):
+        """ bucle principal del motor: atén els esdeveniments fins a la finalització """
+        logging.info("Iniciat el motor d'esdeveniments")
+        while not self.finalitzacio.is_set():
+            try:
+                esdeveniments = self.selector.select(self.temps_espera())
+            except OSError:
+                logging.warning("Error esperant esdeveniments del servidor")
+                break
+            for clau, mascara in esdeveniments:
+                if clau.data is None:
+                    if not self.accepta():
+                        break
+                elif clau.data is self.despertador:
+                    self.buida_despertador()
+                else:
+                    connexio = clau.data
+                    if mascara & selectors.EVENT_READ and connexio.es_actiu:
+                        self.llegeix(connexio)
+                    if mascara & selectors.EVENT_WRITE and connexio.es_actiu:
+                        self.escriu(connexio)
+            self.caduca_noms()
+            self.caduca_esperes()
+            self.caduca_retencions()
+            self.repren_acceptacio()
+            self.comprova_batecs()
+            self.buida_bus()
+        self.finalitza()
+        logging.info("Finalitzat el motor d'esdeveniments")
+
+    def temps_espera(self):
+        """ temps màxim que es pot esperar fins al proper esdeveniment.
+            None si només cal esperar activitat a les connexions """
+        limits = []
+        if self.pendents_nom:
+            limits.append(self.pendents_nom[0].limit_nom)
+        if self.plenes:
+            limits.append(self.plenes[0][0])
+        if self.retingudes:
+            limits.append(self.retingudes[0][0])
+        if self.represa_acceptacio is not None:
+            limits.append(self.represa_acceptacio)
+        if self.proper_batec is not None:
+            limits.append(self.proper_batec)
+        if not limits:
+            return None
+        return max(0, min(limits) - time.monotonic())
+
+    def buida_despertador(self):
+        try:
+            while self.despertador.recv(MIDA_DESPERTADOR):
+                pass
+        except BlockingIOError:
+            pass
+
+    def accepta(self):
+        """ accepta totes les connexions pendents del servidor, fins a
+            admissio.LOT_ACCEPTACIONS, i tanca de seguida les que superen els
+            límits d'admissió. Retorna False si s'ha perdut el socket del
+            servidor """
+        for _ in range(admissio.LOT_ACCEPTACIONS):
+            try:
+                nova_connexio, adressa = self.servidor.accept()
+            except BlockingIOError:
+                return True
+            except OSError as e:
+                if e.errno in admissio.ERRORS_RECURSOS:
+                    # deixa d'acceptar connexions una estona, perquè el
+                    # servidor continuaria apareixent com a llest
+                    logging.warning("No es poden acceptar connexions: %s", e.strerror)
+                    self.selector.unregister(self.servidor)
+                    self.represa_acceptacio = time.monotonic() + admissio.PAUSA_RECURSOS
+                    return True
+                logging.warning("Perduda connexió del servidor")
+                missatge = "Ha caigut el servidor de xat. No es podran acceptar nous participants"
+                self.broadcast(self.participants.instantania(), None, missatge)
+                print(missatge)
+                self.finalitzacio.set()
+                return False
+            metriques.ACCEPTADES.incrementa()
+            if not self.admissions.admet(adressa):
+                metriques.REBUTJADES.incrementa()
+                logging.warning("Rebutjada la connexió des de l'adreça %s: massa connexions", adressa)
+                nova_connexio.close()
+                continue
+            logging.info("Nova connexió des de l'adreça %s", adressa)
+            nova_connexio.setblocking(False)
+            if self.opcions['keepalive']:
+                protocol.activa_keepalive(nova_connexio, self.opcions['keepalive'])
+            descodificador = protocol.Descodificador(entrada=self.entrada)
+            cua = sortida.CuaSortida(self.opcions['cua'], self.opcions['politica'])
+            connexio = Connexio(nova_connexio, adressa, descodificador, cua)
+            connexio.limit_nom = time.monotonic() + self.opcions['espera_nom']
+            self.actualitza_interes(connexio)
+            self.pendents_nom.append(connexio)
+        return True
+
+    def repren_acceptacio(self):
+        """ torna a acceptar connexions quan s'acaba la pausa per manca de recursos """
+        if self.represa_acceptacio is not None and self.represa_acceptacio <= time.monotonic():
+            self.represa_acceptacio = None
+            self.selector.register(self.servidor, selectors.EVENT_READ, None)
+
+    def comprova_batecs(self):
+        """ cada batec segons, envia un batec als participants que no han
+            enviat res des de la comprovació anterior, i dona per perduts els
+            que no han respost a protocol.BATECS_SENSE_RESPOSTA batecs seguits.
+            No compten els participants retinguts, que no es llegeixen """
+        ara = time.monotonic()
+        if self.proper_batec is None or self.proper_batec > ara:
+            return
+        self.proper_batec = ara + self.batec
+        for connexio in self.participants.instantania():
+            if not connexio.es_actiu or connexio.bloquejos:
+                continue
+            connexio.batecs += 1
+            if connexio.batecs > protocol.BATECS_SENSE_RESPOSTA:
+                logging.warning("El participant %s:%s no respon als batecs", *connexio.adressa)
+                metriques.SENSE_BATEC.incrementa()
+                self.perd(connexio)
+            else:
+                self.envia(connexio, protocol.codifica(protocol.MISSATGE_BATEC, connexio.cua.protocol))
+
+    def caduca_noms(self):
+        """ tanca les connexions que no han enviat el nom a temps """
+        ara = time.monotonic()
+        while self.pendents_nom and self.pendents_nom[0].limit_nom <= ara:
+            connexio = self.pendents_nom.popleft()
+            if connexio.nom is None and connexio.es_actiu:
+                logging.warning("No s'aconsegueix obtenir el nom del participant %s:%s. Finalitzat.", *connexio.adressa)
+                self.tanca(connexio)
+
+    def caduca_esperes(self):
+        """ desconnecta els participants que fa massa que tenen la cua plena i
+            aturen els qui els envien missatges """
+        ara = time.monotonic()
+        while self.plenes and self.plenes[0][0] <= ara:
+            limit, connexio = self.plenes.popleft()
+            if connexio.limit_espera == limit and connexio.es_actiu:
+                logging.info("Participant marcat com a innactiu %s:%s", *connexio.adressa)
+                metriques.TEMPS_EXHAURITS.incrementa()
+                metriques.INACTIUS.incrementa()
+                self.perd(connexio)
+
+    def caduca_retencions(self):
+        """ processa els missatges retinguts de les connexions que ja tornen a
+            tenir cabal, i en torna a llegir """
+        ara = time.monotonic()
+        while self.retingudes and self.retingudes[0][0] <= ara:
+            _, _, connexio = heapq.heappop(self.retingudes)
+            if not connexio.es_actiu:
+                continue
+            connexio.bloquejos -= 1
+            retinguts = connexio.retinguts
+            connexio.retinguts = None
+            self.processa_tots(connexio, retinguts)
+            if connexio.es_actiu:
+                self.actualitza_interes(connexio)
+
+    def actualitza_interes(self, connexio):
+        """ registra la connexió pels esdeveniments que li interessen ara:
+            llegir si no està aturada, i escriure si té dades pendents """
+        interes = 0
+        if connexio.bloquejos == 0 and not self.finalitzant:
+            interes |= selectors.EVENT_READ
+        if connexio.enviant or len(connexio.cua) > 0:
+            interes |= selectors.EVENT_WRITE
+        if interes == connexio.interes:
+            return
+        if connexio.interes == 0:
+            self.selector.register(connexio.connexio, interes, connexio)
+        elif interes == 0:
+            self.selector.unregister(connexio.connexio)
+        else:
+            self.selector.modify(connexio.connexio, interes, connexio)
+        connexio.interes = interes
+
+    def llegeix(self, connexio):
+        """ processa les dades que arriben d'una connexió """
+        try:
+            llegits = connexio.descodificador.llegeix(connexio.connexio)
+        except BlockingIOError:
+            return
+        except OSError:
+            llegits = 0
+        if llegits == 0:
+            self.perd(connexio)
+            return
+        connexio.batecs = 0
+        metriques.BYTES_REBUTS.incrementa(llegits)
+        try:
+            missatges = connexio.descodificador.missatges()
+        except protocol.ErrorProtocol as e:
+            logging.warning("Error de protocol del participant %s:%s: %s", *connexio.adressa, e)
+            self.perd(connexio)
+            return
+        self.processa_tots(connexio, missatges)
+
+    def processa_tots(self, connexio, missatges):
+        """ processa els missatges rebuts d'una connexió. Si la connexió queda
+            retinguda per excés de cabal, guarda els que no s'han processat """
+        for posicio, missatge in enumerate(missatges):
+            if not connexio.es_actiu:
+                break
+            if connexio.retinguts is not None:
+                connexio.retinguts.extend(missatges[posicio:])
+                break
+            self.processa(connexio, missatge)
+
+    def processa(self, connexio, missatge):
+        """ processa un missatge complet rebut d'una connexió """
+        if isinstance(connexio, Proces):
+            self.processa_bus(connexio, bus.descodifica(missatge))
+        elif connexio.nom is None:
+            self.afegeix(connexio, missatge)
+        elif missatge == sala.MISSATGE_FINALITZACIO:
+            logging.info("Rebuda petició de sortida del participant %s:%s", *connexio.adressa)
+            sales = tuple(connexio.sales)
+            self.tanca(connexio)
+            self.difon(sales, None, sala.missatge_abandonament(connexio.nom))
+        elif connexio.cabal is None or self.admet(connexio, missatge):
+            respostes, difusions, privats = sala.processa_missatge(self.participants, connexio, missatge)
+            if respostes:
+                self.envia(connexio, sala.codifica_respostes(respostes, connexio.cua.protocol))
+            repartiments = 0
+            for sales, emissor, text, desa in difusions:
+                repartiments += self.difon(sales, emissor, text, desa)
+            for noms, emissor, text in privats:
+                repartiments += self.envia_privat(noms, emissor, text)
+            if connexio.cabal is not None:
+                connexio.cabal.reparteix(repartiments)
+
+    def admet(self, connexio, missatge):
+        """ comprova el cabal del participant abans de processar-ne el
+            missatge. Si l'ha superat, aplica l'acció que correspongui i
+            retorna False """
+        accio, espera = connexio.cabal.admet(missatge)
+        if accio is None:
+            return True
+        metriques.EXCESSOS_CABAL.incrementa()
+        if accio == cabal.ACCIO_ESPERA:
+            # deixa de llegir de la connexió fins que torni a tenir cabal
+            connexio.retinguts = [missatge]
+            connexio.bloquejos += 1
+            heapq.heappush(self.retingudes, (time.monotonic() + espera, next(self.ordre), connexio))
+            self.actualitza_interes(connexio)
+        elif accio == cabal.ACCIO_DESCARTA:
+            if connexio.cabal.cal_avisar():
+                self.envia(connexio, protocol.codifica(sala.missatge_cabal_descartat(), connexio.cua.protocol))
+        else:
+            logging.warning("Desconnectat per excés de cabal el participant %s:%s", *connexio.adressa)
+            self.envia(connexio, protocol.codifica(sala.missatge_cabal_desconnectat(), connexio.cua.protocol))
+            self.perd(connexio)
+        return False
+
+    def processa_bus(self, proces, esdeveniment):
+        """ processa un esdeveniment rebut d'un altre procés del servidor """
+        if esdeveniment[0] == bus.DIFUSIO:
+            _, sales, missatge, desa, reenviament = esdeveniment
+            if reenviament is not None:
+                missatge = protocol.Reenviament(*reenviament)
+            self.difon(sales, None, missatge, desa, publica=False)
+        elif esdeveniment[0] == bus.PRIVAT:
+            _, noms, missatge = esdeveniment
+            self.envia_privat(noms, None, missatge, publica=False)
+        elif esdeveniment[0] == bus.NOMBRE:
+            _, nom, nombre = esdeveniment
+            self.participants.compta_remot(proces.nom, nom, nombre)
+        elif esdeveniment[0] == bus.NOM:
+            _, nom, nombre = esdeveniment
+            self.participants.compta_nom_remot(proces.nom, nom, nombre)
+        elif esdeveniment[0] == bus.FINALITZA:
+            self.finalitzacio.set()
+
+    def afegeix(self, connexio, demanat):
+        """ incorpora a la sala el participant que acaba d'enviar el nom.
+            Si el nom ja el té algú, se li assigna un nom lliure """
+        nom = connexio.nom = self.participants.reserva_nom(demanat)
+        connexio.cua.protocol = connexio.descodificador.protocol
+        connexio.cabal = self.limits.cabal()
+        nombre = self.participants.nombre(registre.SALA_PRINCIPAL)
+        respostes = [sala.missatge_benvinguda(nom, nombre + 1)]
+        if nom != demanat:
+            respostes.append(sala.missatge_rebateig(demanat, nom))
+        respostes += sala.repeticio(self.participants, registre.SALA_PRINCIPAL)
+        connexio.cua.afegeix(protocol.salutacio(connexio.cua.protocol) +
+                             sala.codifica_respostes(respostes, connexio.cua.protocol), 0)
+        self.difon((registre.SALA_PRINCIPAL, ), None, sala.missatge_nou_participant(nom, nombre + 1))
+        self.participants.afegeix(connexio)
+        logging.info("Nou participant %s a %s:%s", nom, connexio.adressa[0], connexio.adressa[1])
+        # la benvinguda s'envia un cop el participant ja és a la sala, perquè
+        # la resta de processos del servidor ja el comptin quan arribi
+        self.escriu(connexio)
+
+    def perd(self, connexio):
+        """ gestiona la pèrdua de la connexió amb un participant
+
+            Avisar la sala pot fer perdre altres connexions (per exemple, quan
+            molts participants desapareixen alhora). Aquestes pèrdues es
+            gestionen després, una rere l'altra, en comptes d'imbricar-les """
+        self.perdudes.append(connexio)
+        if len(self.perdudes) > 1:
+            return      # ja s'està gestionant una pèrdua
+        while self.perdudes:
+            connexio = self.perdudes[0]
+            if connexio.es_actiu:
+                self.gestiona_perdua(connexio)
+            self.perdudes.popleft()
+
+    def gestiona_perdua(self, connexio):
+        """ tanca la connexió perduda i n'avisa la sala """
+        es_participant = connexio in self.participants
+        sales = tuple(connexio.sales)
+        self.tanca(connexio)
+        if es_participant:
+            logging.warning("Perduda la connexió amb el participant %s:%s", *connexio.adressa)
+            self.difon(sales, None, sala.missatge_connexio_perduda(connexio.nom))
+        elif isinstance(connexio, Proces):
+            logging.warning("Perduda la connexió amb el procés %s", connexio.nom)
+            self.participants.oblida_proces(connexio.nom)
+            if connexio.nom == bus.PROCES_PARE:
+                self.finalitzacio.set()
+
+    def tanca(self, connexio):
+        """ tanca la connexió i la treu de la sala """
+        if not connexio.es_actiu:
+            return
+        connexio.es_actiu = False
+        connexio.cua.tanca()
+        self.participants.treu(connexio)
+        if not isinstance(connexio, Proces):
+            self.admissions.allibera(connexio.adressa)
+        self.repren(connexio)
+        if connexio.interes:
+            self.selector.unregister(connexio.connexio)
+            connexio.interes = 0
+        try:
+            connexio.connexio.close()
+        except OSError:
+            pass
+        logging.info("Finalitzada l'execució del participant %s:%s", *connexio.adressa)
+
+    def difon(self, sales, emissor, missatge, desa=False, publica=True):
+        """ envia el missatge un sol cop a cada membre de les sales excepte a
+            l'emissor, tant si el participant és en aquest procés com en un altre.
+            Si desa és cert, el guarda també a l'historial de les sales.
+            publica indica si cal enviar-lo a la resta de processos.
+            Retorna a quants membres d'aquest procés s'ha repartit """
+        inici = time.perf_counter()
+        trames = protocol.codifica_tots(missatge)
+        if desa:
+            for nom in sales:
+                self.participants.desa(nom, missatge, trames)
+        destinataris = self.participants.membres_sales(sales)
+        self.reparteix(destinataris, emissor, trames)
+        metriques.DIFUSIO.observa(time.perf_counter() - inici)
+        metriques.MISSATGES_DIFOSOS.incrementa()
+        if publica and self.processos:
+            self.publica(bus.codifica(bus.DIFUSIO, sales, missatge, desa, bus.reenviament(missatge)),
+                         self.participants.processos_amb(sales))
+        return len(destinataris)
+
+    def envia_privat(self, noms, emissor, missatge, publica=True):
+        """ envia el missatge un sol cop a cada participant amb algun dels noms
+            excepte a l'emissor, tant si és en aquest procés com en un altre.
+            publica indica si cal enviar-lo als processos que tenen algun dels
+            noms. Retorna a quants participants d'aquest procés s'ha repartit """
+        destinataris = self.participants.destinataris(noms)
+        self.reparteix(destinataris, emissor, protocol.codifica_tots(missatge))
+        metriques.MISSATGES_PRIVATS.incrementa()
+        if publica and self.processos:
+            processos = self.participants.processos_amb_noms(noms)
+            if processos:
+                self.publica(bus.codifica(bus.PRIVAT, noms, missatge), processos)
+        return len(destinataris)
+
+    def publica(self, trama, numeros=None):
+        """ afegeix la trama d'un esdeveniment a la cua dels processos indicats
+            (per defecte a tots). S'enviaran totes juntes abans que el motor
+            torni a esperar esdeveniments """
+        for numero in (self.processos if numeros is None else numeros):
+            proces = self.processos.get(numero)
+            if proces is not None and proces.es_actiu:
+                proces.cua.afegeix(trama, 0)
+                self.pendents_bus.add(proces)
+
+    def buida_bus(self):
+        """ envia els esdeveniments publicats als altres processos """
+        while self.pendents_bus:
+            proces = self.pendents_bus.pop()
+            if proces.es_actiu and not proces.interes & selectors.EVENT_WRITE:
+                self.escriu(proces)
+
+    def publica_nombre(self, nom, nombre):
+        """ avisa la resta de processos que ha canviat el nombre de participants
+            de la sala en aquest procés """
+        self.publica(bus.codifica(bus.NOMBRE, nom, nombre))
+
+    def publica_nom(self, nom, nombre):
+        """ avisa la resta de processos que ha canviat quants participants
+            d'aquest procés tenen el nom. El pare no ho necessita """
+        self.publica(bus.codifica(bus.NOM, nom, nombre),
+                     [numero for numero in self.processos if numero != bus.PROCES_PARE])
+
+    def broadcast(self, destinataris, emissor, missatge):
+        """ envia el missatge de l'emissor a tots els destinataris excepte a ell
+            mateix. Els missatges del servidor no tenen emissor (None) """
+        self.reparteix(destinataris, emissor, protocol.codifica_tots(missatge))
+
+    def reparteix(self, destinataris, emissor, trames):
+        """ envia a cada destinatari excepte a l'emissor la trama del seu protocol """
+        for connexio in destinataris:
+            if connexio is not emissor:
+                self.envia(connexio, trames[connexio.cua.protocol], emissor, trames.noms)
+
+    def envia(self, connexio, dades, emissor=None, noms=()):
+        """ afegeix les dades a la cua de sortida de la connexió i intenta
+            enviar-les sense bloquejar. noms són els noms internats que fan
+            servir les dades (sortida.CuaSortida.afegeix()).
+
+            Si la cua queda plena amb la política espera, s'atura la lectura de
+            l'emissor fins que la connexió torni a tenir lloc a la cua.
+        """
+        if not connexio.es_actiu:
+            return
+        resultat = connexio.cua.afegeix(dades, 0, noms)
+        if resultat == sortida.RESULTA_DESCONNECTA:
+            logging.info("Participant marcat com a innactiu %s:%s", *connexio.adressa)
+            metriques.INACTIUS.incrementa()
+            self.perd(connexio)
+            return
+        if resultat == sortida.RESULTA_TANCADA:
+            return
+        if not connexio.interes & selectors.EVENT_WRITE:
+            self.escriu(connexio)
+        if resultat == sortida.RESULTA_PLE and emissor is not None and connexio.es_actiu:
+            self.atura(emissor, connexio)
+
+    def escriu(self, connexio):
+        """ envia tot el que es pugui de les dades pendents d'una connexió
+
+            Abans d'escriure a un participant s'envien els esdeveniments
+            publicats al bus, de manera que la resta de processos s'assabenten
+            dels canvis abans que el participant en pugui veure els efectes.
+        """
+        if self.pendents_bus and not isinstance(connexio, Proces):
+            self.buida_bus()
+        while True:
+            lot = connexio.cua.treu_tots(0)
+            if lot:
+                connexio.enviant.extend(lot)
+                self.repren(connexio)   # la cua torna a tenir lloc
+            if not connexio.enviant:
+                break
+            try:
+                enviades = sortida.envia_vectoritzat(connexio.connexio, connexio.enviant)
+            except BlockingIOError:
+                break
+            except OSError:
+                self.perd(connexio)
+                return
+            metriques.BYTES_ENVIATS.incrementa(enviades)
+            sortida.consumeix(connexio.enviant, enviades)
+            if connexio.enviant:
+                break   # la connexió no admet més dades de moment
+        self.actualitza_interes(connexio)
+
+    def atura(self, emissor, connexio):
+        """ deixa de llegir de l'emissor mentre la connexió tingui la cua plena """
+        if emissor in connexio.esperant:
+            return
+        if not connexio.esperant:
+            connexio.limit_espera = time.monotonic() + MAXIM_ESPERA_SORTIDA
+            self.plenes.append((connexio.limit_espera, connexio))
+        connexio.esperant.append(emissor)
+        emissor.bloquejos += 1
+        if emissor.es_actiu:
+            self.actualitza_interes(emissor)
+
+    def repren(self, connexio):
+        """ torna a llegir de les connexions que la connexió tenia aturades """
+        esperant = connexio.esperant
+        connexio.esperant = []
+        connexio.limit_espera = None
+        for emissor in esperant:
+            emissor.bloquejos -= 1
+            if emissor.es_actiu:
+                self.actualitza_interes(emissor)
+
+    def finalitza(self):
+        """ notifica la finalització a tots els participants, acaba d'enviar les
+            dades pendents i tanca totes les connexions """
+        logging.info("Notificant la finalització als participants")
+        self.finalitzant = True
+        if self.represa_acceptacio is None:
+            self.selector.unregister(self.servidor)
+        self.selector.unregister(self.despertador)
+        self.broadcast(self.participants.instantania(), None, sala.MISSATGE_FINALITZACIO)
+        self.participants.observador = None
+        for proces in list(self.processos.values()):
+            self.tanca(proces)
+        # a partir d'ara només interessa escriure a les connexions amb dades pendents
+        for connexio in self.participants.instantania() + tuple(self.pendents_nom):
+            if connexio.es_actiu:
+                self.actualitza_interes(connexio)
+            if not connexio.interes:
+                self.tanca(connexio)
+        limit = time.monotonic() + MAXIM_ESPERA_FINALITZACIO
+        while len(self.participants):
+            espera = limit - time.monotonic()
+            if espera <= 0:
+                break
+            for clau, _ in self.selector.select(espera):
+                connexio = clau.data
+                if connexio.es_actiu:
+                    self.escriu(connexio)
+                if not connexio.interes:
+                    self.tanca(connexio)
+        for connexio in self.participants.instantania():
+            self.tanca(connexio)
+        self.selector.close()
+        self.servidor.close()
+        self.despertador.close()
+        self.campana.close()
+
+
+def ajusta_limit_fitxers():
+    """ augmenta el límit de fitxers oberts fins al màxim permès, ja que cada
+        participant connectat ocupa un descriptor de fitxer """
+    try:
+        import resource
+        _, maxim = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (maxim, maxim))
+    except (ImportError, ValueError, OSError):
+        logging.warning("No s'ha pogut augmentar el límit de fitxers oberts")
+
+
+def llenca_fil_motor(servidor, participants, finalitzacio, opcions):
+    """ llença el fil d'execució del motor d'esdeveniments i el retorna """
+    ajusta_limit_fitxers()
+    motor = Motor(servidor, participants, finalitzacio, opcions)
+    threading.Thread(target=motor.executa).start()
+    logging.info("Llençat el fil del motor d'esdeveniments")
+    return motor
@@ -0,0 +1,124 @@
+"""
+    Servidor de xat amb diversos processos
+
+    Un sol procés de Python només pot fer servir un nucli del processador per
+    executar codi Python. Amb l'opció --processos=N, el servidor llença N
+    processos fills, cadascun amb el seu motor d'esdeveniments i el seu propi
+    socket de servidor. Tots els sockets comparteixen el port (SO_REUSEPORT) i
+    el sistema reparteix les noves connexions entre els processos.
+
+    Els processos es comuniquen pel bus (bus.py): quan un participant envia un
+    missatge a una sala, el seu procés l'entrega als membres que atén i
+    l'envia un sol cop a cada procés que té altres membres de la sala.
+
+    El procés pare només atén la consola. Sap quants participants hi ha a cada
+    sala perquè els fills l'hi van dient pel bus, i els avisa quan cal
+    finalitzar.
+"""
+
+import logging
+import os
+import selectors
+import threading
+
+import bitacola
+import bus
+import metriques
+import registre
+import servidor_esdeveniments
+
+
+class Coordinador:
+    """ Atén des del procés pare les connexions del bus amb els processos fills """
+
+    def __init__(self, connexions, participants, fills):
+        self.connexions = connexions    # clau: número del procés. valor: socket
+        self.participants = participants
+        self.fills = fills              # identificadors dels processos fills
+
+    def desperta(self):
+        """ demana als processos fills que finalitzin """
+        trama = bus.codifica(bus.FINALITZA)
+        for connexio in self.connexions.values():
+            try:
+                connexio.sendall(trama)
+            except OSError:
+                pass    # el procés ja ha finalitzat
+
+    def executa(self):
+        """ apunta els canvis en el nombre de participants que envien els
+            processos fills, fins que tots han finalitzat """
+        selector = selectors.DefaultSelector()
+        for numero, connexio in self.connexions.items():
+            selector.register(connexio, selectors.EVENT_READ, (numero, bus.descodificador()))
+        while selector.get_map():
+            for clau, _ in selector.select():
+                numero, descodificador = clau.data
+                try:
+                    llegits = descodificador.llegeix(clau.fileobj)
+                except OSError:
+                    llegits = 0
+                if llegits == 0:
+                    logging.info("Ha finalitzat el procés %s", numero)
+                    selector.unregister(clau.fileobj)
+                    clau.fileobj.close()
+                    self.participants.oblida_proces(numero)
+                    continue
+                for missatge in descodificador.missatges():
+                    esdeveniment = bus.descodifica(missatge)
+                    if esdeveniment[0] == bus.NOMBRE:
+                        _, nom, nombre = esdeveniment
+                        self.participants.compta_remot(numero, nom, nombre)
+        selector.close()
+        for fill in self.fills:
+            os.waitpid(fill, 0)
+        logging.info("Han finalitzat tots els processos")
+
+
+def executa_proces(numero, servidor, servidors, xarxa, opcions):
+    """ cos de cada procés fill: atén els participants que li arriben amb el
+        motor d'esdeveniments fins que el pare li demana finalitzar """
+    estat = 0
+    bitacola.arrenca()
+    try:
+        for altre in servidors:
+            if altre is not servidor:
+                altre.close()
+        bus.tanca_altres(xarxa, numero)
+        logging.info("Iniciat el procés %s (pid %s)", numero, os.getpid())
+        participants = registre.Registre(opcions['historial'], opcions['repeticio'])
+        if opcions['metriques']:
+            # cada procés publica les seves mètriques al port següent al del pare
+            metriques.observa_participants(participants, participants.__len__)
+            metriques.publica(opcions['metriques'] + numero)
+        motor = servidor_esdeveniments.Motor(servidor, participants, threading.Event(), opcions, xarxa[numero])
+        motor.executa()
+    except BaseException:
+        logging.exception("Error al procés %s", numero)
+        estat = 1
+    finally:
+        bitacola.atura()
+        logging.shutdown()
+        os._exit(estat)
+
+
+def llenca_processos(servidors, participants, opcions):
+    """ llença un procés fill per cada socket de servidor i el fil que atén el
+        bus des del pare. Retorna el coordinador """
+    servidor_esdeveniments.ajusta_limit_fitxers()
+    xarxa = bus.crea_xarxa(len(servidors))
+    fills = []
+    bitacola.atura()    # els fills tornen a arrencar la bitàcola
+    for numero, servidor in enumerate(servidors, 1):
+        fill = os.fork()
+        if fill == 0:
+            executa_proces(numero, servidor, servidors, xarxa, opcions)
+        fills.append(fill)
+    bitacola.arrenca()
+    for servidor in servidors:
+        servidor.close()
+    bus.tanca_altres(xarxa, bus.PROCES_PARE)
+    coordinador = Coordinador(xarxa[bus.PROCES_PARE], participants, fills)
+    threading.Thread(target=coordinador.executa).start()
+    logging.info("Llençats %s processos", len(servidors))
+    return coordinador
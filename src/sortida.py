@@ -0,0 +1,167 @@
+"""
+    Cua de sortida d'un participant
+
+    Cada participant té la seva pròpia cua amb els missatges pendents d'enviar.
+    La cua té una capacitat màxima, de manera que un participant que no llegeix
+    els missatges no pot fer créixer indefinidament la memòria del servidor ni
+    endarrerir els missatges de la resta.
+
+    Quan la cua és plena, la política escollida decideix què passa:
+
+    - descarta: es descarta el missatge pendent més antic
+    - desconnecta: es desconnecta el participant
+    - espera: qui envia el missatge s'espera fins que hi ha lloc a la cua
+
+    Els missatges de la cua són trames ja codificades (bytes). Una mateixa
+    trama es comparteix entre les cues de tots els destinataris.
+
+    Amb el protocol binari, la cua sap quins noms internats coneix el
+    participant, i afegeix la definició dels que falten davant de la trama
+    que els fa servir. Ho fa amb la cua bloquejada, de manera que cap trama
+    no pot arribar abans que les definicions que necessita. Quan es descarta
+    una trama, les seves definicions passen a la trama següent.
+"""
+
+import collections
+import itertools
+import threading
+
+import protocol
+
+# Polítiques per als participants que no llegeixen prou ràpid
+POLITICA_DESCARTA = 'descarta'
+POLITICA_DESCONNECTA = 'desconnecta'
+POLITICA_ESPERA = 'espera'
+POLITIQUES = (POLITICA_DESCARTA, POLITICA_DESCONNECTA, POLITICA_ESPERA)
+
+# Constants per indicar el resultat d'afegir un missatge a la cua
+RESULTA_ACCEPTAT = 0        # el missatge s'ha afegit a la cua
+RESULTA_PLE = 1             # el missatge s'ha afegit però la cua ja és plena
+RESULTA_DESCONNECTA = 2     # el missatge no s'ha afegit: cal desconnectar el participant
+RESULTA_TANCADA = 3         # el missatge no s'ha afegit: la cua ja està tancada
+
+# Nombre màxim de trames que s'envien amb una sola crida al sistema
+MAXIM_TRAMES_ENVIAMENT = 512
+
+
+class CuaSortida:
+    """ Cua acotada dels missatges pendents d'enviar a un participant
+
+        Es pot fer servir des de diversos fils d'execució alhora.
+    """
+
+    __slots__ = ('missatges', 'capacitat', 'politica', 'protocol', 'condicio', 'tancada', 'descartats',
+                 'noms')
+
+    def __init__(self, capacitat, politica, protocol=None):
+        self.missatges = collections.deque()
+        self.capacitat = capacitat
+        self.politica = politica
+        self.protocol = protocol    # protocol de la connexió, per codificar-hi els missatges
+        self.condicio = threading.Condition()
+        self.tancada = False
+        self.descartats = 0         # missatges descartats per manca de lloc
+        self.noms = None            # protocol binari: identificadors dels noms ja definits
+
+    def __len__(self):
+        return len(self.missatges)
+
+    def afegeix(self, missatge, espera=None, noms=()):
+        """ afegeix el missatge a la cua seguint la política quan és plena
+
+            Amb la política espera, s'espera com a molt espera segons a que hi
+            hagi lloc. Si espera és 0 no s'espera: el missatge s'afegeix
+            igualment i es retorna RESULTA_PLE perquè qui envia pugui aturar-se.
+
+            noms són els parells (identificador, nom) que fa servir el
+            missatge si és una trama del protocol binari
+        """
+        with self.condicio:
+            if self.tancada:
+                return RESULTA_TANCADA
+            ple = False
+            if len(self.missatges) >= self.capacitat:
+                if self.politica == POLITICA_DESCARTA:
+                    descartat = self.missatges.popleft()
+                    self.descartats += 1
+                    if self.noms:
+                        missatge = self.conserva_definicions(descartat, missatge)
+                elif self.politica == POLITICA_DESCONNECTA:
+                    return RESULTA_DESCONNECTA
+                elif espera == 0:
+                    ple = True
+                elif not self.condicio.wait_for(self.te_lloc, espera) or self.tancada:
+                    return RESULTA_DESCONNECTA
+            if noms and self.protocol == protocol.PROTOCOL_BINARI:
+                if self.noms is None:
+                    self.noms = set()
+                missatge = protocol.defineix(self.noms, noms) + missatge
+            self.missatges.append(missatge)
+            self.condicio.notify_all()
+            return RESULTA_PLE if ple else RESULTA_ACCEPTAT
+
+    def conserva_definicions(self, descartat, missatge):
+        """ passa les definicions de noms de la trama descartada a la següent
+            trama de la cua, o al missatge que s'afegeix si no n'hi ha cap:
+            les trames pendents i les futures les fan servir. Retorna el
+            missatge. Cal cridar-la amb la condició adquirida """
+        definicions = protocol.definicions(descartat)
+        if not definicions:
+            return missatge
+        if self.missatges:
+            self.missatges[0] = definicions + self.missatges[0]
+            return missatge
+        return definicions + missatge
+
+    def te_lloc(self):
+        """ indica si es pot afegir un missatge sense superar la capacitat.
+            Cal cridar-la amb la condició adquirida """
+        return self.tancada or len(self.missatges) < self.capacitat
+
+    def treu_tots(self, espera=None):
+        """ treu i retorna la llista de tots els missatges pendents
+
+            Si no n'hi ha cap, espera com a molt espera segons (indefinidament si
+            és None) que n'arribi algun. Quan la cua està tancada i buida,
+            retorna una llista buida.
+        """
+        with self.condicio:
+            if not self.missatges and not self.tancada and espera != 0:
+                self.condicio.wait_for(lambda: self.missatges or self.tancada, espera)
+            lot = list(self.missatges)
+            self.missatges.clear()
+            self.condicio.notify_all()  # ara hi ha lloc per a qui estigui esperant
+            return lot
+
+    def tanca(self):
+        """ tanca la cua: no s'hi afegeixen més missatges però es poden treure
+            els que hi ha pendents """
+        with self.condicio:
+            self.tancada = True
+            self.condicio.notify_all()
+
+
+def envia_vectoritzat(connexio, trames):
+    """ envia tot el que pugui d'una seqüència de trames amb una sola crida al
+        sistema, sense copiar-les en una sola memòria intermèdia.
+        Retorna quants bytes s'han enviat """
+    lot = list(itertools.islice(trames, MAXIM_TRAMES_ENVIAMENT))
+    if hasattr(connexio, 'sendmsg'):
+        return connexio.sendmsg(lot)
+    return connexio.send(b''.join(lot))     # sistemes sense sendmsg()
+
+
+def consumeix(trames, enviades):
+    """ treu del principi de la cua de trames els bytes que ja s'han enviat """
+    while trames and enviades >= len(trames[0]):
+        enviades -= len(trames.popleft())
+    if enviades:
+        trames[0] = memoryview(trames[0])[enviades:]
+
+
+def envia_totes(connexio, trames):
+    """ envia totes les trames per la connexió, com sendall() però per una
+        llista de trames """
+    pendents = collections.deque(trames)
+    while pendents:
+        consumeix(pendents, envia_vectoritzat(connexio, pendents))
@@ -0,0 +1,339 @@
+#! /usr/bin/env python3
+
+"""
+    Motor de tortugues sense pantalla
+
+    Guarda l'estat de les tortugues que els participants mouen amb comandes
+    del xat ("[nom] tortuga endavant"): la posició, l'orientació i les línies
+    que ha dibuixat cadascuna. Les línies de cada tortuga es guarden en un
+    array de coordenades (x0, y0, x1, y1, ...), que ocupa poc i es recorre
+    de pressa. Els passos seguits en la mateixa direcció són una sola línia.
+
+    El motor no necessita cap pantalla: clientturtle.py el fa servir i només
+    dibuixa amb turtle el que hi ha a l'estat, però també pot reproduir un
+    registre de xat sencer a tota velocitat i desar-ne el dibuix en SVG o en
+    JSON. Així es poden refer els dibuixos de les sales arxivades (el diari
+    del servidor o un fitxer amb un missatge per línia) sense pantalla.
+
+    Ús: tortuga.py [--sala=nom] [--svg=fitxer] [--json=fitxer] origen
+
+    L'origen és el directori d'un diari del servidor (--diari) o un fitxer amb
+    un missatge per línia ("-" per l'entrada estàndard).
+"""
+
+import array
+import json
+import math
+import os
+import re
+import sys
+import time
+
+import diari
+import registre
+import xat
+
+# Constants de la tortuga
+PAS_TORTUGA = 100           # longitut d'un pas de tortuga
+GIR_TORTUGA = 90            # graus de gir de tortuga
+COLORS_TORTUGA = ("black", "red", "blue", "green", "orange", "purple",
+                  "brown", "magenta", "cyan", "gray")     # colors de les tortugues, per ordre d'arribada
+
+# Aspecte d'una comanda vàlida (el text del missatge, sense l'emissor)
+COMANDA_VALIDA = re.compile(r"tortuga (\S+)")
+
+# Comandes que es reprodueixen plegades, ajuntant les que es repeteixen
+MIDA_LOT = 10000
+
+# Decimals de les coordenades a les instantànies
+DECIMALS = 2
+
+# Marge al voltant del dibuix en SVG
+MARGE_SVG = 10
+
+# Comandes que entén la tortuga. clau: nom. valor: funció(tortuga, vegades)
+# que executa la comanda vegades seguides. L'estat ha de quedar igual que si
+# s'executés vegades cops d'una en una
+COMANDES = dict()
+
+
+def comanda(nom):
+    """ registra la funció decorada com la comanda nom """
+    def registra(funcio):
+        COMANDES[nom] = funcio
+        return funcio
+    return registra
+
+
+class Tortuga:
+    """ Estat d'una tortuga: posició, orientació (en graus, 0 cap a l'est i en
+        sentit contrari a les agulles del rellotge, com turtle) i les línies
+        que ha dibuixat """
+
+    __slots__ = ('nom', 'color', 'x', 'y', 'angle', 'baixada', 'segments', 'reinicis', 'continua')
+
+    def __init__(self, nom, color):
+        self.nom = nom
+        self.color = color
+        self.x = 0.0
+        self.y = 0.0
+        self.angle = 0.0
+        self.baixada = True                 # si dibuixa en moure's
+        self.segments = array.array('d')    # x0, y0, x1, y1 de cada línia
+        self.reinicis = 0                   # quants cops s'ha tornat a començar
+        self.continua = False               # si en avançar s'allarga la darrera línia
+
+    def avanca(self, distancia):
+        """ avança la distància. Si la tortuga no ha girat des de la darrera
+            línia, l'allarga en comptes d'afegir-ne una altra """
+        radians = math.radians(self.angle)
+        x = self.x + distancia * math.cos(radians)
+        y = self.y + distancia * math.sin(radians)
+        if self.baixada:
+            if self.continua:
+                self.segments[-2] = x
+                self.segments[-1] = y
+            else:
+                self.segments.extend((self.x, self.y, x, y))
+                self.continua = True
+        self.x, self.y = x, y
+
+    def gira(self, graus):
+        self.angle = (self.angle + graus) % 360
+        self.continua = False
+
+    def reinicia(self):
+        """ torna la tortuga a l'inici i n'esborra el dibuix. Conserva el color """
+        self.x = self.y = self.angle = 0.0
+        self.baixada = True
+        del self.segments[:]
+        self.reinicis += 1
+        self.continua = False
+
+    def instantania(self):
+        return {
+            'nom': self.nom,
+            'color': self.color,
+            'x': round(self.x, DECIMALS),
+            'y': round(self.y, DECIMALS),
+            'angle': round(self.angle, DECIMALS),
+            'baixada': self.baixada,
+            'segments': [round(coordenada, DECIMALS) for coordenada in self.segments],
+        }
+
+
+@comanda('endavant')
+def endavant(tortuga, vegades):
+    tortuga.avanca(PAS_TORTUGA * vegades)
+
+
+@comanda('dreta')
+def dreta(tortuga, vegades):
+    tortuga.gira(-GIR_TORTUGA * vegades)
+
+
+@comanda('esquerra')
+def esquerra(tortuga, vegades):
+    tortuga.gira(GIR_TORTUGA * vegades)
+
+
+@comanda('inicia')
+def inicia(tortuga, vegades):
+    for _ in range(vegades):
+        tortuga.reinicia()
+
+
+def analitza(missatge):
+    """ retorna el nom de la comanda de tortuga que conté el missatge
+        (xat.Missatge), o None si no n'és cap de coneguda """
+    m = COMANDA_VALIDA.fullmatch(missatge.cos)
+    if m and m.group(1) in COMANDES:
+        return m.group(1)
+    return None
+
+
+def agrupa(noms):
+    """ ajunta les comandes iguals seguides. Retorna la llista de
+        (nom, vegades) """
+    grups = []
+    for nom in noms:
+        if grups and grups[-1][0] == nom:
+            grups[-1][1] += 1
+        else:
+            grups.append([nom, 1])
+    return grups
+
+
+class Dibuix:
+    """ Estat de totes les tortugues d'una sala
+
+        Cada participant té la seva tortuga, que es crea el primer cop que
+        envia una comanda amb el color següent de COLORS_TORTUGA.
+    """
+
+    def __init__(self):
+        self.tortugues = dict()     # clau: nom del participant. valor: Tortuga, per ordre d'arribada
+        self.comandes = 0           # comandes aplicades
+
+    def tortuga(self, emissor):
+        """ retorna la tortuga del participant, i la crea si encara no en té """
+        tortuga = self.tortugues.get(emissor)
+        if tortuga is None:
+            tortuga = Tortuga(emissor, COLORS_TORTUGA[len(self.tortugues) % len(COLORS_TORTUGA)])
+            self.tortugues[emissor] = tortuga
+        return tortuga
+
+    def aplica(self, emissor, nom, vegades=1):
+        """ aplica vegades seguides la comanda nom a la tortuga de l'emissor """
+        COMANDES[nom](self.tortuga(emissor), vegades)
+        self.comandes += vegades
+
+    def aplica_lot(self, lot):
+        """ aplica un lot de comandes (emissor, nom). Les de cada participant
+            s'apliquen en ordre, ajuntant les que es repeteixen seguides.
+            Retorna els noms dels participants que han mogut la tortuga """
+        per_emissor = dict()
+        for emissor, nom in lot:
+            per_emissor.setdefault(emissor, []).append(nom)
+        for emissor, noms in per_emissor.items():
+            for nom, vegades in agrupa(noms):
+                self.aplica(emissor, nom, vegades)
+        return per_emissor.keys()
+
+    def reprodueix(self, textos, sala=None):
+        """ aplica les comandes de tots els missatges d'un registre de xat, en
+            lots de MIDA_LOT. Amb sala, només les dels missatges de la sala """
+        lot = []
+        for text in textos:
+            missatge = xat.Missatge(text)
+            if missatge.emissor is None:
+                continue
+            if sala is not None and (missatge.sala or registre.SALA_PRINCIPAL) != sala:
+                continue
+            nom = analitza(missatge)
+            if nom is not None:
+                lot.append((missatge.emissor, nom))
+                if len(lot) >= MIDA_LOT:
+                    self.aplica_lot(lot)
+                    lot = []
+        self.aplica_lot(lot)
+
+    def instantania(self):
+        """ retorna l'estat de totes les tortugues com a diccionari """
+        return {'tortugues': [tortuga.instantania() for tortuga in self.tortugues.values()]}
+
+    def exporta_json(self):
+        return json.dumps(self.instantania(), ensure_ascii=False, separators=(',', ':'))
+
+    def limits(self):
+        """ retorna (x mínima, y mínima, x màxima, y màxima) de les línies i
+            les tortugues """
+        xs = [0.0]
+        ys = [0.0]
+        for tortuga in self.tortugues.values():
+            xs.append(tortuga.x)
+            ys.append(tortuga.y)
+            if tortuga.segments:
+                xs.extend((min(tortuga.segments[0::2]), max(tortuga.segments[0::2])))
+                ys.extend((min(tortuga.segments[1::2]), max(tortuga.segments[1::2])))
+        return min(xs), min(ys), max(xs), max(ys)
+
+    def exporta_svg(self):
+        """ retorna el dibuix en SVG, amb un camí per cada tortuga. L'eix y
+            s'inverteix perquè quedi com a la pantalla de turtle """
+        x0, y0, x1, y1 = self.limits()
+        amplada = x1 - x0 + 2 * MARGE_SVG
+        alcada = y1 - y0 + 2 * MARGE_SVG
+        linies = ['<svg xmlns="http://www.w3.org/2000/svg" viewBox="%s %s %s %s" width="%s" height="%s">'
+                  % (format_coordenada(x0 - MARGE_SVG), format_coordenada(-y1 - MARGE_SVG),
+                     format_coordenada(amplada), format_coordenada(alcada),
+                     format_coordenada(amplada), format_coordenada(alcada))]
+        for tortuga in self.tortugues.values():
+            if tortuga.segments:
+                linies.append('<path stroke="%s" fill="none" d="%s"><title>%s</title></path>'
+                              % (tortuga.color, cami_svg(tortuga.segments), escapa_xml(tortuga.nom)))
+        linies.append('</svg>')
+        return "\n".join(linies)
+
+
+def format_coordenada(valor):
+    """ coordenada amb com a molt DECIMALS decimals, sense zeros sobrers """
+    text = ("%.*f" % (DECIMALS, valor)).rstrip('0').rstrip('.')
+    return "0" if text == "-0" else text
+
+
+def cami_svg(segments):
+    """ dades d'un camí SVG amb les línies. Les línies que comencen on acaba
+        l'anterior continuen el mateix tram """
+    ordres = []
+    darrer = None
+    for i in range(0, len(segments), 4):
+        x0, y0, x1, y1 = segments[i:i + 4]
+        inici = (format_coordenada(x0), format_coordenada(-y0))
+        if inici != darrer:
+            ordres.append("M%s %s" % inici)
+        darrer = (format_coordenada(x1), format_coordenada(-y1))
+        ordres.append("L%s %s" % darrer)
+    return "".join(ordres)
+
+
+def escapa_xml(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def textos_origen(origen):
+    """ genera els missatges de l'origen: el directori d'un diari, un fitxer
+        amb un missatge per línia o "-" per l'entrada estàndard """
+    if os.path.isdir(origen):
+        for _, text in diari.recorre(origen):
+            yield text
+        return
+    fitxer = sys.stdin if origen == "-" else open(origen, encoding="utf8", errors="replace")
+    try:
+        for linia in fitxer:
+            yield linia.rstrip("\n")
+    finally:
+        if fitxer is not sys.stdin:
+            fitxer.close()
+
+
+def obte_opcions(argv):
+    """ obté les opcions --sala, --svg i --json i l'origen.
+        Si no són correctes, finalitza l'execució """
+    opcions = {'sala': None, 'svg': None, 'json': None}
+    arguments = []
+    for argument in argv[1:]:
+        if argument.startswith("--"):
+            nom, _, valor = argument[2:].partition("=")
+            if nom not in opcions or not valor:
+                print("ERROR: opció desconeguda o sense valor: %s" % argument)
+                sys.exit()
+            opcions[nom] = valor
+        else:
+            arguments.append(argument)
+    if len(arguments) != 1:
+        print("Ús: %s [--sala=nom] [--svg=fitxer] [--json=fitxer] origen" % argv[0])
+        sys.exit()
+    return opcions, arguments[0]
+
+
+def principal(argv):
+    opcions, origen = obte_opcions(argv)
+    dibuix = Dibuix()
+    inici = time.perf_counter()
+    dibuix.reprodueix(textos_origen(origen), opcions['sala'])
+    durada = time.perf_counter() - inici
+    print("Reproduïdes %s comandes de %s tortugues en %.3f segons"
+          % (dibuix.comandes, len(dibuix.tortugues), durada))
+    if opcions['svg']:
+        with open(opcions['svg'], 'w', encoding="utf8") as fitxer:
+            fitxer.write(dibuix.exporta_svg())
+    if opcions['json']:
+        with open(opcions['json'], 'w', encoding="utf8") as fitxer:
+            fitxer.write(dibuix.exporta_json())
+    if not opcions['svg'] and not opcions['json']:
+        print(dibuix.exporta_json())
+
+
+if __name__ == '__main__':
+    principal(sys.argv)
@@ -0,0 +1,420 @@
+"""
+    Biblioteca per fer clients i bots del xat
+
+    Un Bucle atén des d'un sol fil totes les connexions amb el servidor amb el
+    mòdul selectors, de manera que un sol procés pot fer córrer centenars de
+    bots sense cap fil per bot ni cap despertada periòdica. Totes les
+    connexions del bucle comparteixen el selector i la memòria intermèdia de
+    lectura.
+
+    Cada Client manté una connexió amb el servidor, que no es bloqueja mai,
+    i si es perd la torna a obrir esperant cada cop més (fins a
+    MAXIM_ESPERA_RECONNEXIO segons). El client és el mateix objecte entre
+    reconnexions i conserva els gestors de missatges.
+
+    Cada missatge rebut s'analitza un sol cop (Missatge) i es passa a tots
+    els gestors del client. Per exemple, el bot "no a tot":
+
+        def no_a_tot(client, missatge):
+            if missatge.emissor is not None:
+                client.envia("no estic d'acord")
+
+        bucle = xat.Bucle()
+        bot = xat.Client("localhost", 8000, "noatot")
+        bot.afegeix_gestor(no_a_tot)
+        bucle.afegeix(bot)
+        bucle.executa()
+"""
+
+import errno
+import heapq
+import itertools
+import logging
+import random
+import re
+import selectors
+import socket
+import time
+
+import protocol
+
+# Temps d'espera per connectar amb el servidor (en segons)
+MAXIM_ESPERA_CONNEXIO = 2
+
+# Temps màxim per acabar d'enviar les dades pendents en tancar la connexió (en segons)
+MAXIM_ESPERA_TANCAMENT = 2
+
+# Protocol amb què els clients parlen amb el servidor
+PROTOCOL = protocol.PROTOCOL_BINARI
+
+# Segons sense dades després dels quals el sistema sondeja la connexió amb TCP keepalive
+KEEPALIVE = 60
+
+# Espera abans del primer intent de reconnexió, que es dobla a cada intent
+# fallit fins a MAXIM_ESPERA_RECONNEXIO (en segons)
+ESPERA_RECONNEXIO = 0.5
+MAXIM_ESPERA_RECONNEXIO = 30
+
+# Mida de la memòria intermèdia per buidar el despertador (en bytes)
+MIDA_DESPERTADOR = 1024
+
+# Aspecte dels missatges dels participants: "[nom] text", "[nom@sala] text" o
+# "[nom, en privat] text"
+PATRO_MISSATGE = re.compile(r"\[(.+?)(, en privat|@[^\]]*)?\] (.*)", re.DOTALL)
+
+# Aspecte de la benvinguda del servidor, que indica el nom assignat
+PATRO_BENVINGUDA = re.compile(r"Hola (.+?)\. Acabes d'entrar")
+
+# Estats de la connexió d'un client
+DESCONNECTAT = 0
+CONNECTANT = 1
+CONNECTAT = 2
+
+# Constants per indicar el resultat d'una operació d'entrada/sortida amb sockets
+RESULTA_OK = 0          # operació realitzada amb éxit
+RESULTA_ERROR = 1       # operació no realitzada: s'ha produït un error
+
+
+class Missatge:
+    """ Missatge rebut del servidor, analitzat un sol cop
+
+        text és el missatge tal com es mostraria. Si l'ha enviat un
+        participant, emissor és el seu nom, cos el que ha escrit, sala la sala
+        on l'ha enviat (None si és la principal) i privat si era un missatge
+        privat. Els avisos del servidor tenen emissor None i cos igual a text.
+    """
+
+    __slots__ = ('text', 'emissor', 'sala', 'cos', 'privat')
+
+    def __init__(self, text):
+        self.text = text
+        self.emissor = None
+        self.sala = None
+        self.cos = text
+        self.privat = False
+        if isinstance(text, protocol.Reenviament):
+            # el protocol binari ja porta l'emissor i la sala separats
+            self.emissor, self.sala, self.cos = text.nom, text.sala, text.missatge
+            return
+        m = PATRO_MISSATGE.match(text)
+        if m:
+            self.emissor, marca, self.cos = m.groups()
+            if marca is not None:
+                self.privat = marca == ", en privat"
+                if not self.privat:
+                    self.sala = marca[1:]
+
+    def __str__(self):
+        return self.text
+
+
+class Bucle:
+    """ Bucle d'esdeveniments que atén les connexions de molts clients
+
+        Qualsevol objecte amb un mètode processa(mascara) es pot registrar al
+        bucle (registra()) perquè l'avisi quan el seu fitxer està a punt.
+    """
+
+    def __init__(self, selector=None):
+        self.selector = selector if selector is not None else selectors.DefaultSelector()
+        self.entrada = bytearray(protocol.MIDA_LECTURA)     # lectura compartida per totes les connexions
+        self.clients = set()                # clients que el bucle atén
+        self.temporitzadors = []            # monticle de (moment, ordre, funció)
+        self.ordre = itertools.count()      # desempata els temporitzadors del mateix moment
+        self.despertador, self.campana = socket.socketpair()
+        self.despertador.setblocking(False)
+        self.campana.setblocking(False)
+        self.selector.register(self.despertador, selectors.EVENT_READ, self)
+
+    def afegeix(self, client):
+        """ afegeix el client al bucle i el connecta amb el servidor """
+        client.bucle = self
+        self.clients.add(client)
+        client.connecta()
+
+    def treu(self, client):
+        self.clients.discard(client)
+
+    def registra(self, objecte, fitxer, interes):
+        self.selector.register(fitxer, interes, objecte)
+
+    def modifica(self, objecte, fitxer, interes):
+        self.selector.modify(fitxer, interes, objecte)
+
+    def desregistra(self, fitxer):
+        self.selector.unregister(fitxer)
+
+    def programa(self, espera, funcio):
+        """ crida la funció d'aquí a espera segons """
+        heapq.heappush(self.temporitzadors, (time.monotonic() + espera, next(self.ordre), funcio))
+
+    def desperta(self):
+        """ desperta el bucle si està esperant esdeveniments.
+            Es pot cridar des de qualsevol fil. """
+        try:
+            self.campana.send(b'x')
+        except OSError:
+            pass    # ja hi ha una despertada pendent o el bucle s'ha tancat
+
+    def processa(self, mascara):
+        """ buida el despertador """
+        try:
+            while self.despertador.recv(MIDA_DESPERTADOR):
+                pass
+        except BlockingIOError:
+            pass
+
+    def temps_espera(self, espera=None):
+        """ temps màxim que es pot esperar fins al proper temporitzador, com a
+            molt espera segons. None si es pot esperar indefinidament """
+        if self.temporitzadors:
+            fins_temporitzador = max(0, self.temporitzadors[0][0] - time.monotonic())
+            if espera is None or fins_temporitzador < espera:
+                return fins_temporitzador
+        return espera
+
+    def volta(self, espera=None):
+        """ espera com a molt espera segons (None, sense límit) que passi
+            alguna cosa, i atén els esdeveniments i temporitzadors a punt """
+        for clau, mascara in self.selector.select(self.temps_espera(espera)):
+            clau.data.processa(mascara)
+        ara = time.monotonic()
+        while self.temporitzadors and self.temporitzadors[0][0] <= ara:
+            _, _, funcio = heapq.heappop(self.temporitzadors)
+            funcio()
+
+    def executa(self, finalitzacio=None):
+        """ atén els clients fins que no en queda cap, o fins que es marca la
+            finalització (cal cridar desperta() després de marcar-la) """
+        while self.clients and not (finalitzacio is not None and finalitzacio.is_set()):
+            self.volta()
+
+    def tanca(self):
+        """ tanca tots els clients i el bucle """
+        for client in list(self.clients):
+            client.tanca()
+        self.selector.unregister(self.despertador)
+        self.selector.close()
+        self.despertador.close()
+        self.campana.close()
+
+
+class Client:
+    """ Connexió d'un participant amb el servidor de xat
+
+        Les dades que no es poden enviar de seguida es guarden i s'envien quan
+        el selector indica que hi ha lloc. Si reconnecta és cert, quan es perd
+        la connexió o el servidor finalitza, el client torna a connectar-se.
+
+        Per tractar els missatges rebuts es poden afegir gestors
+        (afegeix_gestor()) o redefinir rebut(). També es poden redefinir
+        connectat(), desconnectat() i finalitzat().
+    """
+
+    def __init__(self, host, port, nom, reconnecta=True):
+        self.host = host
+        self.port = port
+        self.demanat = nom              # nom que demana el participant
+        self.nom = nom                  # nom que li ha assignat el servidor
+        self.reconnecta = reconnecta
+        self.bucle = None
+        self.connexio = None
+        self.descodificador = None
+        self.estat = DESCONNECTAT
+        self.pendents = bytearray()     # dades pendents d'enviar al servidor
+        self.interes = 0                # esdeveniments pels que està registrada la connexió
+        self.espera = ESPERA_RECONNEXIO
+        self.intent = 0                 # intents de connexió fets, per descartar els caducats
+        self.actiu = True               # fals quan el client s'ha tancat definitivament
+        self.gestors = []
+
+    def afegeix_gestor(self, gestor):
+        """ afegeix una funció gestor(client, missatge) que es cridarà amb
+            cada missatge rebut. Retorna el gestor, de manera que es pot fer
+            servir com a decorador """
+        self.gestors.append(gestor)
+        return gestor
+
+    def connecta(self):
+        """ comença a connectar amb el servidor sense bloquejar """
+        if not self.actiu or self.estat != DESCONNECTAT:
+            return
+        self.intent += 1
+        connexio = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        connexio.setblocking(False)
+        try:
+            resultat = connexio.connect_ex((self.host, self.port))
+        except OSError:
+            resultat = errno.EHOSTUNREACH   # no s'ha pogut resoldre el nom del servidor
+        if resultat not in (0, errno.EINPROGRESS):
+            connexio.close()
+            logging.warning("No s'ha pogut connectar amb el servidor %s:%s", self.host, self.port)
+            self.programa_reconnexio()
+            return
+        self.connexio = connexio
+        self.estat = CONNECTANT
+        self.interes = selectors.EVENT_WRITE
+        self.bucle.registra(self, connexio, self.interes)
+        intent = self.intent
+        self.bucle.programa(MAXIM_ESPERA_CONNEXIO, lambda: self.caduca_connexio(intent))
+
+    def caduca_connexio(self, intent):
+        """ abandona l'intent de connexió si encara no s'ha completat """
+        if intent == self.intent and self.estat == CONNECTANT:
+            logging.warning("S'ha superat el temps d'espera màxim per connectar amb el servidor")
+            self.perd()
+
+    def completa_connexio(self):
+        """ la connexió amb el servidor s'ha establert o ha fallat """
+        if self.connexio.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            logging.warning("No s'ha pogut connectar amb el servidor %s:%s", self.host, self.port)
+            self.perd()
+            return
+        logging.info("Connectat amb el servidor")
+        protocol.activa_keepalive(self.connexio, KEEPALIVE)
+        self.estat = CONNECTAT
+        self.descodificador = protocol.Descodificador(entrada=self.bucle.entrada, reenviaments=True)
+        self.pendents[:0] = protocol.salutacio(PROTOCOL) + protocol.codifica(self.demanat, PROTOCOL)
+        self.connectat()
+        self.escriu()
+
+    def programa_reconnexio(self):
+        """ programa el proper intent de connexió, o treu el client del bucle
+            si no s'ha de reconnectar """
+        if not self.reconnecta or not self.actiu:
+            self.actiu = False
+            self.bucle.treu(self)
+            return
+        # una part aleatòria evita que molts bots es reconnectin alhora
+        espera = self.espera * random.uniform(0.5, 1)
+        self.espera = min(2 * self.espera, MAXIM_ESPERA_RECONNEXIO)
+        logging.info("Es tornarà a connectar amb el servidor d'aquí a %.2f segons", espera)
+        self.bucle.programa(espera, self.connecta)
+
+    def envia(self, missatge):
+        """ Tracta d'enviar el missatge al servidor."""
+        return self.envia_dades(protocol.codifica(missatge, PROTOCOL))
+
+    def envia_dades(self, dades):
+        """ afegeix unes dades ja codificades a les pendents d'enviar i
+            n'envia tot el que pugui sense bloquejar. Sense connexió, les
+            dades es descarten """
+        if self.estat != CONNECTAT:
+            return RESULTA_ERROR
+        self.pendents += dades
+        self.escriu()
+        return RESULTA_OK if self.estat == CONNECTAT else RESULTA_ERROR
+
+    def escriu(self):
+        """ envia tot el que es pugui de les dades pendents """
+        try:
+            enviades = self.connexio.send(self.pendents)
+            del self.pendents[:enviades]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.perd()
+            return
+        self.actualitza_interes()
+
+    def actualitza_interes(self):
+        """ demana al selector que avisi quan es pugui escriure només si
+            queden dades pendents """
+        interes = selectors.EVENT_READ
+        if self.pendents:
+            interes |= selectors.EVENT_WRITE
+        if interes != self.interes:
+            self.interes = interes
+            self.bucle.modifica(self, self.connexio, interes)
+
+    def llegeix(self):
+        """ llegeix els missatges que hagin arribat del servidor i els tracta """
+        try:
+            if self.descodificador.llegeix(self.connexio) == 0:
+                self.perd()
+                return
+            missatges = self.descodificador.missatges()
+        except BlockingIOError:
+            return
+        except (OSError, protocol.ErrorProtocol):
+            self.perd()
+            return
+        for text in missatges:
+            logging.debug("Rebut missatge %s", text)
+            if text == protocol.MISSATGE_BATEC:
+                self.envia(protocol.RESPOSTA_BATEC)
+                continue
+            if text == "{quit}":
+                logging.info("Rebut missatge de finalització del servidor")
+                self.finalitzat()
+                self.perd()
+                return
+            benvinguda = PATRO_BENVINGUDA.match(text)
+            if benvinguda:
+                self.nom = benvinguda.group(1)
+                self.espera = ESPERA_RECONNEXIO     # la connexió funciona
+            self.rebut(Missatge(text))
+            if self.estat != CONNECTAT:
+                return      # un gestor ha tancat el client
+
+    def processa(self, mascara):
+        """ atén els esdeveniments que el selector ha indicat per la connexió """
+        if self.estat == CONNECTANT:
+            if mascara & (selectors.EVENT_WRITE | selectors.EVENT_READ):
+                self.completa_connexio()
+            return
+        if mascara & selectors.EVENT_READ and self.estat == CONNECTAT:
+            self.llegeix()
+        if mascara & selectors.EVENT_WRITE and self.estat == CONNECTAT:
+            self.escriu()
+
+    def rebut(self, missatge):
+        """ tracta un missatge rebut del servidor. Per defecte el passa a
+            tots els gestors """
+        for gestor in self.gestors:
+            gestor(self, missatge)
+
+    def connectat(self):
+        """ s'ha establert la connexió amb el servidor """
+
+    def desconnectat(self):
+        """ s'ha perdut la connexió amb el servidor """
+
+    def finalitzat(self):
+        """ el servidor ha finalitzat la sessió """
+
+    def desconnecta(self):
+        """ tanca la connexió, si n'hi ha """
+        if self.connexio is None:
+            return
+        self.bucle.desregistra(self.connexio)
+        self.connexio.close()
+        self.connexio = None
+        self.estat = DESCONNECTAT
+        self.pendents.clear()
+
+    def perd(self):
+        """ la connexió amb el servidor s'ha perdut: la tanca i, si cal,
+            programa la reconnexió """
+        if self.estat == DESCONNECTAT:
+            return
+        if self.estat == CONNECTAT:
+            logging.info("Perduda la connexió amb el servidor")
+            self.desconnectat()
+        self.desconnecta()
+        self.programa_reconnexio()
+
+    def tanca(self):
+        """ acaba d'enviar les dades pendents i tanca definitivament el client """
+        if not self.actiu:
+            return
+        self.actiu = False
+        if self.estat == CONNECTAT and self.pendents:
+            try:
+                self.connexio.settimeout(MAXIM_ESPERA_TANCAMENT)
+                self.connexio.sendall(self.pendents)
+            except OSError:
+                pass
+        self.desconnecta()
+        self.bucle.treu(self)
+        logging.info("Tancada la connexió")
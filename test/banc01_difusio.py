@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+"""
+    Banc de proves de la difusió de missatges del servidor de xat
+
+    Mesura el temps de CPU que gasta servidor.broadcast() per cada missatge
+    segons la mida de la sala. El missatge es codifica un sol cop i tots els
+    destinataris comparteixen la mateixa trama, de manera que el cost per
+    destinatari s'ha de mantenir constant encara que la sala creixi.
+
+    Per comparar, també es mesura com ho feia la versió original: una tupla i
+    una codificació del missatge per cada destinatari.
+
+    No cal cap servidor en marxa: les cues de sortida no s'envien a cap lloc.
+
+    Ús: banc01_difusio.py [mida del missatge]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import protocol
+import registre
+import servidor
+import sortida
+
+MIDES_SALA = (10, 100, 1000, 10000)
+DESTINATARIS_PER_MIDA = 200000      # enviaments totals que es fan per cada mida de sala
+
+
+def prepara_sala(mida, repeticions):
+    """ crea el registre de participants d'una sala imaginària """
+    participants = registre.Registre()
+    for numero in range(mida):
+        cua = sortida.CuaSortida(repeticions + 1, sortida.POLITICA_DESCARTA, protocol.PROTOCOL_TEXT)
+        participant = registre.Participant(object(), None, cua)     # object() fa el paper del socket
+        participant.nom = "participant%s" % numero
+        participants.afegeix(participant)
+    return participants
+
+
+def broadcast_original(destinataris, emissor, missatge):
+    """ difusió com la feia la versió original del servidor """
+    for participant in destinataris:
+        if participant is emissor:
+            continue
+        participant.cua.afegeix((participant.connexio, bytes(missatge, "utf8")))
+
+
+def mesura(difusio, mida, missatge):
+    """ retorna el temps de CPU per missatge de la funció de difusió """
+    repeticions = max(1, DESTINATARIS_PER_MIDA // mida)
+    destinataris = prepara_sala(mida, repeticions).instantania()
+    inici = time.process_time()
+    for _ in range(repeticions):
+        difusio(destinataris, None, missatge)
+    return (time.process_time() - inici) / repeticions
+
+
+mida_missatge = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+missatge = "[pep] " + "x" * mida_missatge
+print("Difusió d'un missatge de %s caràcters" % len(missatge))
+print("%10s %18s %18s %18s" % ("sala", "µs per missatge", "ns per destinatari", "ns original"))
+for mida in MIDES_SALA:
+    actual = mesura(servidor.broadcast, mida, missatge)
+    original = mesura(broadcast_original, mida, missatge)
+    print("%10s %18.1f %18.1f %18.1f" % (mida, actual * 1e6, actual * 1e9 / mida, original * 1e9 / mida))
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+"""
+    Banc de proves de càrrega del servidor de xat
+
+    Fa el mateix que test03_servidor_dos_clients.py però amb centenars o milers
+    de participants simulats: arrenca un servidor.py local, hi connecta tots
+    els participants, fa que uns quants emissors enviïn missatges a un ritme
+    fix i mesura:
+
+    - el ritme de connexió i la latència d'entrada (des que es comença a
+      connectar fins que arriba la benvinguda)
+    - la latència de difusió: el temps que passa des que un emissor envia un
+      missatge fins que el rep cada un dels altres participants (percentils)
+    - el rendiment: missatges enviats i entregues per segon
+    - la memòria (RSS) i la CPU del servidor, sumant-hi els processos fills
+      si n'hi ha (--processos), llegides de /proc
+
+    Tot passa per la interfície de loopback. Els resultats s'escriuen en un
+    fitxer JSON perquè es puguin comparar motors i detectar regressions.
+
+    Tots els participants simulats s'atenen des d'un sol fil amb selectors.
+    Amb sales molt grans, aquest procés també pot arribar a ser el coll
+    d'ampolla: cal mirar-ne la CPU (cpu_banc) en interpretar els resultats.
+
+    Ús: banc02_carrega.py [--opcio=valor ...] [opcions del servidor ...]
+
+    Les opcions que no són del banc (per exemple --motor=esdeveniments) es
+    passen tal qual al servidor.
+"""
+
+import collections
+import json
+import os
+import selectors
+import socket
+import subprocess
+import sys
+import time
+
+import eines
+import protocol
+import servidor_esdeveniments
+
+# Opcions del banc de proves
+# clau: nom de l'opció. valor: (valor per defecte, descripció)
+OPCIONS = {
+    'participants': (500, "nombre de participants simulats"),
+    'emissors': (10, "quants dels participants envien missatges"),
+    'ritme': (200, "missatges per segon que s'envien entre tots els emissors"),
+    'durada': (5.0, "segons que dura l'enviament de missatges"),
+    'mida': (100, "mida aproximada de cada missatge (en caràcters)"),
+    'simultanies': (100, "nombre màxim d'entrades a la sala en curs alhora"),
+    'espera': (10.0, "segons màxims d'espera per les entregues pendents i per cada fase"),
+    'port': (0, "port del servidor (0: qualsevol port lliure)"),
+    'resultats': ("banc02_resultats.json", "fitxer on s'escriuen els resultats"),
+}
+
+PERCENTILS = (0.5, 0.9, 0.99, 0.999)
+
+
+class Simulat:
+    """ Participant simulat """
+
+    __slots__ = ('nom', 'connexio', 'descodificador', 'pendent', 'inici', 'entrada', 'rebuts')
+
+    def __init__(self, nom, descodificador):
+        self.nom = nom
+        self.connexio = None
+        self.descodificador = descodificador
+        self.pendent = bytearray()      # dades pendents d'enviar al servidor
+        self.inici = None               # quan ha començat a connectar-se
+        self.entrada = None             # latència d'entrada, un cop ha rebut la benvinguda
+        self.rebuts = 0                 # missatges rebuts dels emissors
+
+
+class Carrega:
+    """ Generador de càrrega: atén tots els participants simulats """
+
+    def __init__(self, port, opcions):
+        self.port = port
+        self.opcions = opcions
+        self.selector = selectors.DefaultSelector()
+        lectura = bytearray(protocol.MIDA_LECTURA)     # compartida per tots els simulats
+        self.simulats = [Simulat("c%s" % numero, protocol.Descodificador(entrada=lectura))
+                         for numero in range(opcions['participants'])]
+        self.entrats = 0
+        self.en_curs = 0
+        self.errors = 0
+        self.enviats = []               # moment d'enviament de cada missatge, per número
+        self.latencies = []             # latència de cada entrega
+        self.ultima_entrega = None
+
+    # --- entrada a la sala
+
+    def connecta(self, simulat):
+        """ comença a connectar el participant simulat sense esperar """
+        connexio = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        connexio.setblocking(False)
+        connexio.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        simulat.connexio = connexio
+        simulat.inici = time.perf_counter()
+        connexio.connect_ex(('127.0.0.1', self.port))
+        simulat.pendent += protocol.SALUTACIO + protocol.codifica(simulat.nom, protocol.PROTOCOL_TRAMES)
+        self.selector.register(connexio, selectors.EVENT_READ | selectors.EVENT_WRITE, simulat)
+        self.en_curs += 1
+
+    def entra_tots(self):
+        """ fa entrar tots els participants, amb un màxim d'entrades en curs.
+            Retorna el temps que ha calgut """
+        pendents = collections.deque(self.simulats)
+        inici = time.perf_counter()
+        limit = inici + self.opcions['espera'] + len(self.simulats) / 10
+        while self.entrats + self.errors < len(self.simulats):
+            while pendents and self.en_curs < self.opcions['simultanies']:
+                self.connecta(pendents.popleft())
+            self.aten(max(0, limit - time.perf_counter()))
+            if time.perf_counter() > limit:
+                print("ATENCIÓ: s'ha exhaurit el temps d'entrada amb %s participants a dins" % self.entrats)
+                break
+        return time.perf_counter() - inici
+
+    # --- enviament i recepció
+
+    def aten(self, espera):
+        """ atén els esdeveniments de les connexions durant com a molt espera segons """
+        for clau, mascara in self.selector.select(espera):
+            simulat = clau.data
+            if mascara & selectors.EVENT_WRITE:
+                self.escriu(simulat)
+            if mascara & selectors.EVENT_READ and simulat.connexio is not None:
+                self.llegeix(simulat)
+
+    def escriu(self, simulat):
+        """ envia les dades pendents del participant simulat """
+        try:
+            enviades = simulat.connexio.send(simulat.pendent)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.perd(simulat)
+            return
+        del simulat.pendent[:enviades]
+        interes = selectors.EVENT_READ | (selectors.EVENT_WRITE if simulat.pendent else 0)
+        self.selector.modify(simulat.connexio, interes, simulat)
+
+    def envia(self, simulat, missatge):
+        """ afegeix el missatge a les dades pendents del participant i l'intenta enviar """
+        pendia = bool(simulat.pendent)
+        simulat.pendent += protocol.codifica(missatge, protocol.PROTOCOL_TRAMES)
+        if not pendia:
+            self.escriu(simulat)
+
+    def llegeix(self, simulat):
+        """ processa els missatges que arriben a un participant simulat """
+        try:
+            llegits = simulat.descodificador.llegeix(simulat.connexio)
+            missatges = simulat.descodificador.missatges()
+        except BlockingIOError:
+            return
+        except (OSError, protocol.ErrorProtocol):
+            llegits = 0
+        if llegits == 0:
+            self.perd(simulat)
+            return
+        ara = time.perf_counter()
+        for missatge in missatges:
+            if simulat.entrada is None:
+                simulat.entrada = ara - simulat.inici
+                self.entrats += 1
+                self.en_curs -= 1
+            elif missatge.startswith('['):
+                # els missatges dels emissors són de la forma "[nom] m<número> farcit"
+                numero = int(missatge.split(' ', 2)[1][1:])
+                self.latencies.append(ara - self.enviats[numero])
+                simulat.rebuts += 1
+                self.ultima_entrega = ara
+
+    def perd(self, simulat):
+        """ el servidor ha tancat la connexió del participant simulat """
+        if simulat.entrada is None:
+            self.en_curs -= 1
+            self.errors += 1
+        self.selector.unregister(simulat.connexio)
+        simulat.connexio.close()
+        simulat.connexio = None
+
+    def difon(self):
+        """ envia missatges des dels emissors al ritme indicat i espera que
+            arribin a tothom. Retorna el temps d'enviament """
+        emissors = [simulat for simulat in self.simulats[:self.opcions['emissors']] if simulat.connexio]
+        if not emissors:
+            return 0
+        farcit = "x" * self.opcions['mida']
+        total = int(self.opcions['ritme'] * self.opcions['durada'])
+        interval = 1 / self.opcions['ritme']
+        inici = time.perf_counter()
+        for numero in range(total):
+            proper = inici + numero * interval
+            while True:
+                espera = proper - time.perf_counter()
+                if espera <= 0:
+                    break
+                self.aten(espera)
+            self.enviats.append(time.perf_counter())
+            emissor = emissors[numero % len(emissors)]
+            if emissor.connexio is not None:
+                self.envia(emissor, "m%s %s" % (numero, farcit))
+        enviament = time.perf_counter() - inici
+
+        # espera les entregues pendents
+        esperades = total * (self.entrats - 1)
+        limit = time.perf_counter() + self.opcions['espera']
+        while len(self.latencies) < esperades and time.perf_counter() < limit:
+            self.aten(max(0, limit - time.perf_counter()))
+        return enviament
+
+    def tanca(self):
+        for simulat in self.simulats:
+            if simulat.connexio is not None:
+                simulat.connexio.close()
+        self.selector.close()
+
+
+def percentils(valors):
+    """ retorna un diccionari amb els percentils dels valors (en mil·lisegons) """
+    if not valors:
+        return {}
+    ordenats = sorted(valors)
+    resultat = { "p%g" % (percentil * 100): ordenats[min(len(ordenats) - 1, int(percentil * len(ordenats)))] * 1000
+                 for percentil in PERCENTILS }
+    resultat["maxim"] = ordenats[-1] * 1000
+    resultat["mitjana"] = sum(ordenats) / len(ordenats) * 1000
+    return resultat
+
+
+def llegeix_proces(pid):
+    """ retorna els camps de /proc/<pid>/status i de /proc/<pid>/stat del procés """
+    with open("/proc/%s/status" % pid) as fitxer:
+        estat = dict(linia.split(':', 1) for linia in fitxer if ':' in linia)
+    with open("/proc/%s/stat" % pid) as fitxer:
+        camps = fitxer.read().rsplit(')', 1)[1].split()
+    return estat, camps
+
+
+def fills(pid):
+    """ retorna els identificadors dels processos fills del procés """
+    resultat = []
+    for nom in os.listdir("/proc"):
+        if nom.isdigit():
+            try:
+                _, camps = llegeix_proces(nom)
+            except OSError:
+                continue    # el procés ha acabat
+            if int(camps[1]) == pid:   # ppid
+                resultat.append(int(nom))
+    return resultat
+
+
+def mesura_proces(pid):
+    """ retorna la memòria i el temps de CPU consumits pel procés i els seus
+        fills (servidor amb --processos), llegits de /proc. None en els
+        sistemes que no en tenen """
+    try:
+        processos = [pid] + fills(pid)
+        lectures = [llegeix_proces(numero) for numero in processos]
+    except OSError:
+        return None
+    tics = os.sysconf('SC_CLK_TCK')
+    return {
+        "processos": len(processos),
+        "rss_kb": sum(int(estat['VmRSS'].split()[0]) for estat, _ in lectures),
+        "rss_maxim_kb": sum(int(estat['VmHWM'].split()[0]) for estat, _ in lectures),
+        "fils": sum(int(estat['Threads']) for estat, _ in lectures),
+        "cpu_s": sum(int(camps[11]) + int(camps[12]) for _, camps in lectures) / tics,   # utime + stime
+    }
+
+
+def atura_servidor(servidor):
+    """ demana al servidor que finalitzi i espera que ho faci """
+    try:
+        servidor.finalitza()
+    except (OSError, subprocess.TimeoutExpired):
+        servidor.mata()
+
+
+def obte_opcions(argv):
+    """ separa les opcions del banc, de la forma --nom=valor, de les opcions
+        que s'han de passar al servidor """
+    opcions = { nom: valor for nom, (valor, _) in OPCIONS.items() }
+    opcions_servidor = []
+    for argument in argv[1:]:
+        nom, _, valor = argument[2:].partition('=')
+        if not argument.startswith('--') or nom not in OPCIONS:
+            opcions_servidor.append(argument)
+            continue
+        try:
+            opcions[nom] = type(OPCIONS[nom][0])(valor)
+        except ValueError:
+            sys.exit("ERROR: valor incorrecte per l'opció %s" % argument)
+    if opcions['participants'] < 2 or opcions['ritme'] <= 0:
+        sys.exit("ERROR: calen com a mínim dos participants i un ritme positiu")
+    return opcions, opcions_servidor
+
+
+def principal(opcions, opcions_servidor):
+    servidor_esdeveniments.ajusta_limit_fitxers()
+    try:
+        servidor = eines.Servidor('127.0.0.1', opcions['port'], opcions_servidor)
+    except AssertionError as error:
+        sys.exit("No s'ha aconseguit arrencar el servidor amb %s: %s" % (" ".join(opcions_servidor), error))
+    cpu_banc = time.process_time()
+    carrega = Carrega(servidor.port, opcions)
+    try:
+        durada_entrada = carrega.entra_tots()
+        repos = mesura_proces(servidor.proces.pid)
+        inici_difusio = time.perf_counter()
+        enviament = carrega.difon()
+        # la CPU es mesura durant tota la difusió, també mentre s'esperen les entregues
+        durada_difusio = time.perf_counter() - inici_difusio
+        final = mesura_proces(servidor.proces.pid)
+    finally:
+        atura_servidor(servidor)
+        carrega.tanca()
+
+    total = len(carrega.enviats)
+    esperades = total * max(0, carrega.entrats - 1)
+    durada_entregues = (carrega.ultima_entrega - carrega.enviats[0]) if carrega.latencies else 0
+    resultats = {
+        "opcions": opcions,
+        "opcions_servidor": opcions_servidor,
+        "entrada": {
+            "participants": carrega.entrats,
+            "errors": carrega.errors,
+            "segons": durada_entrada,
+            "connexions_per_segon": carrega.entrats / durada_entrada if durada_entrada else None,
+            "latencia_ms": percentils([simulat.entrada for simulat in carrega.simulats
+                                       if simulat.entrada is not None]),
+        },
+        "difusio": {
+            "missatges": total,
+            "missatges_per_segon": total / enviament if enviament else None,
+            "entregues": len(carrega.latencies),
+            "entregues_perdudes": esperades - len(carrega.latencies),
+            "entregues_per_segon": len(carrega.latencies) / durada_entregues if durada_entregues else None,
+            "latencia_ms": percentils(carrega.latencies),
+        },
+        "servidor": {
+            "repos": repos,
+            "final": final,
+            "segons_difusio": durada_difusio,
+            "cpu_difusio": (final["cpu_s"] - repos["cpu_s"]) / durada_difusio if final and repos else None,
+        },
+        "cpu_banc_s": time.process_time() - cpu_banc,
+    }
+    with open(opcions['resultats'], 'w') as fitxer:
+        json.dump(resultats, fitxer, indent=2)
+    mostra(resultats)
+
+
+def mostra(resultats):
+    """ mostra un resum dels resultats """
+    entrada, difusio, servidor = resultats['entrada'], resultats['difusio'], resultats['servidor']
+    print("Entrada: %s participants (%s errors) en %.2f s, %.0f connexions/s" % (
+          entrada['participants'], entrada['errors'], entrada['segons'], entrada['connexions_per_segon'] or 0))
+    for nom, valor in entrada['latencia_ms'].items():
+        print("\tlatència d'entrada %-8s %10.2f ms" % (nom, valor))
+    print("Difusió: %s missatges, %s entregues (%s perdudes), %.0f entregues/s" % (
+          difusio['missatges'], difusio['entregues'], difusio['entregues_perdudes'],
+          difusio['entregues_per_segon'] or 0))
+    for nom, valor in difusio['latencia_ms'].items():
+        print("\tlatència de difusió %-8s %10.2f ms" % (nom, valor))
+    if servidor['final']:
+        print("Servidor: %s processos, RSS %s KB (màxim %s KB), %s fils, CPU durant la difusió %.0f%%" % (
+              servidor['final']['processos'], servidor['final']['rss_kb'], servidor['final']['rss_maxim_kb'],
+              servidor['final']['fils'], (servidor['cpu_difusio'] or 0) * 100))
+    print("CPU del banc de proves: %.2f s" % resultats['cpu_banc_s'])
+    print("Resultats escrits a %s" % resultats['opcions']['resultats'])
+
+
+if __name__ == '__main__':
+    principal(*obte_opcions(sys.argv))
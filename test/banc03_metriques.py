@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+"""
+    Banc de proves del cost de les mètriques del servidor de xat
+
+    Les mètriques (metriques.py) estan sempre actives, de manera que han de
+    costar poc. Aquest banc mesura:
+
+    - el temps de CPU de cada operació: incrementar un comptador i anotar un
+      valor a un histograma
+    - el temps de CPU per missatge de servidor.difon(), que anota la difusió a
+      les mètriques, comparat amb el de la mateixa difusió sense mètriques, per
+      diverses mides de sala
+    - el temps de CPU de generar el text de les mètriques que es publica, que
+      recorre les cues de tots els participants
+
+    No cal cap servidor en marxa: les cues de sortida no s'envien a cap lloc.
+
+    Ús: banc03_metriques.py [mida del missatge]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import metriques
+import protocol
+import registre
+import servidor
+import sortida
+
+MIDES_SALA = (1, 10, 100, 1000)
+DESTINATARIS_PER_MIDA = 200000      # enviaments totals que es fan per cada mida de sala
+OPERACIONS = 1000000                # operacions per mesurar cada mètrica
+CONSULTES = 100                     # consultes de les mètriques que es mesuren
+
+
+def prepara_sala(mida, repeticions):
+    """ crea el registre de participants d'una sala imaginària """
+    participants = registre.Registre()
+    for numero in range(mida):
+        cua = sortida.CuaSortida(repeticions + 1, sortida.POLITICA_DESCARTA, protocol.PROTOCOL_TEXT)
+        participant = registre.Participant(object(), None, cua)     # object() fa el paper del socket
+        participant.nom = "participant%s" % numero
+        participants.afegeix(participant)
+    return participants
+
+
+def difon_sense_metriques(participants, sales, emissor, missatge):
+    """ servidor.difon() sense anotar res a les mètriques """
+    trames = protocol.codifica_tots(missatge)
+    servidor.reparteix(participants.membres_sales(sales), emissor, trames)
+
+
+def mesura_operacio(operacio):
+    """ retorna el temps de CPU de cada crida a l'operació (en segons) """
+    inici = time.process_time()
+    for _ in range(OPERACIONS):
+        operacio()
+    buit = time.process_time()
+    for _ in range(OPERACIONS):
+        pass
+    return ((buit - inici) - (time.process_time() - buit)) / OPERACIONS
+
+
+def mesura_difusio(difusio, mida, missatge):
+    """ retorna el temps de CPU per missatge de la funció de difusió """
+    repeticions = max(1, DESTINATARIS_PER_MIDA // mida)
+    participants = prepara_sala(mida, 2)
+    sales = (registre.SALA_PRINCIPAL, )
+    inici = time.process_time()
+    for _ in range(repeticions):
+        difusio(participants, sales, None, missatge)
+    return (time.process_time() - inici) / repeticions
+
+
+comptador = metriques.Comptador("banc", "comptador del banc de proves")
+histograma = metriques.Histograma("banc", "histograma del banc de proves")
+print("Cost de cada operació de les mètriques")
+print("%30s %10.1f ns" % ("Comptador.incrementa()", mesura_operacio(comptador.incrementa) * 1e9))
+print("%30s %10.1f ns" % ("Histograma.observa()", mesura_operacio(lambda: histograma.observa(0.0002)) * 1e9))
+print("%30s %10.1f ns" % ("time.perf_counter()", mesura_operacio(time.perf_counter) * 1e9))
+
+mida_missatge = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+missatge = "[pep] " + "x" * mida_missatge
+print()
+print("Difusió d'un missatge de %s caràcters" % len(missatge))
+print("%10s %18s %18s %12s" % ("sala", "µs amb mètriques", "µs sense", "cost"))
+for mida in MIDES_SALA:
+    amb = mesura_difusio(servidor.difon, mida, missatge)
+    sense = mesura_difusio(difon_sense_metriques, mida, missatge)
+    print("%10s %18.2f %18.2f %11.1f%%" % (mida, amb * 1e6, sense * 1e6, (amb - sense) * 100 / sense))
+
+print()
+print("Consulta de les mètriques")
+for mida in MIDES_SALA[1:] + (10000, ):
+    participants = prepara_sala(mida, 1)
+    metriques.observa_participants(participants, participants.nombre)
+    inici = time.process_time()
+    for _ in range(CONSULTES):
+        metriques.METRIQUES.text()
+    print("%10s participants %10.3f ms" % (mida, (time.process_time() - inici) * 1e3 / CONSULTES))
@@ -0,0 +1,112 @@
+"""
+    Eines comunes dels tests del servidor de xat
+
+    Afegeix el directori src al camí dels mòduls, de manera que els tests fan
+    servir les constants i la codificació del protocol (protocol.py) en
+    comptes de copiar-les.
+
+    Els tests que arrenquen el seu propi servidor.py (Servidor) reben, com la
+    resta, la ip i el port del servidor, seguits de les opcions amb què s'ha
+    d'arrencar:
+
+        testNN_nom.py ip port [opcions del servidor ...]
+
+    Amb el port 0 el servidor s'arrenca en un port lliure.
+"""
+
+import atexit
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+
+DIRECTORI_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, DIRECTORI_SRC)
+
+import protocol
+
+# Temps màxim perquè el servidor arrenqui o finalitzi (en segons)
+MAXIM_ESPERA_SERVIDOR = 10
+
+
+def obte_adressa(argv):
+    """ obté la ip i el port del servidor i les opcions del servidor que els
+        segueixen. Si no són correctes, finalitza l'execució """
+    if len(argv) < 3 or not argv[2].isdigit():
+        print("Ús: %s ip port [opcions del servidor ...]" % argv[0])
+        sys.exit()
+    return argv[1], int(argv[2]), argv[3:]
+
+
+def port_lliure(ip):
+    """ retorna un port de la ip que ara mateix està lliure """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as prova:
+        prova.bind((ip, 0))
+        return prova.getsockname()[1]
+
+
+def trama(missatge):
+    """ codifica el missatge dins d'una trama """
+    return protocol.codifica(missatge, protocol.PROTOCOL_TRAMES)
+
+
+def rep_exacte(connexio, mida):
+    """ rep exactament mida bytes de la connexió """
+    dades = b''
+    while len(dades) < mida:
+        tros = connexio.recv(mida - len(dades))
+        assert tros, "s'ha tancat la connexió"
+        dades += tros
+    return dades
+
+
+def rep_trama(connexio):
+    """ rep el missatge de la propera trama """
+    mida, = protocol.CAPCALERA.unpack(rep_exacte(connexio, protocol.CAPCALERA.size))
+    return rep_exacte(connexio, mida).decode("utf8")
+
+
+class Servidor:
+    """ servidor.py propi d'un test
+
+        S'arrenca a la ip i el port (0: un port lliure) amb les opcions, i
+        espera que accepti connexions. Si el test acaba sense haver-lo
+        finalitzat (per exemple, perquè ha fallat una comprovació), el mata
+        perquè no quedi en marxa.
+    """
+
+    def __init__(self, ip, port, opcions=()):
+        self.ip = ip
+        self.port = port or port_lliure(ip)
+        self.proces = subprocess.Popen([sys.executable, os.path.join(DIRECTORI_SRC, 'servidor.py'),
+                                        ip, str(self.port)] + list(opcions),
+                                       stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, cwd=DIRECTORI_SRC)
+        atexit.register(self.mata)
+        limit = time.monotonic() + MAXIM_ESPERA_SERVIDOR
+        while True:
+            assert self.proces.poll() is None, "el servidor no ha arrencat"
+            try:
+                socket.create_connection((ip, self.port), 1).close()
+                break
+            except OSError:
+                assert time.monotonic() < limit, "el servidor no accepta connexions"
+                time.sleep(0.05)
+        time.sleep(0.2)     # que el servidor alliberi la connexió de prova
+        logging.info("Arrencat el servidor a %s:%s" % (ip, self.port))
+
+    def demana_finalitzacio(self):
+        """ demana al servidor que finalitzi, sense esperar-lo """
+        self.proces.stdin.write(b"finalitza\n")
+        self.proces.stdin.flush()
+
+    def finalitza(self, espera=MAXIM_ESPERA_SERVIDOR):
+        """ demana al servidor que finalitzi i espera que acabi """
+        self.demana_finalitzacio()
+        self.proces.wait(espera)
+
+    def mata(self):
+        if self.proces.poll() is None:
+            self.proces.kill()
+            self.proces.wait()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""
+    Test del servidor de xat
+
+    Aquest test comprova que el servidor reenvia els missatges de seguida,
+    també el primer missatge després d'una estona sense activitat.
+
+    - entren un emissor i diversos receptors
+
+    - l'emissor envia missatges numerats, amb pauses de tant en tant
+
+    - cada receptor anota quant ha trigat a rebre cada missatge
+
+    - el percentil 99 del retard ha de ser de pocs mil·lisegons
+"""
+
+import sys
+import socket
+import logging
+import selectors
+import time
+import re
+
+MIDA_MISSATGE = 1024
+NOMBRE_RECEPTORS = 10
+NOMBRE_MISSATGES = 200
+CADA_QUANTS_PAUSA = 20      # cada quants missatges l'emissor fa una pausa
+PAUSA = 0.3                 # durada de la pausa (en segons)
+ENTRE_MISSATGES = 0.005     # temps entre dos missatges seguits (en segons)
+MAXIM_RETARD_P99 = 0.010    # retard màxim admès pel percentil 99 (en segons)
+
+logging.basicConfig(filename="client.py.log",
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s: %(message)s")
+logging.info("Arrenca el test 04")
+
+# Obté la IP i el port de connexió amb el servidor
+ip, port = sys.argv[1], int(sys.argv[2])
+
+
+def entra(nom):
+    """ connecta un participant amb el servidor i es descarta la benvinguda """
+    connexio = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    connexio.settimeout(2)
+    connexio.connect((ip, port))
+    connexio.send(bytes(nom, "utf8"))
+    connexio.recv(MIDA_MISSATGE)
+    time.sleep(0.1)     # que la benvinguda no es barregi amb altres missatges
+    return connexio
+
+
+receptors = [entra("receptor%s" % i) for i in range(NOMBRE_RECEPTORS)]
+emissor = entra("emissor")
+emissor.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)   # cada missatge surt de seguida
+logging.info("Connectats l'emissor i %s receptors" % NOMBRE_RECEPTORS)
+
+# descarta les notificacions d'entrada que hagin arribat
+time.sleep(0.5)
+selector = selectors.DefaultSelector()
+for receptor in receptors:
+    receptor.setblocking(False)
+    try:
+        while receptor.recv(MIDA_MISSATGE * 64):
+            pass
+    except BlockingIOError:
+        pass
+    selector.register(receptor, selectors.EVENT_READ)
+
+enviaments = dict()     # clau: número de missatge. valor: moment de l'enviament
+retards = []
+patro = re.compile(r"#(\d+)#")
+
+for numero in range(NOMBRE_MISSATGES):
+    if numero % CADA_QUANTS_PAUSA == 0:
+        limit = time.perf_counter() + PAUSA
+    else:
+        limit = time.perf_counter() + ENTRE_MISSATGES
+    # mentre esperem, recollim el que arribi als receptors
+    while True:
+        espera = limit - time.perf_counter()
+        if espera <= 0:
+            break
+        for clau, _ in selector.select(espera):
+            dades = clau.fileobj.recv(MIDA_MISSATGE * 64).decode("utf8")
+            ara = time.perf_counter()
+            for recepcio in patro.findall(dades):
+                retards.append(ara - enviaments[int(recepcio)])
+    enviaments[numero] = time.perf_counter()
+    emissor.send(bytes("#%s#" % numero, "utf8"))
+
+# recull els darrers missatges
+limit = time.perf_counter() + 1
+while len(retards) < NOMBRE_MISSATGES * NOMBRE_RECEPTORS and time.perf_counter() < limit:
+    for clau, _ in selector.select(0.1):
+        dades = clau.fileobj.recv(MIDA_MISSATGE * 64).decode("utf8")
+        ara = time.perf_counter()
+        for recepcio in patro.findall(dades):
+            retards.append(ara - enviaments[int(recepcio)])
+
+assert len(retards) == NOMBRE_MISSATGES * NOMBRE_RECEPTORS, "s'han perdut missatges: %s" % len(retards)
+retards.sort()
+p50 = retards[len(retards) // 2]
+p99 = retards[len(retards) * 99 // 100]
+logging.info("Retards: p50 %.2f ms, p99 %.2f ms, màxim %.2f ms" % (p50 * 1000, p99 * 1000, retards[-1] * 1000))
+assert p99 < MAXIM_RETARD_P99, "p99 de %.2f ms" % (p99 * 1000)
+
+for connexio in receptors + [emissor]:
+    connexio.setblocking(True)
+    connexio.send(bytes('{quit}', 'utf8'))
+    connexio.close()
+logging.info("Finalitzades les connexions")
+print("OK")
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+    Test del servidor de xat
+
+    Aquest test comprova que un participant que no llegeix mai els missatges
+    no endarrereix els missatges de la resta de participants.
+
+    - entra un participant lent, que no llegirà res
+
+    - entren un emissor i un receptor
+
+    - l'emissor envia molts missatges grans, molts més dels que caben a les
+      memòries intermèdies de la connexió del participant lent
+
+    - el receptor els ha de rebre tots i sense retards
+
+    Amb la política espera, el servidor atura expressament l'emissor mentre el
+    participant lent té la cua plena, així que aquest test s'ha de fer amb les
+    polítiques descarta o desconnecta.
+"""
+
+import sys
+import socket
+import logging
+import selectors
+import time
+import re
+
+MIDA_MISSATGE = 1024
+NOMBRE_MISSATGES = 6000
+MIDA_FARCIT = 900           # mida aproximada de cada missatge (en bytes)
+ENTRE_MISSATGES = 0.001     # temps entre dos missatges seguits (en segons)
+MAXIM_RETARD = 0.5          # retard màxim admès per a qualsevol missatge (en segons)
+
+logging.basicConfig(filename="client.py.log",
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s: %(message)s")
+logging.info("Arrenca el test 05")
+
+# Obté la IP i el port de connexió amb el servidor
+ip, port = sys.argv[1], int(sys.argv[2])
+
+
+def entra(nom, mida_recepcio=None):
+    """ connecta un participant amb el servidor i es descarta la benvinguda """
+    connexio = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if mida_recepcio:
+        connexio.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, mida_recepcio)
+    connexio.settimeout(2)
+    connexio.connect((ip, port))
+    connexio.send(bytes(nom, "utf8"))
+    connexio.recv(MIDA_MISSATGE)
+    time.sleep(0.1)     # que la benvinguda no es barregi amb altres missatges
+    return connexio
+
+
+lent = entra("lent", mida_recepcio=1024)
+receptor = entra("receptor")
+emissor = entra("emissor")
+emissor.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)   # cada missatge surt de seguida
+logging.info("Connectats el participant lent, l'emissor i el receptor")
+
+# descarta les notificacions d'entrada que hagin arribat al receptor
+time.sleep(0.5)
+receptor.setblocking(False)
+try:
+    while receptor.recv(MIDA_MISSATGE * 64):
+        pass
+except BlockingIOError:
+    pass
+selector = selectors.DefaultSelector()
+selector.register(receptor, selectors.EVENT_READ)
+
+enviaments = dict()     # clau: número de missatge. valor: moment de l'enviament
+retards = []
+patro = re.compile(r"#(\d+)#")
+farcit = "x" * MIDA_FARCIT
+pendent = ""            # tros de missatge rebut que encara no es pot interpretar
+
+
+def recull(espera):
+    """ recull el que arribi al receptor durant com a molt espera segons """
+    global pendent
+    for clau, _ in selector.select(espera):
+        pendent += clau.fileobj.recv(MIDA_MISSATGE * 64).decode("utf8")
+        ara = time.perf_counter()
+        final = 0
+        for recepcio in patro.finditer(pendent):
+            retards.append(ara - enviaments[int(recepcio.group(1))])
+            final = recepcio.end()
+        pendent = pendent[final:]
+
+
+for numero in range(NOMBRE_MISSATGES):
+    limit = time.perf_counter() + ENTRE_MISSATGES
+    while time.perf_counter() < limit:
+        recull(max(0, limit - time.perf_counter()))
+    enviaments[numero] = time.perf_counter()
+    emissor.send(bytes("%s#%s#" % (farcit, numero), "utf8"))
+
+# recull els darrers missatges
+limit = time.perf_counter() + 2
+while len(retards) < NOMBRE_MISSATGES and time.perf_counter() < limit:
+    recull(0.1)
+
+assert len(retards) == NOMBRE_MISSATGES, "s'han perdut missatges: %s" % len(retards)
+logging.info("Retard màxim amb un participant lent: %.2f ms" % (max(retards) * 1000))
+assert max(retards) < MAXIM_RETARD, "retard màxim de %.2f ms" % (max(retards) * 1000)
+
+for connexio in [receptor, emissor]:
+    connexio.setblocking(True)
+    connexio.send(bytes('{quit}', 'utf8'))
+    connexio.close()
+lent.close()
+logging.info("Finalitzades les connexions")
+print("OK")
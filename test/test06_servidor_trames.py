@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+    Test del servidor de xat
+
+    Aquest test comprova el protocol de trames: cada missatge viatja amb
+    quatre bytes al davant que n'indiquen la mida.
+
+    - p1 i p2 entren amb trames, i un participant antic entra amb text
+
+    - p1 envia de cop molts missatges, un de molt llarg amb caràcters de més
+      d'un byte, i {quit}
+
+    - p2 els ha de rebre tots, sencers i en ordre, i després la notificació
+      d'abandonament de p1
+
+    - el participant antic també rep la notificació d'abandonament
+"""
+
+import sys
+import socket
+import logging
+
+import eines
+import protocol
+
+MIDA_MISSATGE = 1024
+NOMBRE_MISSATGES = 50
+
+logging.basicConfig(filename="client.py.log",
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s: %(message)s")
+logging.info("Arrenca el test 06")
+
+# Obté la IP i el port de connexió amb el servidor
+ip, port = sys.argv[1], int(sys.argv[2])
+
+
+def entra_amb_trames(nom):
+    connexio = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    connexio.settimeout(2)
+    connexio.connect((ip, port))
+    connexio.sendall(protocol.SALUTACIO + eines.trama(nom))
+    assert eines.rep_exacte(connexio, len(protocol.SALUTACIO)) == protocol.SALUTACIO
+    benvinguda = eines.rep_trama(connexio)
+    assert benvinguda.startswith("Hola %s." % nom), benvinguda
+    return connexio
+
+
+# p1 entra
+connexio1 = entra_amb_trames("p1")
+logging.info("p1 ha entrat amb trames")
+
+# el participant antic entra
+antic = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+antic.settimeout(2)
+antic.connect((ip, port))
+antic.send(bytes("antic", "utf8"))
+benvinguda = antic.recv(MIDA_MISSATGE).decode("utf8").strip()
+assert benvinguda == "Hola antic. Acabes d'entrar a la sala de xat de Fanjac. De moment hi ha 2 participants"
+logging.info("El participant antic ha entrat amb text")
+
+# p2 entra
+connexio2 = entra_amb_trames("p2")
+logging.info("p2 ha entrat amb trames")
+
+# p1 envia tots els missatges de cop
+missatges = ["missatge %s" % numero for numero in range(NOMBRE_MISSATGES)]
+missatges.insert(NOMBRE_MISSATGES // 2, "llarg " + "à" * 20000)
+connexio1.sendall(b''.join(eines.trama(missatge) for missatge in missatges) + eines.trama("{quit}"))
+logging.info("p1 ha enviat %s missatges i {quit}" % len(missatges))
+
+# p2 rep els missatges
+for missatge in missatges:
+    rebut = eines.rep_trama(connexio2)
+    assert rebut == "[p1] %s" % missatge, rebut[:80]
+logging.info("p2 ha rebut tots els missatges")
+assert eines.rep_trama(connexio2) == "p1 abandona la sala de xat"
+logging.info("p2 ha rebut la notificació d'abandonament de p1")
+
+# el participant antic rep els mateixos missatges en text
+rebut = b''
+while "p1 abandona la sala de xat" not in rebut.decode("utf8", "replace"):
+    tros = antic.recv(MIDA_MISSATGE * 64)
+    assert tros, "s'ha tancat la connexió"
+    rebut += tros
+logging.info("El participant antic ha rebut la notificació d'abandonament de p1")
+
+# surten p2 i el participant antic
+connexio2.sendall(eines.trama("{quit}"))
+antic.send(bytes("{quit}", "utf8"))
+
+connexio1.close()
+connexio2.close()
+antic.close()
+logging.info("Finalitzades les connexions")
+print("OK")
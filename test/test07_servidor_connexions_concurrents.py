@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+"""
+    Test del servidor de xat
+
+    Aquest test comprova que el registre de participants aguanta que molts
+    participants entrin i surtin alhora.
+
+    - diversos fils connecten participants un rere l'altre. Cada participant
+      rep la benvinguda i després surt amb {quit} o bé tanca la connexió de cop
+
+    - quan tots han acabat, un nou participant ha de trobar la sala buida: el
+      servidor no s'ha deixat cap participant ni n'ha perdut cap pel camí
+"""
+
+import sys
+import socket
+import logging
+import threading
+import time
+
+MIDA_MISSATGE = 1024
+NOMBRE_FILS = 10
+CICLES_PER_FIL = 30
+MAXIM_ESPERA_BUIDA = 10     # temps màxim perquè el servidor buidi la sala (en segons)
+
+logging.basicConfig(filename="client.py.log",
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s: %(message)s")
+logging.info("Arrenca el test 07")
+
+# Obté la IP i el port de connexió amb el servidor
+ip, port = sys.argv[1], int(sys.argv[2])
+
+
+def entra(nom):
+    """ connecta un participant amb el servidor i en retorna la connexió i la benvinguda """
+    connexio = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    connexio.settimeout(5)
+    connexio.connect((ip, port))
+    connexio.send(bytes(nom, "utf8"))
+    benvinguda = connexio.recv(MIDA_MISSATGE).decode("utf8")
+    return connexio, benvinguda
+
+
+def entra_i_surt(numero_fil, errors):
+    """ connecta i desconnecta participants un rere l'altre """
+    try:
+        for cicle in range(CICLES_PER_FIL):
+            nom = "p%s_%s" % (numero_fil, cicle)
+            connexio, benvinguda = entra(nom)
+            assert benvinguda.startswith("Hola %s." % nom), benvinguda
+            if cicle % 2 == 0:
+                connexio.send(bytes("{quit}", "utf8"))
+            connexio.close()
+    except (OSError, AssertionError) as e:
+        errors.append(e)
+
+
+errors = []
+fils = [threading.Thread(target=entra_i_surt, args=(numero, errors)) for numero in range(NOMBRE_FILS)]
+for fil in fils:
+    fil.start()
+for fil in fils:
+    fil.join()
+assert not errors, errors
+logging.info("Han entrat i sortit %s participants" % (NOMBRE_FILS * CICLES_PER_FIL))
+
+# un nou participant ha de trobar la sala buida
+limit = time.monotonic() + MAXIM_ESPERA_BUIDA
+while True:
+    connexio, benvinguda = entra("darrer")
+    if benvinguda.startswith("Hola darrer. Acabes d'entrar a la sala de xat de Fanjac. De moment hi ha 1 participants"):
+        break
+    connexio.send(bytes("{quit}", "utf8"))
+    connexio.close()
+    assert time.monotonic() < limit, benvinguda
+    time.sleep(0.5)
+logging.info("El darrer participant ha trobat la sala buida")
+
+connexio.send(bytes("{quit}", "utf8"))
+connexio.close()
+logging.info("Finalitzades les connexions")
+print("OK")
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+"""
+    Test del servidor de xat
+
+    Aquest test comprova les sales de xat.
+
+    - a, b i c entren a la sala principal
+    - a i b entren a la sala jocs. Els missatges que s'hi envien no arriben a c
+    - a torna a parlar a la sala principal i els seus missatges arriben a tothom
+    - b surt de la sala jocs, i no pot sortir de la principal perquè és l'única
+      on és
+    - a surt del xat: b i c reben una sola notificació tot i que a era a dues
+      sales
+"""
+
+import sys
+import socket
+import logging
+
+import eines
+import protocol
+
+logging.basicConfig(filename="client.py.log",
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s: %(message)s")
+logging.info("Arrenca el test 08")
+
+# Obté la IP i el port de connexió amb el servidor
+ip, port = sys.argv[1], int(sys.argv[2])
+
+
+def espera(connexio, esperat):
+    """ comprova que el proper missatge de la connexió és l'esperat """
+    rebut = eines.rep_trama(connexio)
+    assert rebut == esperat, "esperat '%s' però rebut '%s'" % (esperat, rebut)
+
+
+def entra(nom, nombre):
+    connexio = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    connexio.settimeout(2)
+    connexio.connect((ip, port))
+    connexio.sendall(protocol.SALUTACIO + eines.trama(nom))
+    assert eines.rep_exacte(connexio, len(protocol.SALUTACIO)) == protocol.SALUTACIO
+    espera(connexio, "Hola %s. Acabes d'entrar a la sala de xat de Fanjac. De moment hi ha %s participants" % (nom, nombre))
+    return connexio
+
+
+# tots entren a la sala principal
+a = entra("a", 1)
+b = entra("b", 2)
+espera(a, "S'ha afegit b. Ara ja sou 2 participants")
+c = entra("c", 3)
+espera(a, "S'ha afegit c. Ara ja sou 3 participants")
+espera(b, "S'ha afegit c. Ara ja sou 3 participants")
+logging.info("a, b i c han entrat a la sala principal")
+
+# a i b entren a la sala jocs
+a.sendall(eines.trama("{entra jocs}"))
+espera(a, "Ara parles a la sala jocs. Hi ha 1 participants")
+b.sendall(eines.trama("{entra jocs}"))
+espera(b, "Ara parles a la sala jocs. Hi ha 2 participants")
+espera(a, "b entra a la sala jocs. Ara hi sou 2 participants")
+logging.info("a i b han entrat a la sala jocs")
+
+# els missatges de la sala jocs només arriben als seus membres
+a.sendall(eines.trama("hola jocs"))
+espera(b, "[a@jocs] hola jocs")
+
+# a torna a parlar a la sala principal
+a.sendall(eines.trama("{canvia principal}"))
+espera(a, "Ara parles a la sala principal. Hi ha 3 participants")
+a.sendall(eines.trama("hola tothom"))
+espera(b, "[a] hola tothom")
+espera(c, "[a] hola tothom")
+logging.info("Els missatges arriben només a la sala on parla a")
+
+# b surt de la sala jocs, però no pot sortir de la principal
+b.sendall(eines.trama("{surt jocs}"))
+espera(b, "Has sortit de la sala jocs. Ara parles a la sala principal. Hi ha 3 participants")
+espera(a, "b surt de la sala jocs")
+b.sendall(eines.trama("{surt}"))
+espera(b, "No pots sortir de l'única sala on ets")
+
+# consulta i errors de a
+a.sendall(eines.trama("{sales}"))
+espera(a, "Ets a les sales: principal (3) *, jocs (1)")
+a.sendall(eines.trama("{canvia enlloc}"))
+espera(a, "No ets a la sala enlloc")
+logging.info("Comandes de sales correctes")
+
+# a surt del xat: una sola notificació per a cadascú
+a.sendall(eines.trama("{quit}"))
+espera(b, "a abandona la sala de xat")
+espera(c, "a abandona la sala de xat")
+b.sendall(eines.trama("darrer"))
+espera(c, "[b] darrer")
+logging.info("b i c han rebut una sola notificació de sortida de a")
+
+b.sendall(eines.trama("{quit}"))
+espera(c, "b abandona la sala de xat")
+c.sendall(eines.trama("{quit}"))
+
+a.close()
+b.close()
+c.close()
+logging.info("Finalitzades les connexions")
+print("OK")
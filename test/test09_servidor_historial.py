@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+"""
+    Test del servidor de xat
+
+    Aquest test comprova l'historial de les sales de xat, amb l'historial
+    activat (opció per defecte del servidor).
+
+    - a entra a la sala llibres i hi envia tres missatges
+    - a demana l'historial sencer, els darrers missatges i els posteriors a
+      una seqüència
+    - b entra a la sala llibres i l'historial inclou el missatge que a hi envia
+"""
+
+import sys
+import socket
+import logging
+
+import eines
+import protocol
+
+logging.basicConfig(filename="client.py.log",
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s: %(message)s")
+logging.info("Arrenca el test 09")
+
+# Obté la IP i el port de connexió amb el servidor
+ip, port = sys.argv[1], int(sys.argv[2])
+
+
+def espera(connexio, esperat):
+    """ comprova que el proper missatge de la connexió és l'esperat """
+    rebut = eines.rep_trama(connexio)
+    assert rebut == esperat, "esperat '%s' però rebut '%s'" % (esperat, rebut)
+
+
+def entra(nom, nombre):
+    connexio = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    connexio.settimeout(2)
+    connexio.connect((ip, port))
+    connexio.sendall(protocol.SALUTACIO + eines.trama(nom))
+    assert eines.rep_exacte(connexio, len(protocol.SALUTACIO)) == protocol.SALUTACIO
+    espera(connexio, "Hola %s. Acabes d'entrar a la sala de xat de Fanjac. De moment hi ha %s participants" % (nom, nombre))
+    return connexio
+
+
+def espera_historial(connexio, primer, missatges):
+    """ comprova que arriba l'historial de la sala llibres amb els missatges indicats """
+    espera(connexio, "Historial de la sala llibres (#%s a #%s):" % (primer, primer + len(missatges) - 1))
+    for missatge in missatges:
+        espera(connexio, "[a@llibres] %s" % missatge)
+
+
+a = entra("a", 1)
+b = entra("b", 2)
+espera(a, "S'ha afegit b. Ara ja sou 2 participants")
+
+# a envia tres missatges a la sala llibres
+a.sendall(eines.trama("{entra llibres}"))
+espera(a, "Ara parles a la sala llibres. Hi ha 1 participants")
+a.sendall(eines.trama("u") + eines.trama("dos") + eines.trama("tres"))
+logging.info("a ha enviat tres missatges a la sala llibres")
+
+# consultes de l'historial
+a.sendall(eines.trama("{historial}"))
+espera_historial(a, 1, ["u", "dos", "tres"])
+a.sendall(eines.trama("{historial 2}"))
+espera_historial(a, 2, ["dos", "tres"])
+a.sendall(eines.trama("{historial #2}"))
+espera_historial(a, 3, ["tres"])
+a.sendall(eines.trama("{historial #3}"))
+espera(a, "No hi ha historial a la sala llibres")
+a.sendall(eines.trama("{historial molts}"))
+espera(a, "Cal indicar quants missatges: {historial N}, o des de quin: {historial #N}")
+logging.info("Consultes de l'historial correctes")
+
+# b entra a la sala i rep l'historial del missatge que s'hi envia després
+b.sendall(eines.trama("{entra llibres}"))
+espera(b, "Ara parles a la sala llibres. Hi ha 2 participants")
+espera(a, "b entra a la sala llibres. Ara hi sou 2 participants")
+a.sendall(eines.trama("quatre"))
+espera(b, "[a@llibres] quatre")
+b.sendall(eines.trama("{historial 1}"))
+capcalera = eines.rep_trama(b)
+assert capcalera.startswith("Historial de la sala llibres (#"), "capçalera incorrecta '%s'" % capcalera
+espera(b, "[a@llibres] quatre")
+logging.info("b rep l'historial de la sala llibres")
+
+a.sendall(eines.trama("{quit}"))
+espera(b, "a abandona la sala de xat")
+b.sendall(eines.trama("{quit}"))
+
+a.close()
+b.close()
+logging.info("Finalitzades les connexions")
+print("OK")
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""
+    Test del servidor de xat
+
+    Aquest test comprova que el servidor finalitza de pressa encara que tingui
+    molts participants connectats.
+
+    - arrenca un servidor.py propi a la ip i el port indicats, perquè cal
+      poder-li demanar que finalitzi des de la consola
+
+    - hi connecta NOMBRE_PARTICIPANTS participants
+
+    - demana la finalització i comprova que tots els participants reben
+      {quit} com a darrer missatge i veuen tancada la connexió, i que el
+      servidor acaba, en menys de MAXIM_FINALITZACIO segons
+
+    Ús: test10_servidor_finalitzacio.py ip port [opcions del servidor ...]
+"""
+
+import sys
+import socket
+import logging
+import selectors
+import time
+
+import eines
+import protocol
+
+NOMBRE_PARTICIPANTS = 500
+MAXIM_FINALITZACIO = 1.0    # temps màxim per finalitzar (en segons)
+MAXIM_ESPERA = 10           # temps màxim de cada fase del test (en segons)
+
+logging.basicConfig(filename="client.py.log",
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s: %(message)s")
+logging.info("Arrenca el test 10")
+
+
+def missatges(dades):
+    """ retorna la llista de missatges de les trames rebudes després de la salutació """
+    assert dades.startswith(protocol.SALUTACIO), "no s'ha rebut la salutació"
+    resultat = []
+    posicio = len(protocol.SALUTACIO)
+    while posicio + protocol.CAPCALERA.size <= len(dades):
+        mida, = protocol.CAPCALERA.unpack_from(dades, posicio)
+        posicio += protocol.CAPCALERA.size
+        resultat.append(dades[posicio:posicio + mida].decode("utf8"))
+        posicio += mida
+    assert posicio == len(dades), "trama incompleta"
+    return resultat
+
+
+# arrenca el servidor
+ip, port, opcions = eines.obte_adressa(sys.argv)
+servidor = eines.Servidor(ip, port, opcions)
+
+# connecta els participants. Cadascun espera la benvinguda abans que entri el següent
+rebut = dict()      # clau: connexió. valor: dades rebudes
+selector = selectors.DefaultSelector()
+for numero in range(NOMBRE_PARTICIPANTS):
+    connexio = socket.create_connection((ip, servidor.port), MAXIM_ESPERA)
+    connexio.sendall(protocol.SALUTACIO + eines.trama("p%s" % numero))
+    dades = b''
+    while len(dades) < len(protocol.SALUTACIO) + protocol.CAPCALERA.size:
+        dades += connexio.recv(4096)
+    rebut[connexio] = dades
+    connexio.setblocking(False)
+    selector.register(connexio, selectors.EVENT_READ)
+logging.info("Connectats %s participants" % NOMBRE_PARTICIPANTS)
+
+# demana la finalització i espera que totes les connexions es tanquin
+inici = time.monotonic()
+servidor.demana_finalitzacio()
+oberts = len(rebut)
+limit = inici + MAXIM_ESPERA
+while oberts and time.monotonic() < limit:
+    for clau, _ in selector.select(limit - time.monotonic()):
+        try:
+            dades = clau.fileobj.recv(65536)
+        except BlockingIOError:
+            continue
+        except OSError:
+            dades = b''
+        if dades:
+            rebut[clau.fileobj] += dades
+        else:
+            selector.unregister(clau.fileobj)
+            oberts -= 1
+tancament = time.monotonic() - inici
+assert oberts == 0, "%s participants no han vist tancada la connexió" % oberts
+servidor.proces.wait(MAXIM_ESPERA)
+finalitzacio = time.monotonic() - inici
+logging.info("Connexions tancades en %.3f s i servidor finalitzat en %.3f s" % (tancament, finalitzacio))
+
+for connexio, dades in rebut.items():
+    assert missatges(dades)[-1] == "{quit}", "un participant no ha rebut {quit}"
+    connexio.close()
+assert finalitzacio < MAXIM_FINALITZACIO, "el servidor ha trigat %.3f s a finalitzar" % finalitzacio
+logging.info("Finalitzades les connexions")
+print("OK")
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+"""
+    Test del servidor de xat
+
+    Aquest test comprova que el servidor limita el cabal de cada participant
+    sense endarrerir els que envien a un ritme normal.
+
+    - arrenca un servidor.py propi a la ip i el port indicats amb un límit de
+      LIMIT_MISSATGES missatges per segon per participant, primer amb l'acció
+      descarta i després amb l'acció espera
+
+    - connecta un participant que escolta, un que inunda la sala enviant
+      INUNDACIO missatges de cop i un que envia missatges normals
+
+    - amb descarta, comprova que de la inundació només arriben els missatges
+      que permet el límit, que l'inundador rep un sol avís, i que el missatge
+      normal arriba de seguida
+
+    - amb espera, comprova que arriben tots els missatges de la inundació, en
+      ordre i al ritme del límit, i que el missatge normal arriba de seguida
+      encara que la inundació no hagi acabat
+
+    Ús: test11_servidor_cabal.py ip port [opcions del servidor ...]
+"""
+
+import sys
+import socket
+import logging
+import time
+
+import eines
+import protocol
+
+LIMIT_MISSATGES = 50    # missatges per segon de cada participant
+RAFEGA = 2              # segons de cabal que admet el servidor de cop (cabal.RAFEGA)
+INUNDACIO = 300         # missatges que envia l'inundador de cop
+MAXIM_RETARD = 0.5      # retard màxim del missatge normal (en segons)
+MAXIM_ESPERA = 10       # temps màxim de cada fase del test (en segons)
+
+logging.basicConfig(filename="client.py.log",
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s: %(message)s")
+logging.info("Arrenca el test 11")
+
+
+class Participant:
+    """ Participant de prova que parla el protocol de trames """
+
+    def __init__(self, servidor, nom):
+        self.connexio = socket.create_connection((servidor.ip, servidor.port), MAXIM_ESPERA)
+        self.dades = b''
+        self.pendents = []      # missatges rebuts que rep_fins() encara no ha retornat
+        self.connexio.sendall(protocol.SALUTACIO + eines.trama(nom))
+        assert self.rep_fins(lambda missatge: missatge.startswith("Hola")), "no s'ha rebut la benvinguda"
+
+    def envia(self, *missatges):
+        self.connexio.sendall(b''.join(eines.trama(missatge) for missatge in missatges))
+
+    def rep(self, espera):
+        """ retorna la llista de missatges que arriben en com a molt espera segons """
+        if self.pendents:
+            missatges, self.pendents = self.pendents, []
+            return missatges
+        self.connexio.settimeout(max(espera, 0.001))
+        try:
+            self.dades += self.connexio.recv(65536)
+        except socket.timeout:
+            pass
+        if self.dades.startswith(protocol.SALUTACIO):
+            self.dades = self.dades[len(protocol.SALUTACIO):]
+        missatges = []
+        mida_capcalera = protocol.CAPCALERA.size
+        while len(self.dades) >= mida_capcalera:
+            mida, = protocol.CAPCALERA.unpack_from(self.dades)
+            if len(self.dades) < mida_capcalera + mida:
+                break
+            missatges.append(self.dades[mida_capcalera:mida_capcalera + mida].decode("utf8"))
+            self.dades = self.dades[mida_capcalera + mida:]
+        return missatges
+
+    def rep_fins(self, condicio, espera=MAXIM_ESPERA):
+        """ rep missatges fins que un compleix la condició. Retorna la llista
+            dels rebuts fins aquest, o None si no n'arriba cap a temps """
+        rebuts = []
+        limit = time.monotonic() + espera
+        while time.monotonic() < limit:
+            missatges = self.rep(limit - time.monotonic())
+            for posicio, missatge in enumerate(missatges):
+                rebuts.append(missatge)
+                if condicio(missatge):
+                    self.pendents = missatges[posicio + 1:]
+                    return rebuts
+        return None
+
+    def tanca(self):
+        self.connexio.close()
+
+
+def inunda(exces):
+    """ inunda la sala amb el servidor limitat i l'acció exces. Retorna
+        (temps de la inundació, retard del missatge normal, missatges de
+        l'inundador que rep l'oient, avisos que rep l'inundador) """
+    servidor = eines.Servidor(ip, port, ["--missatges_segon=%s" % LIMIT_MISSATGES, "--exces=%s" % exces]
+                              + opcions)
+    oient = Participant(servidor, "oient")
+    inundador = Participant(servidor, "inundador")
+    normal = Participant(servidor, "normal")
+    oient.rep(0.2)      # notificacions d'entrada
+
+    inici = time.monotonic()
+    inundador.envia(*("inundacio %s" % numero for numero in range(INUNDACIO)))
+    time.sleep(0.2)
+    enviament = time.monotonic()
+    normal.envia("missatge normal")
+    rebuts = oient.rep_fins(lambda missatge: missatge == "[normal] missatge normal")
+    assert rebuts is not None, "no ha arribat el missatge normal (%s)" % exces
+    retard = time.monotonic() - enviament
+    if exces == "espera":
+        resta = oient.rep_fins(lambda missatge: missatge == "[inundador] inundacio %s" % (INUNDACIO - 1))
+        assert resta is not None, "no han arribat tots els missatges de la inundació"
+        rebuts += resta
+    else:
+        rebuts += oient.rep(1)
+    durada = time.monotonic() - inici
+    avisos = []
+    missatges = inundador.rep(0.2)
+    while missatges:
+        avisos += [missatge for missatge in missatges if missatge.startswith("Envies massa")]
+        missatges = inundador.rep(0.2)
+
+    for participant in (oient, inundador, normal):
+        participant.tanca()
+    servidor.finalitza()
+    return durada, retard, [missatge for missatge in rebuts if missatge.startswith("[inundador]")], avisos
+
+
+ip, port, opcions = eines.obte_adressa(sys.argv)
+
+# descarta: només arriben els missatges que permet el límit
+durada, retard, rebuts, avisos = inunda("descarta")
+logging.info("Descarta: rebuts %s missatges de %s en %.3f s. Retard del normal %.3f s"
+             % (len(rebuts), INUNDACIO, durada, retard))
+maxim = LIMIT_MISSATGES * (RAFEGA + durada) + 1
+assert len(rebuts) <= maxim, "han arribat %s missatges de la inundació (màxim %s)" % (len(rebuts), maxim)
+assert len(rebuts) < INUNDACIO, "no s'ha descartat cap missatge de la inundació"
+assert retard < MAXIM_RETARD, "el missatge normal ha trigat %.3f s" % retard
+assert len(avisos) == 1, "l'inundador ha rebut %s avisos" % len(avisos)
+
+# espera: arriben tots, en ordre i al ritme del límit
+durada, retard, rebuts, avisos = inunda("espera")
+logging.info("Espera: rebuts %s missatges de %s en %.3f s. Retard del normal %.3f s"
+             % (len(rebuts), INUNDACIO, durada, retard))
+assert rebuts == ["[inundador] inundacio %s" % numero for numero in range(INUNDACIO)], \
+    "els missatges de la inundació no han arribat tots i en ordre"
+minim = (INUNDACIO - LIMIT_MISSATGES * RAFEGA) / LIMIT_MISSATGES * 0.9
+assert durada >= minim, "la inundació ha durat %.3f s (mínim %.3f s)" % (durada, minim)
+assert retard < MAXIM_RETARD, "el missatge normal ha trigat %.3f s" % retard
+assert not avisos, "l'inundador ha rebut avisos sense que se li descarti res"
+
+logging.info("Finalitzat el test de cabal")
+print("OK")
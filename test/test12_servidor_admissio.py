@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+"""
+    Test del servidor de xat
+
+    Aquest test comprova que el servidor limita les connexions obertes i
+    tanca les que no envien el nom a temps.
+
+    - arrenca un servidor.py propi a la ip i el port indicats, amb un màxim de
+      MAXIM_CONNEXIONS connexions en total i MAXIM_CONNEXIONS_IP per adreça
+      IP. Les connexions surten de diverses adreces de 127.0.0.0/8, que són
+      totes locals, de manera que el servidor ha d'escoltar a 127.0.0.1
+
+    - comprova que una adreça no pot obrir més de MAXIM_CONNEXIONS_IP
+      connexions, que entre totes no se'n poden obrir més de MAXIM_CONNEXIONS,
+      i que quan se'n tanquen es tornen a admetre connexions noves
+
+    - comprova que el servidor tanca, poc després de ESPERA_NOM segons, tant
+      una connexió que no envia res com una que envia el nom a trossos sense
+      acabar-lo mai
+
+    Amb --processos=N cada procés aplica els límits a les seves connexions,
+    de manera que el test només té sentit amb un sol procés.
+
+    Ús: test12_servidor_admissio.py ip port [opcions del servidor ...]
+"""
+
+import sys
+import socket
+import logging
+import time
+
+import eines
+import protocol
+
+MAXIM_CONNEXIONS = 30
+MAXIM_CONNEXIONS_IP = 10
+ESPERA_NOM = 0.5        # temps màxim per enviar el nom (en segons)
+MARGE = 1.0             # marge per tancar les connexions sense nom (en segons)
+MAXIM_ESPERA = 10       # temps màxim de cada fase del test (en segons)
+
+logging.basicConfig(filename="client.py.log",
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s: %(message)s")
+logging.info("Arrenca el test 12")
+
+
+def connecta(origen, nom):
+    """ obre una connexió des de l'adreça origen i envia el nom. Retorna la
+        connexió si el servidor l'admet i envia la benvinguda, o None si la
+        tanca """
+    connexio = socket.create_connection((ip, servidor.port), MAXIM_ESPERA, source_address=(origen, 0))
+    try:
+        connexio.sendall(protocol.SALUTACIO + eines.trama(nom))
+        dades = connexio.recv(4096)
+    except OSError:
+        dades = b''
+    if not dades:
+        connexio.close()
+        return None
+    assert dades.startswith(protocol.SALUTACIO), "no s'ha rebut la salutació"
+    return connexio
+
+
+def connecta_moltes(origen, nombre):
+    """ intenta obrir nombre connexions des de l'adreça origen. Retorna la
+        llista de les admeses """
+    admeses = []
+    for numero in range(nombre):
+        connexio = connecta(origen, "%s_%s" % (origen, numero))
+        if connexio is not None:
+            admeses.append(connexio)
+    return admeses
+
+
+def espera_tancament(connexio):
+    """ retorna quants segons triga el servidor a tancar la connexió """
+    inici = time.monotonic()
+    connexio.settimeout(MAXIM_ESPERA)
+    try:
+        while connexio.recv(4096):
+            pass
+    except OSError:
+        pass
+    return time.monotonic() - inici
+
+
+# arrenca el servidor
+ip, port, opcions = eines.obte_adressa(sys.argv)
+servidor = eines.Servidor(ip, port, ["--connexions=%s" % MAXIM_CONNEXIONS,
+                                     "--connexions_ip=%s" % MAXIM_CONNEXIONS_IP,
+                                     "--espera_nom=%s" % ESPERA_NOM] + opcions)
+
+# límit per adreça IP
+primeres = connecta_moltes('127.0.0.1', MAXIM_CONNEXIONS_IP + 5)
+assert len(primeres) == MAXIM_CONNEXIONS_IP, \
+    "s'han admès %s connexions de la mateixa adreça" % len(primeres)
+
+# límit total
+altres = []
+for origen in ('127.0.0.2', '127.0.0.3', '127.0.0.4'):
+    altres += connecta_moltes(origen, MAXIM_CONNEXIONS_IP)
+assert len(primeres) + len(altres) == MAXIM_CONNEXIONS, \
+    "s'han admès %s connexions en total" % (len(primeres) + len(altres))
+logging.info("Admeses %s connexions de %s" % (len(primeres) + len(altres), 4 * MAXIM_CONNEXIONS_IP + 5))
+
+# en tancar-ne, se n'admeten de noves
+for connexio in primeres:
+    connexio.sendall(eines.trama("{quit}"))
+    connexio.close()
+limit = time.monotonic() + MAXIM_ESPERA
+noves = []
+while len(noves) < MAXIM_CONNEXIONS_IP and time.monotonic() < limit:
+    noves += connecta_moltes('127.0.0.4', MAXIM_CONNEXIONS_IP - len(noves))
+    time.sleep(0.05)
+assert len(noves) == MAXIM_CONNEXIONS_IP, "només s'han admès %s connexions noves" % len(noves)
+for connexio in altres + noves:
+    connexio.close()
+logging.info("Admeses les connexions noves")
+
+# temps màxim per enviar el nom
+time.sleep(0.2)
+muda = socket.create_connection((ip, servidor.port), MAXIM_ESPERA, source_address=('127.0.0.5', 0))
+lenta = socket.create_connection((ip, servidor.port), MAXIM_ESPERA, source_address=('127.0.0.6', 0))
+lenta.sendall(protocol.SALUTACIO)
+inici = time.monotonic()
+nom = eines.trama("lenta_" + "x" * 100)
+for posicio in range(len(nom)):
+    try:
+        lenta.sendall(nom[posicio:posicio + 1])
+    except OSError:
+        break
+    lenta.settimeout(0.1)
+    try:
+        if not lenta.recv(4096):
+            break
+    except socket.timeout:
+        pass
+    except OSError:
+        break
+durada_lenta = time.monotonic() - inici
+durada_muda = espera_tancament(muda) + durada_lenta
+logging.info("Connexions sense nom tancades en %.3f s (muda) i %.3f s (lenta)" % (durada_muda, durada_lenta))
+assert durada_lenta < ESPERA_NOM + MARGE, "la connexió lenta s'ha tancat en %.3f s" % durada_lenta
+assert durada_muda < ESPERA_NOM + MARGE, "la connexió muda s'ha tancat en %.3f s" % durada_muda
+muda.close()
+lenta.close()
+
+servidor.finalitza()
+logging.info("Finalitzat el test d'admissió")
+print("OK")
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+"""
+    Test del servidor de xat
+
+    Aquest test comprova que el servidor envia batecs als participants que no
+    envien res i desconnecta els que no hi responen.
+
+    - arrenca un servidor.py propi a la ip i el port indicats amb un batec
+      de BATEC segons
+
+    - connecta un participant mut, que no respon mai, i un que respon cada
+      batec amb {pong}
+
+    - comprova que el participant mut rep batecs i que el servidor el
+      desconnecta poc després de BATECS_SENSE_RESPOSTA + 1 batecs
+
+    - comprova que el participant que respon continua connectat, i que el
+      servidor respon {pong} quan un participant li envia {ping}
+
+    Ús: test13_servidor_batecs.py ip port [opcions del servidor ...]
+"""
+
+import sys
+import socket
+import logging
+import time
+
+import eines
+import protocol
+
+BATEC = 0.3                 # segons sense rebre res abans d'enviar un batec
+BATECS_SENSE_RESPOSTA = 2   # batecs sense resposta abans de desconnectar (protocol.BATECS_SENSE_RESPOSTA)
+MARGE = 1.0                 # marge per desconnectar el participant mut (en segons)
+MAXIM_ESPERA = 10           # temps màxim de cada fase del test (en segons)
+
+logging.basicConfig(filename="client.py.log",
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s: %(message)s")
+logging.info("Arrenca el test 13")
+
+
+class Participant:
+    """ Participant de prova que parla el protocol de trames """
+
+    def __init__(self, servidor, nom):
+        self.connexio = socket.create_connection((servidor.ip, servidor.port), MAXIM_ESPERA)
+        self.dades = b''
+        self.connexio.sendall(protocol.SALUTACIO + eines.trama(nom))
+
+    def envia(self, missatge):
+        self.connexio.sendall(eines.trama(missatge))
+
+    def rep(self, espera):
+        """ retorna la llista de missatges que arriben en com a molt espera
+            segons, o None si el servidor ha tancat la connexió """
+        self.connexio.settimeout(max(espera, 0.001))
+        try:
+            dades = self.connexio.recv(65536)
+            if not dades:
+                return None
+            self.dades += dades
+        except socket.timeout:
+            pass
+        except OSError:
+            return None
+        if self.dades.startswith(protocol.SALUTACIO):
+            self.dades = self.dades[len(protocol.SALUTACIO):]
+        missatges = []
+        mida_capcalera = protocol.CAPCALERA.size
+        while len(self.dades) >= mida_capcalera:
+            mida, = protocol.CAPCALERA.unpack_from(self.dades)
+            if len(self.dades) < mida_capcalera + mida:
+                break
+            missatges.append(self.dades[mida_capcalera:mida_capcalera + mida].decode("utf8"))
+            self.dades = self.dades[mida_capcalera + mida:]
+        return missatges
+
+    def tanca(self):
+        self.connexio.close()
+
+
+# arrenca el servidor
+ip, port, opcions = eines.obte_adressa(sys.argv)
+servidor = eines.Servidor(ip, port, ["--batec=%s" % BATEC] + opcions)
+
+mut = Participant(servidor, "mut")
+atent = Participant(servidor, "atent")
+
+# el participant mut rep batecs fins que el servidor el desconnecta, mentre
+# que l'atent els respon
+inici = time.monotonic()
+batecs_mut = 0
+batecs_atent = 0
+durada_mut = None
+while time.monotonic() - inici < MAXIM_ESPERA:
+    if durada_mut is None:
+        missatges = mut.rep(0.05)
+        if missatges is None:
+            durada_mut = time.monotonic() - inici
+        else:
+            batecs_mut += missatges.count("{ping}")
+    missatges = atent.rep(0.05)
+    assert missatges is not None, "el servidor ha desconnectat el participant que respon els batecs"
+    for missatge in missatges:
+        if missatge == "{ping}":
+            batecs_atent += 1
+            atent.envia("{pong}")
+    if durada_mut is not None and time.monotonic() - inici > durada_mut + 2 * BATEC:
+        break
+logging.info("Participant mut desconnectat en %s s després de %s batecs. L'atent n'ha respost %s"
+             % (durada_mut, batecs_mut, batecs_atent))
+assert durada_mut is not None, "el servidor no ha desconnectat el participant mut"
+assert batecs_mut == BATECS_SENSE_RESPOSTA, "el participant mut ha rebut %s batecs" % batecs_mut
+maxim = (BATECS_SENSE_RESPOSTA + 1) * BATEC + MARGE
+assert durada_mut < maxim, "el participant mut s'ha desconnectat en %.3f s" % durada_mut
+assert batecs_atent >= BATECS_SENSE_RESPOSTA, "el participant atent ha rebut %s batecs" % batecs_atent
+
+# el servidor respon els batecs dels participants
+atent.envia("{ping}")
+limit = time.monotonic() + MAXIM_ESPERA
+resposta = []
+while "{pong}" not in resposta and time.monotonic() < limit:
+    missatges = atent.rep(limit - time.monotonic())
+    assert missatges is not None, "el servidor ha tancat la connexió"
+    resposta += missatges
+assert "{pong}" in resposta, "el servidor no ha respost el batec"
+atent.tanca()
+mut.tanca()
+
+servidor.finalitza()
+logging.info("Finalitzat el test de batecs")
+print("OK")
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+"""
+    Test del servidor de xat
+
+    Aquest test comprova el protocol binari: sobres amb el tipus, l'emissor i
+    la sala, noms internats i compressió dels missatges llargs.
+
+    - connecta un participant que parla el protocol binari, un que parla amb
+      trames i un que parla en text
+
+    - comprova que el participant binari rep els missatges dels altres amb
+      el nom de l'emissor definit un sol cop i referenciat pel seu
+      identificador, també fora de la sala principal
+
+    - comprova que un missatge llarg arriba comprimit al participant binari i
+      sencer als altres, i que el que envia comprimit el participant binari
+      arriba sencer a tothom
+
+    - comprova que l'historial arriba al participant binari amb la definició
+      dels noms que fa servir
+
+    - comprova que el servidor desconnecta el participant binari que li envia
+      definicions de noms o reenviaments en comptes de missatges de text
+
+    Ús: test14_servidor_binari.py ip port
+"""
+
+import sys
+import socket
+import logging
+import time
+import zlib
+
+import eines
+import protocol
+
+MAXIM_ESPERA = 5        # temps màxim d'espera de cada missatge (en segons)
+
+logging.basicConfig(filename="client.py.log",
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s: %(message)s")
+logging.info("Arrenca el test 14")
+
+if len(sys.argv) != 3:
+    print("Ús: %s ip port" % sys.argv[0])
+    sys.exit()
+adressa = (sys.argv[1], int(sys.argv[2]))
+
+
+def sobre(missatge, comprimeix=False):
+    """ codifica el missatge dins d'un sobre binari de tipus text. A
+        diferència de protocol.sobre(), el test tria si es comprimeix """
+    dades = bytes(missatge, "utf8")
+    indicadors = 0
+    if comprimeix:
+        dades = zlib.compress(dades)
+        indicadors = protocol.COMPRIMIT
+    return protocol.CAPCALERA.pack(protocol.SOBRE.size + len(dades)) + protocol.SOBRE.pack(protocol.TIPUS_TEXT, indicadors, 0, 0) + dades
+
+
+class Binari:
+    """ Participant de prova que parla el protocol binari. Guarda els sobres
+        rebuts tal com arriben """
+
+    def __init__(self, nom):
+        self.connexio = socket.create_connection(adressa, MAXIM_ESPERA)
+        self.dades = b''
+        self.noms = dict()      # clau: identificador. valor: nom
+        self.definicions = []   # identificadors definits, en ordre
+        self.connexio.sendall(protocol.SALUTACIO_BINARI + sobre(nom))
+        assert self.rep_fins(lambda sobre: sobre[3].startswith("Hola")), "no s'ha rebut la benvinguda"
+
+    def rep(self):
+        """ retorna el proper sobre (tipus, emissor, sala, text, comprimit) """
+        while True:
+            if self.dades.startswith(protocol.SALUTACIO_BINARI):
+                self.dades = self.dades[len(protocol.SALUTACIO_BINARI):]
+            if len(self.dades) >= protocol.CAPCALERA.size:
+                mida, = protocol.CAPCALERA.unpack_from(self.dades)
+                if len(self.dades) >= protocol.CAPCALERA.size + mida:
+                    tipus, indicadors, emissor, sala = protocol.SOBRE.unpack_from(self.dades, protocol.CAPCALERA.size)
+                    dades = self.dades[protocol.CAPCALERA.size + protocol.SOBRE.size:protocol.CAPCALERA.size + mida]
+                    self.dades = self.dades[protocol.CAPCALERA.size + mida:]
+                    if indicadors & protocol.COMPRIMIT:
+                        dades = zlib.decompress(dades)
+                    text = dades.decode("utf8")
+                    if tipus == protocol.TIPUS_NOM:
+                        self.noms[emissor] = text
+                        self.definicions.append(emissor)
+                    return tipus, emissor, sala, text, bool(indicadors & protocol.COMPRIMIT)
+            dades = self.connexio.recv(65536)
+            assert dades, "el servidor ha tancat la connexió"
+            self.dades += dades
+
+    def rep_fins(self, condicio):
+        """ rep sobres fins que un compleix la condició i el retorna """
+        self.connexio.settimeout(MAXIM_ESPERA)
+        while True:
+            rebut = self.rep()
+            if condicio(rebut):
+                return rebut
+
+    def reenviament(self, text):
+        """ espera el reenviament amb el text indicat i retorna (nom, sala, comprimit) """
+        tipus, emissor, sala, _, comprimit = self.rep_fins(
+            lambda sobre: sobre[0] == protocol.TIPUS_REENVIAMENT and sobre[3] == text)
+        assert emissor in self.noms, "l'emissor %s no s'ha definit" % emissor
+        assert sala == 0 or sala in self.noms, "la sala %s no s'ha definit" % sala
+        return self.noms[emissor], self.noms[sala] if sala else None, comprimit
+
+    def envia(self, missatge, comprimeix=False):
+        self.connexio.sendall(sobre(missatge, comprimeix))
+
+
+class Trames:
+    """ Participant de prova que parla amb trames o en text """
+
+    def __init__(self, nom, text=False):
+        self.text = text
+        self.connexio = socket.create_connection(adressa, MAXIM_ESPERA)
+        self.dades = b''
+        if text:
+            self.connexio.sendall(bytes(nom, "utf8"))
+        else:
+            self.connexio.sendall(protocol.SALUTACIO + eines.trama(nom))
+        self.espera(lambda dades: b"Hola" in dades)
+
+    def envia(self, missatge):
+        if self.text:
+            self.connexio.sendall(bytes(missatge, "utf8"))
+            time.sleep(0.1)     # en text, cada lectura és un missatge
+        else:
+            self.connexio.sendall(eines.trama(missatge))
+
+    def espera(self, condicio):
+        """ acumula el que arriba fins que les dades compleixen la condició """
+        self.connexio.settimeout(MAXIM_ESPERA)
+        while not condicio(self.dades):
+            dades = self.connexio.recv(65536)
+            assert dades, "el servidor ha tancat la connexió"
+            self.dades += dades
+        self.dades = b''
+
+
+binari = Binari("binari")
+trames = Trames("trames")
+text = Trames("text", text=True)
+
+# noms internats: el nom es defineix un sol cop
+trames.envia("primer")
+assert binari.reenviament("primer") == ("trames", None, False), "el primer reenviament és incorrecte"
+trames.envia("segon")
+assert binari.reenviament("segon") == ("trames", None, False), "el segon reenviament és incorrecte"
+text.envia("del text")
+assert binari.reenviament("del text") == ("text", None, False), "el reenviament del text és incorrecte"
+assert len(binari.definicions) == len(set(binari.definicions)), \
+    "s'han repetit definicions de noms: %s" % binari.definicions
+logging.info("Noms definits: %s" % binari.noms)
+
+# fora de la sala principal
+for participant in (binari, trames):
+    participant.envia("{entra cuina}")
+time.sleep(0.3)
+trames.envia("a la cuina")
+assert binari.reenviament("a la cuina") == ("trames", "cuina", False), "el reenviament a la sala és incorrecte"
+
+# compressió en els dos sentits
+for participant in (binari, trames):
+    participant.envia("{canvia principal}")
+time.sleep(0.3)
+llarg = "bla " * 1000
+trames.envia(llarg)
+assert binari.reenviament(llarg.strip()) == ("trames", None, True), "el missatge llarg no ha arribat comprimit"
+text.espera(lambda dades: dades.count(b"bla") == 1000)
+binari.envia(llarg, comprimeix=True)
+trames.espera(lambda dades: dades.count(b"bla") == 1000 and b"[binari]" in dades)
+text.espera(lambda dades: dades.count(b"bla") == 1000 and b"[binari]" in dades)
+logging.info("Missatges llargs comprimits correctament")
+
+# l'historial torna a definir els noms que fa servir
+binari.noms.clear()
+binari.envia("{historial 3}")
+binari.rep_fins(lambda sobre: sobre[3].startswith("Historial"))
+assert binari.reenviament("del text") == ("text", None, False), "l'historial no defineix els noms"
+
+# un client no pot definir noms ni reenviar missatges
+for tipus in (protocol.TIPUS_NOM, protocol.TIPUS_REENVIAMENT):
+    intrus = Binari("intrus")
+    intrus.connexio.sendall(protocol.sobre(tipus, "anna", 7))
+    try:
+        while intrus.connexio.recv(65536):
+            pass
+    except ConnectionResetError:
+        pass
+    intrus.connexio.close()
+logging.info("Tipus de missatge dels clients comprovats")
+
+for participant in (binari, trames, text):
+    participant.connexio.sendall(sobre("{quit}") if isinstance(participant, Binari) else
+                                 eines.trama("{quit}") if not participant.text else b"{quit}")
+    participant.connexio.close()
+
+logging.info("Finalitzat el test del protocol binari")
+print("OK")
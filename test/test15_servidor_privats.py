@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""
+    Test del servidor de xat
+
+    Aquest test comprova els missatges privats.
+
+    - anna, bernat i carla entren a la sala principal, i bernat entra també a
+      la sala jocs
+    - anna envia un missatge privat a bernat: només l'hi arriba a ell, encara
+      que parli a una altra sala
+    - anna envia un missatge privat a bernat i a carla: els arriba a tots dos
+    - anna s'envia un missatge privat a si mateixa i rep un avís, o l'envia
+      a carla i a si mateixa i només arriba a carla
+    - anna envia un missatge privat a un participant que no existeix, o sense
+      missatge, i rep un avís
+    - amb diversos processos, els participants poden ser a processos
+      diferents i els missatges privats els arriben igualment
+"""
+
+import sys
+import socket
+import logging
+import time
+
+import eines
+import protocol
+
+logging.basicConfig(filename="client.py.log",
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s: %(message)s")
+logging.info("Arrenca el test 15")
+
+# Obté la IP i el port de connexió amb el servidor
+ip, port = sys.argv[1], int(sys.argv[2])
+
+
+def espera(connexio, esperat):
+    """ salta els avisos d'entrada de participants i comprova que el proper
+        missatge de la connexió és l'esperat """
+    rebut = eines.rep_trama(connexio)
+    while rebut.startswith("S'ha afegit"):
+        rebut = eines.rep_trama(connexio)
+    assert rebut == esperat, "esperat '%s' però rebut '%s'" % (esperat, rebut)
+
+
+def entra(nom):
+    connexio = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    connexio.settimeout(2)
+    connexio.connect((ip, port))
+    connexio.sendall(protocol.SALUTACIO + eines.trama(nom))
+    assert eines.rep_exacte(connexio, len(protocol.SALUTACIO)) == protocol.SALUTACIO
+    assert eines.rep_trama(connexio).startswith("Hola %s." % nom), "no s'ha rebut la benvinguda"
+    return connexio
+
+
+anna = entra("anna_15")
+bernat = entra("bernat_15")
+carla = entra("carla_15")
+bernat.sendall(eines.trama("{entra jocs}"))
+espera(bernat, "Ara parles a la sala jocs. Hi ha 1 participants")
+time.sleep(0.2)     # que els altres processos sàpiguen on és cada nom
+logging.info("anna, bernat i carla han entrat")
+
+# missatge privat a un sol participant
+anna.sendall(eines.trama("{privat bernat_15 hola bernat}"))
+anna.sendall(eines.trama("missatge per a tothom"))
+espera(bernat, "[anna_15, en privat] hola bernat")
+espera(bernat, "[anna_15] missatge per a tothom")
+espera(carla, "[anna_15] missatge per a tothom")
+logging.info("Missatge privat a bernat correcte")
+
+# missatge privat a una llista de participants
+anna.sendall(eines.trama("{privat bernat_15,carla_15,bernat_15 hola a tots dos}"))
+espera(bernat, "[anna_15, en privat] hola a tots dos")
+espera(carla, "[anna_15, en privat] hola a tots dos")
+logging.info("Missatge privat a bernat i carla correcte")
+
+# el nom de qui envia no és un destinatari
+anna.sendall(eines.trama("{privat anna_15 hola}"))
+espera(anna, "No et pots enviar un missatge privat a tu mateix")
+anna.sendall(eines.trama("{privat anna_15,carla_15 hola carla}"))
+espera(carla, "[anna_15, en privat] hola carla")
+logging.info("Missatges privats a si mateix correctes")
+
+# destinataris que no hi són, o sense missatge
+anna.sendall(eines.trama("{privat carla_15,ningu_15 hola}"))
+espera(anna, "No hi ha cap participant anomenat ningu_15")
+espera(carla, "[anna_15, en privat] hola")
+anna.sendall(eines.trama("{privat carla_15}"))
+espera(anna, "Cal indicar a qui i què: {privat nom[,nom...] missatge}")
+logging.info("Avisos dels missatges privats correctes")
+
+for connexio in (anna, bernat, carla):
+    connexio.sendall(eines.trama("{quit}"))
+    connexio.close()
+
+logging.info("Finalitzat el test de missatges privats")
+print("OK")
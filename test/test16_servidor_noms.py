@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+"""
+    Test del servidor de xat
+
+    Aquest test comprova que cada participant té un nom diferent.
+
+    - arrenca un servidor.py propi a la ip i el port indicats
+
+    - connecta alhora PARTICIPANTS participants que demanen el mateix nom, i
+      comprova que reben els noms "nom", "nom1", "nom2"... sense repeticions,
+      i que els rebatejats en reben l'avís
+
+    - comprova que un participant que demana explícitament un nom amb sufix
+      que ja està assignat també es rebateja
+
+    - quan marxen alguns participants, els nous reben el sufix més petit que
+      ha quedat lliure
+
+    - quan marxen tots, el nom torna a quedar lliure
+
+    Amb --processos=N dos processos poden assignar alhora el mateix nom, de
+    manera que el test només té sentit amb un sol procés.
+
+    Ús: test16_servidor_noms.py ip port [opcions del servidor ...]
+"""
+
+import sys
+import socket
+import logging
+import threading
+import time
+
+import eines
+import protocol
+
+PARTICIPANTS = 10
+NOM = "pep"
+MAXIM_ESPERA = 10       # temps màxim de cada fase del test (en segons)
+
+logging.basicConfig(filename="client.py.log",
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s: %(message)s")
+logging.info("Arrenca el test 16")
+
+
+def entra(nom):
+    """ connecta un participant que demana el nom. Retorna la tupla
+        (connexió, nom assignat, avís de rebateig o None) """
+    connexio = socket.create_connection((ip, servidor.port), MAXIM_ESPERA)
+    connexio.sendall(protocol.SALUTACIO + eines.trama(nom))
+    assert eines.rep_exacte(connexio, len(protocol.SALUTACIO)) == protocol.SALUTACIO
+    benvinguda = eines.rep_trama(connexio)
+    assert benvinguda.startswith("Hola "), "esperada la benvinguda però rebut '%s'" % benvinguda
+    assignat = benvinguda[len("Hola "):benvinguda.index(".")]
+    avis = None
+    if assignat != nom:
+        avis = eines.rep_trama(connexio)
+    return connexio, assignat, avis
+
+
+def surt(connexio):
+    connexio.sendall(eines.trama("{quit}"))
+    connexio.close()
+
+
+# arrenca el servidor
+ip, port, opcions = eines.obte_adressa(sys.argv)
+servidor = eines.Servidor(ip, port, opcions)
+
+# tots demanen el mateix nom alhora
+resultats = []
+barrera = threading.Barrier(PARTICIPANTS)
+
+
+def entra_alhora():
+    barrera.wait()
+    resultats.append(entra(NOM))
+
+
+fils = [threading.Thread(target=entra_alhora) for _ in range(PARTICIPANTS)]
+for fil in fils:
+    fil.start()
+for fil in fils:
+    fil.join(MAXIM_ESPERA)
+assert len(resultats) == PARTICIPANTS, "només han entrat %s participants" % len(resultats)
+noms = sorted(assignat for _, assignat, _ in resultats)
+esperats = sorted([NOM] + ["%s%s" % (NOM, numero) for numero in range(1, PARTICIPANTS)])
+assert noms == esperats, "noms assignats incorrectes: %s" % noms
+for _, assignat, avis in resultats:
+    if assignat != NOM:
+        assert avis == "El nom %s ja el fa servir algú altre. Et diràs %s" % (NOM, assignat), \
+            "avís de rebateig incorrecte: %s" % avis
+logging.info("Assignats %s noms diferents" % len(noms))
+
+# un nom amb sufix ja assignat també es rebateja
+connexio, assignat, _ = entra("%s1" % NOM)
+assert assignat == "%s11" % NOM, "el participant que demana %s1 s'ha dit %s" % (NOM, assignat)
+surt(connexio)
+
+# els sufixos que queden lliures es tornen a fer servir, primer el més petit
+alliberats = ["%s5" % NOM, "%s3" % NOM]
+observador, _, _ = entra("observador_16")
+for connexio, assignat, _ in resultats:
+    if assignat in alliberats:
+        surt(connexio)
+resultats = [resultat for resultat in resultats if resultat[1] not in alliberats]
+# el servidor atén les sortides pel seu compte: un missatge privat als dos
+# noms i a un que no té ningú respon quins no hi són, fins que ho són tots
+consultats = alliberats + ["ningu_16"]
+absents = "No hi ha cap participant anomenat %s" % ", ".join(consultats)
+limit = time.monotonic() + MAXIM_ESPERA
+while True:
+    observador.sendall(eines.trama("{privat %s hola}" % ",".join(consultats)))
+    rebut = eines.rep_trama(observador)
+    while not rebut.startswith("No hi ha cap participant"):    # avisos de les sortides
+        rebut = eines.rep_trama(observador)
+    if rebut == absents:
+        break
+    assert time.monotonic() < limit, "no s'han alliberat els noms %s" % alliberats
+    time.sleep(0.1)
+for esperat in (alliberats[1], alliberats[0]):
+    resultat = entra(NOM)
+    resultats.append(resultat)
+    assert resultat[1] == esperat, "el participant nou s'ha dit %s i no %s" % (resultat[1], esperat)
+surt(observador)
+logging.info("S'han tornat a fer servir els sufixos lliures")
+
+# quan marxen tots, el nom queda lliure
+for connexio, _, _ in resultats:
+    surt(connexio)
+limit = time.monotonic() + MAXIM_ESPERA
+while True:
+    connexio, assignat, _ = entra(NOM)
+    surt(connexio)
+    if assignat == NOM:
+        break
+    assert time.monotonic() < limit, "el nom %s no ha quedat lliure" % NOM
+    time.sleep(0.1)
+logging.info("El nom %s ha quedat lliure" % NOM)
+
+servidor.finalitza()
+logging.info("Finalitzat el test de noms")
+print("OK")
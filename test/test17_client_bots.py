@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+"""
+    Test de la biblioteca de clients del xat (xat.py)
+
+    Aquest test comprova que un sol bucle pot atendre molts bots i que els
+    bots es tornen a connectar quan el servidor torna a arrencar.
+
+    - arrenca un servidor.py propi a la ip i el port indicats
+
+    - connecta BOTS bots "no a tot selectiu" i un participant que parla, tots
+      al mateix xat.Bucle, des d'un sol fil
+
+    - comprova que tots els bots reben el missatge del que parla, amb
+      l'emissor i el text separats, i que tots li responen
+
+    - finalitza el servidor i n'arrenca un altre al mateix port, i comprova
+      que tots els bots s'hi tornen a connectar sols
+
+    Ús: test17_client_bots.py ip port [opcions del servidor ...]
+"""
+
+import sys
+import logging
+import time
+
+import eines
+import xat
+
+BOTS = 200
+MAXIM_ESPERA = 20       # temps màxim de cada fase del test (en segons)
+RESPOSTA = "no estic d'acord"
+
+logging.basicConfig(filename="client.py.log",
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s: %(message)s")
+logging.info("Arrenca el test 17")
+
+
+def espera_fins(bucle, condicio, descripcio):
+    """ fa voltes al bucle fins que es compleix la condició """
+    limit = time.monotonic() + MAXIM_ESPERA
+    while not condicio():
+        assert time.monotonic() < limit, "no s'ha complert: %s" % descripcio
+        bucle.volta(0.1)
+
+
+class Bot(xat.Client):
+    """ bot "no a tot selectiu": respon només els missatges del que parla """
+
+    def __init__(self, servidor, nom):
+        super().__init__(servidor.ip, servidor.port, nom)
+        self.connexions = 0
+        self.benvingut = False
+        self.rebuts = []
+        self.afegeix_gestor(Bot.no_a_tot)
+
+    def connectat(self):
+        self.connexions += 1
+        self.benvingut = False
+
+    def rebut(self, missatge):
+        if missatge.text.startswith("Hola "):
+            self.benvingut = True
+        super().rebut(missatge)
+
+    def no_a_tot(self, missatge):
+        if missatge.emissor == "parlador":
+            self.rebuts.append((missatge.emissor, missatge.cos))
+            self.envia(RESPOSTA)
+
+
+# arrenca el servidor
+ip, port, opcions = eines.obte_adressa(sys.argv)
+servidor = eines.Servidor(ip, port, opcions)
+
+bucle = xat.Bucle()
+bots = [Bot(servidor, "bot_%s" % numero) for numero in range(BOTS)]
+for bot in bots:
+    bucle.afegeix(bot)
+respostes = []
+parlador = xat.Client(ip, servidor.port, "parlador", reconnecta=False)
+parlador.afegeix_gestor(lambda client, missatge: respostes.append(missatge)
+                        if missatge.cos == RESPOSTA else None)
+bucle.afegeix(parlador)
+espera_fins(bucle, lambda: all(bot.benvingut for bot in bots), "tots els bots han entrat")
+espera_fins(bucle, lambda: parlador.nom == "parlador" and parlador.estat == xat.CONNECTAT,
+            "el parlador ha entrat")
+logging.info("Han entrat %s bots" % BOTS)
+
+# tots els bots reben el missatge analitzat i responen
+parlador.envia("hola bots")
+espera_fins(bucle, lambda: all(bot.rebuts for bot in bots), "tots els bots han rebut el missatge")
+for bot in bots:
+    assert bot.rebuts == [("parlador", "hola bots")], "%s ha rebut %s" % (bot.nom, bot.rebuts)
+espera_fins(bucle, lambda: len(respostes) == BOTS, "tots els bots han respost")
+assert {resposta.emissor for resposta in respostes} == {bot.nom for bot in bots}, \
+    "no han respost tots els bots"
+logging.info("Han respost tots els bots")
+
+# en tornar a arrencar el servidor, els bots s'hi tornen a connectar
+parlador.tanca()
+servidor.finalitza()
+espera_fins(bucle, lambda: all(bot.estat != xat.CONNECTAT for bot in bots), "tots els bots s'han desconnectat")
+servidor = eines.Servidor(ip, servidor.port, opcions)
+espera_fins(bucle, lambda: all(bot.connexions == 2 and bot.benvingut for bot in bots),
+            "tots els bots s'han tornat a connectar")
+assert len(bucle.clients) == BOTS, "el bucle atén %s clients" % len(bucle.clients)
+logging.info("S'han tornat a connectar tots els bots")
+
+bucle.tanca()
+servidor.finalitza()
+logging.info("Finalitzat el test de bots")
+print("OK")
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""
+    Test del motor de tortugues sense pantalla (tortuga.py)
+
+    - comprova la posició, l'orientació i les línies d'una tortuga que fa un
+      quadrat, que cada participant té la seva tortuga i el seu color, i que
+      inicia esborra el dibuix d'una sola tortuga
+
+    - comprova que aplicar les comandes en un lot, ajuntant les que es
+      repeteixen, dona el mateix estat que aplicar-les una a una
+
+    - comprova les instantànies en JSON i en SVG
+
+    - arrenca un servidor.py propi amb diari a la ip i el port indicats, hi
+      connecta dos participants que mouen les seves tortugues a la sala
+      principal i a una altra sala, i comprova que en reproduir el diari i un
+      registre de text amb tortuga.py es refà el mateix dibuix
+
+    Ús: test18_tortuga.py ip port [opcions del servidor ...]
+"""
+
+import json
+import os
+import sys
+import socket
+import logging
+import subprocess
+import tempfile
+
+import eines
+import diari
+import protocol
+import tortuga
+
+MAXIM_ESPERA = 10       # temps màxim de cada fase del test (en segons)
+
+logging.basicConfig(filename="client.py.log",
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s: %(message)s")
+logging.info("Arrenca el test 18")
+
+
+def rep_fins(connexio, text):
+    """ rep dades fins que arriba el text """
+    dades = b''
+    connexio.settimeout(MAXIM_ESPERA)
+    while bytes(text, "utf8") not in dades:
+        tros = connexio.recv(65536)
+        assert tros, "s'ha tancat la connexió"
+        dades += tros
+
+
+def dibuix_de(textos, sala=None):
+    dibuix = tortuga.Dibuix()
+    dibuix.reprodueix(textos, sala)
+    return dibuix
+
+
+# un quadrat
+quadrat = ["[anna] tortuga endavant", "[anna] tortuga esquerra"] * 4
+dibuix = dibuix_de(quadrat)
+anna = dibuix.tortugues["anna"]
+assert (round(anna.x, 6), round(anna.y, 6), anna.angle) == (0, 0, 0), "la tortuga no ha tornat a l'inici"
+assert [round(coordenada) for coordenada in anna.segments] == \
+    [0, 0, 100, 0, 100, 0, 100, 100, 100, 100, 0, 100, 0, 100, 0, 0], "línies del quadrat incorrectes"
+assert dibuix.comandes == 8, "s'han comptat %s comandes" % dibuix.comandes
+
+# els passos seguits són una sola línia, s'apliquin en lot o d'un en un
+dibuix = dibuix_de(["[anna] tortuga endavant"] * 3 + ["[anna] tortuga dreta", "[anna] tortuga endavant"])
+assert [round(coordenada) for coordenada in dibuix.tortugues["anna"].segments] == \
+    [0, 0, 300, 0, 300, 0, 300, -100], "els passos seguits no són una sola línia"
+una_a_una = tortuga.Dibuix()
+for _ in range(3):
+    una_a_una.aplica("anna", "endavant")
+assert list(una_a_una.tortugues["anna"].segments) == [0, 0, 300, 0], "els passos d'un en un no són una sola línia"
+
+# cada participant la seva tortuga, i inicia només n'esborra una
+dibuix = dibuix_de(quadrat + ["[bernat] tortuga dreta", "[bernat] tortuga endavant",
+                              "[anna] tortuga inicia", "[anna] tortuga salta", "[anna] hola",
+                              "[carla, en privat] tortuga endavant", "Hola anna."])
+anna, bernat = dibuix.tortugues["anna"], dibuix.tortugues["bernat"]
+assert not anna.segments and anna.reinicis == 1, "inicia no ha esborrat el dibuix"
+assert [round(coordenada) for coordenada in bernat.segments] == [0, 0, 0, -100], "línia de bernat incorrecta"
+assert anna.color != bernat.color, "anna i bernat tenen el mateix color"
+assert dibuix.tortugues["carla"].segments, "no s'han aplicat les comandes privades"
+logging.info("Estat de les tortugues correcte")
+
+# en lot o una a una
+comandes = [("p%s" % (numero % 7), nom) for numero, nom in
+            enumerate(["endavant", "endavant", "esquerra", "endavant", "dreta", "dreta", "inicia",
+                       "endavant", "esquerra", "esquerra", "endavant"] * 50)]
+en_lot = tortuga.Dibuix()
+en_lot.aplica_lot(comandes)
+una_a_una = tortuga.Dibuix()
+for emissor, nom in comandes:
+    una_a_una.aplica(emissor, nom)
+assert en_lot.exporta_json() == una_a_una.exporta_json(), "el lot dona un estat diferent"
+assert en_lot.comandes == una_a_una.comandes == len(comandes)
+logging.info("Lots correctes")
+
+# instantànies
+dibuix = dibuix_de(quadrat + ["[bernat] tortuga dreta", "[bernat] tortuga endavant"])
+instantania = json.loads(dibuix.exporta_json())
+assert [t["nom"] for t in instantania["tortugues"]] == ["anna", "bernat"]
+assert instantania["tortugues"][1] == {"nom": "bernat", "color": "red", "x": 0, "y": -100, "angle": 270,
+                                      "baixada": True, "segments": [0, 0, 0, -100]}, \
+    "instantània incorrecta: %s" % instantania["tortugues"][1]
+svg = dibuix.exporta_svg()
+assert svg.startswith("<svg") and svg.endswith("</svg>"), "SVG incorrecte"
+assert svg.count("<path") == 2 and 'stroke="red"' in svg, "falten camins a l'SVG"
+assert "M0 0L100 0L100 -100L0 -100L0 0" in svg, "el quadrat no és un sol tram: %s" % svg
+logging.info("Instantànies correctes")
+
+# reproducció d'un diari i d'un registre de text
+directori = tempfile.mkdtemp(prefix="diari_test18_")
+ip, port, opcions = eines.obte_adressa(sys.argv)
+servidor = eines.Servidor(ip, port, ["--diari=%s" % directori] + opcions)
+
+participants = dict()
+for nom in ("anna_18", "bernat_18"):
+    connexio = socket.create_connection((ip, servidor.port), MAXIM_ESPERA)
+    connexio.sendall(protocol.SALUTACIO + eines.trama(nom))
+    rep_fins(connexio, "Hola %s." % nom)
+    participants[nom] = connexio
+participants["bernat_18"].sendall(eines.trama("{entra cuina}"))
+rep_fins(participants["bernat_18"], "Ara parles a la sala cuina")
+enviats = []
+for missatge in ["tortuga endavant", "tortuga esquerra", "tortuga endavant", "tortuga endavant"]:
+    participants["anna_18"].sendall(eines.trama(missatge))
+    enviats.append("[anna_18] %s" % missatge)
+for missatge in ["tortuga dreta", "tortuga endavant"]:
+    participants["bernat_18"].sendall(eines.trama(missatge))
+    enviats.append("[bernat_18@cuina] %s" % missatge)
+participants["anna_18"].sendall(eines.trama("{historial}"))
+rep_fins(participants["anna_18"], "tortuga endavant")
+for connexio in participants.values():
+    connexio.sendall(eines.trama("{quit}"))
+    connexio.close()
+servidor.finalitza()
+
+arxivats = [text for _, text in diari.recorre(directori)]
+assert sorted(arxivats) == sorted(enviats), "el diari conté %s" % arxivats
+principal = dibuix_de((text for _, text in diari.recorre(directori)), "principal")
+assert list(principal.tortugues) == ["anna_18"], "tortugues de la sala principal: %s" % list(principal.tortugues)
+assert principal.exporta_json() == dibuix_de(enviats[:4]).exporta_json(), "el diari no refà el dibuix"
+cuina = dibuix_de((text for _, text in diari.recorre(directori)), "cuina")
+assert list(cuina.tortugues) == ["bernat_18"], "tortugues de la sala cuina: %s" % list(cuina.tortugues)
+logging.info("Reproducció del diari correcta")
+
+# amb tortuga.py, des del diari i des d'un registre de text
+registre = os.path.join(directori, "registre.txt")
+with open(registre, "w", encoding="utf8") as fitxer:
+    fitxer.write("\n".join(["Hola anna_18. Acabes d'entrar a la sala de xat"] + enviats[:4]) + "\n")
+for origen in (directori, registre):
+    instantania = os.path.join(directori, "instantania.json")
+    sortida = subprocess.run([sys.executable, os.path.join(eines.DIRECTORI_SRC, 'tortuga.py'), "--sala=principal",
+                              "--json=%s" % instantania, "--svg=%s" % instantania[:-5] + ".svg", origen],
+                             stdout=subprocess.PIPE, timeout=MAXIM_ESPERA, check=True, encoding="utf8")
+    assert "Reproduïdes 4 comandes de 1 tortugues" in sortida.stdout, sortida.stdout
+    with open(instantania, encoding="utf8") as fitxer:
+        assert fitxer.read() == principal.exporta_json(), "tortuga.py no refà el dibuix de %s" % origen
+    assert os.path.getsize(instantania[:-5] + ".svg") > 0
+logging.info("Reproducció amb tortuga.py correcta")
+
+for nom in os.listdir(directori):
+    os.remove(os.path.join(directori, nom))
+os.rmdir(directori)
+logging.info("Finalitzat el test de tortugues")
+print("OK")
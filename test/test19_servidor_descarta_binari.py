@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+    Test del servidor de xat
+
+    Aquest test comprova que, amb la política descarta, un participant binari
+    que llegeix lentament perd missatges però no les definicions dels noms
+    que fan servir els que encara li han d'arribar.
+
+    - arrenca un servidor.py propi amb una cua petita i la política descarta
+      a la ip i el port indicats
+
+    - connecta un participant binari que deixa de llegir i uns quants
+      emissors que envien missatges llargs seguits, de manera que se
+      n'omple la cua i se'n descarten
+
+    - comprova que en tornar a llegir el participant binari descodifica tots
+      els missatges que li arriben, amb l'emissor definit, fins al darrer
+
+    Ús: test19_servidor_descarta_binari.py ip port [opcions del servidor ...]
+"""
+
+import base64
+import os
+import sys
+import socket
+import logging
+import time
+
+import eines
+import protocol
+
+MAXIM_ESPERA = 10       # temps màxim d'espera de cada fase (en segons)
+EMISSORS = 5            # participants que envien missatges
+MISSATGES = 100         # missatges seguits de cada emissor
+MIDA = 16 * 1024        # mida aproximada de cada missatge (en caràcters)
+
+logging.basicConfig(filename="client.py.log",
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s: %(message)s")
+logging.info("Arrenca el test 19")
+
+ip, port, opcions = eines.obte_adressa(sys.argv)
+servidor = eines.Servidor(ip, port, ["--cua=4", "--politica=descarta"] + opcions)
+
+# el participant binari, amb una memòria de recepció petita
+lector = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+lector.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+lector.settimeout(MAXIM_ESPERA)
+lector.connect((ip, servidor.port))
+lector.sendall(protocol.SALUTACIO_BINARI + protocol.sobre(protocol.TIPUS_TEXT, "lector"))
+descodificador = protocol.Descodificador(reenviaments=True)
+rebuts = []
+while not any(missatge.startswith("Hola") for missatge in rebuts):
+    assert descodificador.llegeix(lector), "el servidor ha tancat la connexió"
+    rebuts += descodificador.missatges()
+
+# els emissors envien els seus missatges seguits mentre el lector no llegeix
+emissors = []
+for numero in range(EMISSORS):
+    emissor = socket.create_connection((ip, servidor.port), MAXIM_ESPERA)
+    emissor.sendall(protocol.SALUTACIO + eines.trama("emissor%s" % numero))
+    assert eines.rep_exacte(emissor, len(protocol.SALUTACIO)) == protocol.SALUTACIO
+    assert eines.rep_trama(emissor).startswith("Hola"), "l'emissor no ha entrat"
+    emissors.append(emissor)
+enviats = 0
+for emissor in emissors:
+    for _ in range(MISSATGES):
+        # text aleatori perquè la compressió no l'encongeixi gaire
+        emissor.sendall(eines.trama(base64.b64encode(os.urandom(MIDA * 3 // 4)).decode("ascii")))
+        enviats += 1
+time.sleep(1)
+emissors[0].sendall(eines.trama("final"))
+enviats += 1
+logging.info("Enviats %s missatges" % enviats)
+
+# el lector ho descodifica tot, amb els emissors definits
+reenviaments = []
+while not reenviaments or reenviaments[-1] != "final":
+    try:
+        assert descodificador.llegeix(lector), "el servidor ha tancat la connexió"
+        missatges = descodificador.missatges()
+    except protocol.ErrorProtocol as error:
+        assert False, "el lector no pot descodificar el que rep: %s" % error
+    for missatge in missatges:
+        if isinstance(missatge, protocol.Reenviament):
+            assert missatge.nom.startswith("emissor"), "emissor incorrecte: %s" % missatge.nom
+            reenviaments.append(missatge.missatge)
+assert len(reenviaments) < enviats, "no s'ha descartat cap missatge"
+logging.info("Rebuts %s dels %s missatges" % (len(reenviaments), enviats))
+
+for connexio in [lector] + emissors:
+    connexio.close()
+servidor.finalitza()
+
+logging.info("Finalitzat el test de descart amb el protocol binari")
+print("OK")
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+"""
+    Test del servidor de xat
+
+    Aquest test comprova que l'historial de la sala principal es recupera
+    del diari en tornar a arrencar el servidor.
+
+    - arrenca un servidor.py propi amb diari a la ip i el port indicats, i a
+      hi envia uns quants missatges
+    - torna a arrencar el servidor amb el mateix diari i amb repetició, i
+      comprova que el primer participant que entra rep els darrers missatges
+      de la sala principal
+
+    Ús: test20_servidor_diari.py ip port [opcions del servidor ...]
+"""
+
+import os
+import sys
+import socket
+import logging
+import tempfile
+
+import eines
+import protocol
+
+MAXIM_ESPERA = 5        # temps màxim d'espera de cada missatge (en segons)
+MISSATGES = 7           # missatges que s'envien abans de tornar a arrencar
+REPETICIO = 3           # missatges que es repeteixen en entrar
+
+logging.basicConfig(filename="client.py.log",
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s: %(message)s")
+logging.info("Arrenca el test 20")
+
+
+def espera(connexio, esperat):
+    """ comprova que el proper missatge de la connexió és l'esperat """
+    rebut = eines.rep_trama(connexio)
+    assert rebut == esperat, "esperat '%s' però rebut '%s'" % (esperat, rebut)
+
+
+def entra(nom):
+    """ connecta el participant, que ha de ser el primer de la sala """
+    connexio = socket.create_connection((ip, servidor.port), MAXIM_ESPERA)
+    connexio.sendall(protocol.SALUTACIO + eines.trama(nom))
+    assert eines.rep_exacte(connexio, len(protocol.SALUTACIO)) == protocol.SALUTACIO
+    espera(connexio, "Hola %s. Acabes d'entrar a la sala de xat de Fanjac. De moment hi ha 1 participants" % nom)
+    return connexio
+
+
+directori = tempfile.mkdtemp(prefix="diari_test20_")
+ip, port, opcions = eines.obte_adressa(sys.argv)
+servidor = eines.Servidor(ip, port, ["--diari=%s" % directori, "--historial=5"] + opcions)
+
+# a envia els missatges, i l'historial confirma que han arribat al diari
+a = entra("a")
+for numero in range(1, MISSATGES + 1):
+    a.sendall(eines.trama("m%s" % numero))
+a.sendall(eines.trama("{historial 1}"))
+espera(a, "Historial de la sala principal (#%s a #%s):" % (MISSATGES, MISSATGES))
+espera(a, "[a] m%s" % MISSATGES)
+a.sendall(eines.trama("{quit}"))
+a.close()
+servidor.finalitza()
+
+# el primer que entra després d'arrencar rep la repetició
+servidor = eines.Servidor(ip, servidor.port, ["--diari=%s" % directori, "--historial=5",
+                                              "--repeticio=%s" % REPETICIO] + opcions)
+b = entra("b")
+primer = MISSATGES - REPETICIO + 1
+espera(b, "Historial de la sala principal (#%s a #%s):" % (primer, MISSATGES))
+for numero in range(primer, MISSATGES + 1):
+    espera(b, "[a] m%s" % numero)
+logging.info("Repetició de l'historial del diari correcta")
+b.sendall(eines.trama("{quit}"))
+b.close()
+servidor.finalitza()
+
+for nom in os.listdir(directori):
+    os.remove(os.path.join(directori, nom))
+os.rmdir(directori)
+logging.info("Finalitzat el test del diari")
+print("OK")